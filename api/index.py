@@ -1,5 +1,8 @@
 import importlib.util
 import pathlib
+import time
+
+_started = time.perf_counter()
 
 # プロジェクトルートの app.py へのパスを取得
 module_path = pathlib.Path(__file__).resolve().parent.parent / "app.py"
@@ -8,6 +11,9 @@ spec = importlib.util.spec_from_file_location("flask_app_module", module_path)
 module = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(module)
 
+# コールドスタートの計測用 (モジュール毎の内訳は scripts/import_cost_report.py で確認する)
+print(f"app.py の読み込み: {(time.perf_counter() - _started) * 1000:.0f} ms")
+
 # Vercel が検出する WSGI アプリとして公開
 app = module.app
 
@@ -2,9 +2,8 @@ from flask import Flask, render_template, jsonify, request, redirect, url_for
 from flask_socketio import SocketIO
 from dotenv import load_dotenv
 import os
-from app.models.database import db, init_db
 from app.controllers.document_controller import document_bp
-from app.controllers.chat_controller import chat_bp
+from app.controllers.chat_controller import chat_bp, register_socketio_events
 from app.controllers.settings_controller import settings_bp
 from app.controllers.auth_controller import auth_bp
 
@@ -17,30 +16,39 @@ app = Flask(__name__,
             static_folder='app/static')
             
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'default_secret_key')
-# Supabase への直接接続 URI（例: postgres://...）が無い場合、
-# SQLAlchemy を実際には使わないが拡張の初期化だけを行うために
-# インメモリ SQLite をフォールバックとして設定する。
+# データの読み書きは Supabase (PostgREST) で行い、SQLAlchemy のモデルは互換性のためだけに残している。
+# Supabase への直接接続 URI（例: postgres://...）が設定されている場合だけ初期化し、
+# それ以外 (Vercel など) では flask_sqlalchemy の import と create_all を省いてコールドスタートを短くする。
+if os.getenv('SUPABASE_DB_URL'):
+    from app.models.legacy_models import db, init_db
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SUPABASE_DB_URL', 'sqlite:///:memory:')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SUPABASE_DB_URL')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-# データベースの初期化
-db.init_app(app)
+    # データベースの初期化
+    db.init_app(app)
 
-# データベーステーブルの作成
-with app.app_context():
-    init_db()
+    # データベーステーブルの作成
+    with app.app_context():
+        init_db()
 
-# SocketIOの初期化 - engineioのロギングを有効に
+# SocketIOの初期化
+# async_mode は serve.py (本番用) が gevent / eventlet を指定する。
+# monkey patch をしていない `python app.py` では gevent 等がインストール済みでも threading で動かす
+socketio_debug_log = os.getenv('SOCKETIO_DEBUG_LOG', '1') == '1'
 socketio = SocketIO(app, 
+                   async_mode=os.getenv('SOCKETIO_ASYNC_MODE', 'threading'),
                    cors_allowed_origins="*", 
-                   logger=True, 
-                   engineio_logger=True,
+                   logger=socketio_debug_log, 
+                   engineio_logger=socketio_debug_log,
                    ping_timeout=60,
                    ping_interval=25)
 
 print("SocketIOを初期化しました")
 
+# チャットのストリーミング応答用イベントを登録
+register_socketio_events(socketio)
+
 # 各種ブループリントの登録
 app.register_blueprint(document_bp)
 app.register_blueprint(chat_bp)
@@ -71,6 +79,6 @@ def login_page():
     return render_template('login.html', supabase_url=os.getenv('SUPABASE_URL'))
 
 if __name__ == '__main__':
-    # デバッグモードでサーバー起動
+    # デバッグモードでサーバー起動 (本番は serve.py を使う)
     print("アプリケーションを起動します...")
     socketio.run(app, debug=True, port=5001) 
\ No newline at end of file
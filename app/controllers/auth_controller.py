@@ -1,11 +1,19 @@
 from flask import Blueprint, redirect, request, jsonify, url_for, g
 import os, jwt
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/auth')
 
+# 設定は起動時に一度だけ読む
 SUPA_URL = os.getenv('SUPABASE_URL')
 JWT_SECRET = os.getenv('SUPABASE_JWT_SECRET')
+DEBUG_AUTH = os.getenv('DEBUG_AUTH', 'false').lower() == 'true'
+# 検証済みトークンを保持する件数 (exp まで再検証を省略する)
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', '1024'))
 
 # ---------- Google OAuth flow via Supabase ---------- #
 
@@ -68,6 +76,55 @@ def callback():
 
 # ---------- JWT decorator ---------- #
 
+# 検証済みトークン: sha256(token) -> (payload, exp) の LRU
+_verified_tokens = OrderedDict()
+_verified_lock = threading.Lock()
+
+def _decode_token(token):
+    """
+    JWT を検証して payload を返す (失敗時は jwt.PyJWTError)。
+    検証済みのトークンは exp までキャッシュし、署名検証を繰り返さない。
+    """
+    key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    now = time.time()
+    with _verified_lock:
+        entry = _verified_tokens.get(key)
+        if entry is not None:
+            payload, exp = entry
+            if exp > now:
+                _verified_tokens.move_to_end(key)
+                return payload
+            del _verified_tokens[key]
+
+    payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'], audience='authenticated')
+    exp = payload.get('exp')
+    if exp and AUTH_TOKEN_CACHE_SIZE > 0:
+        with _verified_lock:
+            _verified_tokens[key] = (payload, exp)
+            _verified_tokens.move_to_end(key)
+            while len(_verified_tokens) > AUTH_TOKEN_CACHE_SIZE:
+                _verified_tokens.popitem(last=False)
+    return payload
+
+def verify_token(token):
+    """
+    Supabase の JWT を検証し、成功すれば g.current_user / g.jwt_token を設定して payload を返す。
+    検証に失敗した場合は None を返す（HTTP 以外の SocketIO イベントからも利用する）。
+    """
+    # デバッグ: 先頭数文字だけ表示して漏洩防止
+    if DEBUG_AUTH:
+        print('[AUTH] Header token (trunc):', token[:20] + '...')
+        print('[AUTH] JWT_SECRET (trunc):', (JWT_SECRET or '')[:8] + '...')
+    try:
+        payload = _decode_token(token)
+    except jwt.PyJWTError as e:
+        if DEBUG_AUTH:
+            print('[AUTH] Decode error:', e)
+        return None
+    g.current_user = payload['sub']  # Supabase UID
+    g.jwt_token = token
+    return payload
+
 def require_auth(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
@@ -75,17 +132,7 @@ def require_auth(fn):
         if not auth_header.startswith('Bearer '):
             return jsonify({'success': False, 'message': 'Unauthorized'}), 401
         token = auth_header.split()[1]
-        # デバッグ: 先頭数文字だけ表示して漏洩防止
-        if os.getenv('DEBUG_AUTH', 'false').lower() == 'true':
-            print('[AUTH] Header token (trunc):', token[:20] + '...')
-            print('[AUTH] JWT_SECRET (trunc):', (JWT_SECRET or '')[:8] + '...')
-        try:
-            payload = jwt.decode(token, JWT_SECRET, algorithms=['HS256'], audience='authenticated')
-            g.current_user = payload['sub']  # Supabase UID
-            g.jwt_token = token
-        except jwt.PyJWTError as e:
-            if os.getenv('DEBUG_AUTH', 'false').lower() == 'true':
-                print('[AUTH] Decode error:', e)
+        if verify_token(token) is None:
             return jsonify({'success': False, 'message': 'Token invalid'}), 401
         return fn(*args, **kwargs)
     return wrapper
@@ -1,24 +1,30 @@
-from flask import Blueprint, request, jsonify, g
-from app.models.database import (
-    get_document as supa_get_document,
+from flask import Blueprint, request, jsonify, g, current_app
+from app.models.storage import (
+    document_exists as supa_document_exists,
     get_chat_messages as supa_get_chat_messages,
-    create_chat_message as supa_create_chat_message,
+    begin_chat_turn as supa_begin_chat_turn,
+    chat_message_row,
     delete_chat_messages as supa_delete_chat_messages,
+    delete_chat_summary as supa_delete_chat_summary,
+    run_concurrently,
 )
 import os
 import json
 import sys
+import time
 
 # APIクライアントのインポート
-import openai
-import google.generativeai as genai
-from anthropic import Anthropic
-from duckduckgo_search import DDGS # ★ duckduckgo-search をインポート
-from google.generativeai.types import GenerationConfig, FunctionDeclaration, Tool
+from app.utils import web_search # ★ duckduckgo-search の検索 (キャッシュ・並列実行付き)
 from urllib.parse import urlparse # URLパース用に追記
 from io import BytesIO # Base64デコード用
 import base64
-from openai import OpenAI
+from app.utils.llm_gateway import LLM_TIMEOUT, get_llm_gateway
+from app.utils.context_builder import build_context, context_budget, estimate_tokens
+from app.utils.retrieval import select_relevant_text
+from app.utils.document_text import document_markdown
+from app.utils.chat_compaction import schedule_compaction
+from app.utils.chat_writer import get_chat_writer
+from app.utils.job_queue import CHAT_JOBS, get_job_queue
 
 chat_bp = Blueprint('chat', __name__, url_prefix='/api/chat')
 
@@ -32,15 +38,12 @@ print(f"OpenAI API Key設定状況: {'設定済み' if OPENAI_API_KEY else '未
 print(f"Google API Key設定状況: {'設定済み' if GOOGLE_API_KEY else '未設定'}")
 print(f"Anthropic API Key設定状況: {'設定済み' if ANTHROPIC_API_KEY else '未設定'}")
 
-# APIクライアントの設定
-if OPENAI_API_KEY:
-    openai.api_key = OPENAI_API_KEY
-if GOOGLE_API_KEY:
-    genai.configure(api_key=GOOGLE_API_KEY)
-if ANTHROPIC_API_KEY:
-    anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
-else:
-    anthropic_client = None
+# APIクライアントは llm_gateway が共有プール付きで遅延生成・再利用する
+llm_gateway = get_llm_gateway()
+# ユーザーメッセージは生成前に RPC begin_chat_turn で、アシスタントのメッセージは応答後に保存する
+chat_writer = get_chat_writer()
+# CHAT_JOBS=1 のとき、job: true の /send は生成をバックグラウンドのジョブとして実行する
+job_queue = get_job_queue()
 
 # -------------------- 504 回避用のチューニング定数 --------------------
 # Vercel の Serverless Function は 15 秒でタイムアウトするため、
@@ -48,17 +51,48 @@ else:
 #   • チャット履歴が多すぎる
 #   • 出力トークンを大量に要求する
 # などの条件が重なると 504 となる。これを防ぐための上限値を設定する。
-
-# ドキュメント本文は末尾 MAX_CONTEXT_CHARS 文字だけを送る
-MAX_CONTEXT_CHARS = 15_000  # およそ 4k〜5k トークン相当
-# チャット履歴は直近 MAX_CHAT_HISTORY_MSG メッセージに丸める
+# ドキュメント・履歴・追加コンテキストはモデル毎のトークン予算内に
+# context_builder.build_context で詰める (予算は context_builder 側で定義)。
+# ジョブモード (CHAT_JOBS=1 で job: true の /send) は生成をリクエストの外で行うため、
+# 出力トークン・コンテキスト予算・タイムアウトを JOB_* の値まで広げる。
+
+# システムプロンプト (定型文) 分として予約するトークン数
+SYSTEM_PROMPT_RESERVE_TOKENS = 400
+# チャット履歴は最大でも直近 MAX_CHAT_HISTORY_MSG メッセージに丸める
 MAX_CHAT_HISTORY_MSG = 25
+# DB から読み込む履歴の上限（全件を読まず直近分だけ取得する）
+# 今回のユーザーメッセージは応答後に保存するため、履歴には含まれない
+CHAT_HISTORY_FETCH_LIMIT = MAX_CHAT_HISTORY_MSG
+# /history のページサイズ上限
+MAX_HISTORY_PAGE_SIZE = 200
 # Gemini への出力トークン要求上限
 MAX_OUTPUT_TOKENS = 2_048
+# Claude への出力トークン要求上限
+CLAUDE_MAX_TOKENS = 1_024
+# ジョブモードはリクエストのタイムアウトに縛られないため、出力上限を広げ Claude の thinking も有効にする
+# (thinking の予算は出力上限に含まれるため JOB_MAX_OUTPUT_TOKENS より小さくする)
+JOB_MAX_OUTPUT_TOKENS = int(os.getenv('CHAT_JOB_MAX_OUTPUT_TOKENS', '8192'))
+JOB_THINKING_BUDGET_TOKENS = int(os.getenv('CHAT_JOB_THINKING_BUDGET_TOKENS', '4096'))
+# ジョブモードではモデル毎のコンテキスト予算をこの倍率まで広げる
+JOB_CONTEXT_BUDGET_MULTIPLIER = float(os.getenv('CHAT_JOB_CONTEXT_BUDGET_MULTIPLIER', '4'))
+# ジョブモードでの API 呼び出しのタイムアウト秒数 (通常は LLM_TIMEOUT)
+JOB_LLM_TIMEOUT = float(os.getenv('CHAT_JOB_LLM_TIMEOUT', '600'))
+# プロンプトキャッシュ: 指示・ドキュメント・過去履歴を先頭 (安定部分) に、
+# 追加コンテキストと最新メッセージを末尾 (変動部分) に置く。
+# Gemini は安定部分がこのトークン数以上のとき明示的コンテキストキャッシュを使う
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv('GEMINI_CACHE_MIN_TOKENS', '4096'))
+# Web検索有効時の Function Calling モード。AUTO なら検索不要な質問は 1 回の呼び出しで済む
+GEMINI_TOOL_MODE = os.getenv('GEMINI_TOOL_MODE', 'AUTO').upper()
+# ツール実行ループの上限 (ツール呼び出しの往復回数・経過秒数)。
+# 上限に達したら検索結果を渡した上でツール無し (mode NONE) で最終応答させる
+GEMINI_TOOL_MAX_ITERATIONS = int(os.getenv('GEMINI_TOOL_MAX_ITERATIONS', '3'))
+GEMINI_TOOL_TIME_BUDGET = float(os.getenv('GEMINI_TOOL_TIME_BUDGET', '8'))
 # --------------------------------------------------------------------
 
 # --- Gemini用 Web検索ツールの定義 --- START ---
-web_search_func = FunctionDeclaration(
+# google.generativeai の import は重い (コールドスタートが遅くなる) ため、
+# SDK の型は Gemini を初めて呼び出すときに import する
+WEB_SEARCH_DECLARATION = dict(
     name="web_search",
     description="ユーザーの質問に答えるために、Webで情報を検索します。最新情報、不明確な用語、事実確認が必要な場合に加え、ユーザーが『検索して』と明示的に指示した場合は、他の判断基準よりも優先して必ずこのツールを呼び出してください。",
     parameters={
@@ -72,7 +106,14 @@ web_search_func = FunctionDeclaration(
         "required": ["search_query"]
     }
 )
-search_tool = Tool(function_declarations=[web_search_func])
+_search_tool = None
+
+def _get_search_tool():
+    global _search_tool
+    if _search_tool is None:
+        from google.generativeai.types import FunctionDeclaration, Tool
+        _search_tool = Tool(function_declarations=[FunctionDeclaration(**WEB_SEARCH_DECLARATION)])
+    return _search_tool
 # --- Gemini用 Web検索ツールの定義 --- END ---
 
 from app.controllers.auth_controller import require_auth
@@ -82,13 +123,14 @@ from app.controllers.auth_controller import require_auth
 def reset_chat_history(doc_id):
     """指定されたドキュメントIDに関連するチャット履歴を削除"""
     try:
-        # ドキュメント存在チェック
-        document = supa_get_document(doc_id)
-        if not document:
+        # ドキュメント存在チェック (id 列のみ取得)
+        if not supa_document_exists(doc_id):
             return jsonify({'success': False, 'message': 'Document not found'}), 404
 
-        # Supabaseでチャットメッセージを削除
+        # チャットメッセージ → 会話要約の順に削除する。実行中の要約 (chat_compaction) は
+        # 要約した最後のメッセージが残っている場合だけ保存されるため、この順なら古い要約が書き戻されない
         num_deleted = supa_delete_chat_messages(doc_id)
+        supa_delete_chat_summary(doc_id)
         
         print(f"ドキュメントID {doc_id} のチャット履歴を {num_deleted} 件削除しました。")
         return jsonify({'success': True, 'message': 'チャット履歴がリセットされました。'}), 200
@@ -99,24 +141,178 @@ def reset_chat_history(doc_id):
 @chat_bp.route('/history/<int:doc_id>', methods=['GET'])
 @require_auth
 def get_chat_history(doc_id):
-    """指定されたドキュメントIDに関連するチャット履歴を取得"""
-    document = supa_get_document(doc_id)
-    if not document:
+    """
+    指定されたドキュメントIDに関連するチャット履歴を取得
+
+    クエリパラメータ limit を指定するとページ単位で返す:
+      ?limit=50               → 最新 50 件
+      ?limit=50&before_id=123 → ID 123 より古い 50 件 (過去ページの遅延読み込み)
+    レスポンスは {messages, has_more, next_before_id}。limit 無しの場合は従来通り全件の配列。
+    """
+    limit = request.args.get('limit', type=int)
+    if limit:
+        limit = max(1, min(limit, MAX_HISTORY_PAGE_SIZE))
+    # ページ指定時は 1 件多く取得して次ページの有無を判定する
+    fetch_limit = limit + 1 if limit else None
+    before_id = request.args.get('before_id', type=int) if limit else None
+
+    # ドキュメントの存在確認と履歴の取得は独立しているので並行に行う
+    exists, page = run_concurrently(
+        lambda: supa_document_exists(doc_id),
+        lambda: supa_get_chat_messages(doc_id, limit=fetch_limit, before_id=before_id),
+    )
+    if not exists:
         return jsonify({'success': False, 'message': 'Document not found'}), 404
+    page = page or []
+    if not limit:
+        return jsonify(page)
+
+    has_more = len(page) > limit
+    if has_more:
+        page = page[1:]
+    return jsonify({
+        'messages': page,
+        'has_more': has_more,
+        'next_before_id': page[0]['id'] if has_more and page else None,
+    })
+
+# 会話要約を履歴に差し込む際のアシスタント側の応答文
+SUMMARY_ACK = "これまでの会話の要約を把握しました。"
 
-    chat_messages = supa_get_chat_messages(doc_id) or []
-    return jsonify(chat_messages)
+def _begin_chat_turn(doc_id, user_message, model_name, thinking_enabled):
+    """
+    ユーザーメッセージを保存し、ドキュメント・直近の履歴・会話要約を取得する (RPC 1 回)。
+    {'document', 'messages', 'summary', 'user_message_id'} を返す。ドキュメントが無ければ None。
+    """
+    # write-behind で保存待ちの前回のターンがあれば書き込みを待ってから読む
+    chat_writer.wait_for(doc_id)
+    return supa_begin_chat_turn(doc_id, user_message, model_name, thinking_enabled, CHAT_HISTORY_FETCH_LIMIT)
+
+def _assemble_context(doc_id, model_name, context, chat_history, user_message, chat_context, summary_row,
+                      budget=None):
+    """
+    ドキュメント・履歴・追加コンテキストをモデルのトークン予算内に詰め、
+    (context, chat_history, chat_context) を返す。全プロバイダ共通。
+    summary_row は会話要約 ({'summary', 'last_message_id'} または None)。
+    budget を省略した場合はモデル毎の既定の予算を使う。
+    ドキュメントが予算を超える場合は、ユーザーメッセージと関連の高いチャンクを選んで送る。
+    """
+    query = f"{user_message}\n{chat_context or ''}"
+
+    def select_document(document, max_tokens):
+        return select_relevant_text(doc_id, document, query, max_tokens, model_name)
+
+    # バックグラウンドで作成済みの古い会話の要約があれば、要約済みのメッセージは送らない
+    summary_row = summary_row or {}
+    summary = summary_row.get('summary')
+    if summary_row.get('last_message_id') is not None:
+        chat_history = [m for m in chat_history if m.get('id', 0) > summary_row['last_message_id']]
+
+    assembled = build_context(
+        model_name, context, chat_history, user_message, chat_context,
+        reserved_tokens=SYSTEM_PROMPT_RESERVE_TOKENS,
+        max_messages=MAX_CHAT_HISTORY_MSG,
+        budget=budget,
+        document_selector=select_document,
+        summary=summary,
+    )
+    print(f"--- コンテキスト: 約 {assembled['tokens']}/{assembled['budget']} トークン, "
+          f"履歴 {len(assembled['history'])} 件 (除外 {assembled['dropped_messages']} 件), "
+          f"要約: {bool(assembled['summary'])}, ドキュメント切り詰め: {assembled['document_truncated']} ---")
+
+    history = assembled['history']
+    if assembled['summary']:
+        # 要約は履歴の先頭に「ユーザー提示 → 了解」の1往復として置く (全プロバイダ共通の形)
+        history = [
+            {'role': 'user', 'content': f"[これまでの会話の要約]\n{assembled['summary']}"},
+            {'role': 'assistant', 'content': SUMMARY_ACK},
+        ] + history
+    return assembled['document'], history, assembled['chat_context']
+
+@chat_bp.route('/usage', methods=['GET'])
+@require_auth
+def get_usage_stats():
+    """プロセス起動以降の LLM トークン使用量 (プロンプトキャッシュのヒット/作成分を含む)"""
+    return jsonify(llm_gateway.usage_stats())
 
 @chat_bp.route('/send/<int:doc_id>', methods=['POST'])
 @require_auth
 def send_message(doc_id):
-    """ユーザーメッセージを保存し、AIからの応答を取得して保存"""
-    document = supa_get_document(doc_id)
-    if not document:
-        return jsonify({'success': False, 'message': 'Document not found'}), 404
+    """
+    ユーザーメッセージを保存し、AIからの応答を取得して保存
 
+    CHAT_JOBS=1 でペイロードに job: true を指定した場合は生成をジョブとして投入し、
+    202 {success, job_id, state} を即座に返す。結果は GET /api/chat/job/<job_id> か
+    SocketIO の 'chat_job_subscribe' → 'chat_job_done' で受け取る。
+    """
     data = request.get_json()
-    
+
+    if data.get('job') and CHAT_JOBS:
+        if not supa_document_exists(doc_id):
+            return jsonify({'success': False, 'message': 'Document not found'}), 404
+        job_id = job_queue.enqueue(
+            current_app._get_current_object(), 'chat', dict(data, doc_id=doc_id),
+            jwt_token=g.jwt_token, user_id=g.current_user,
+        )
+        return jsonify({'success': True, 'job_id': job_id, 'state': 'queued'}), 202
+
+    body, status = _complete_chat_turn(doc_id, data)
+    return jsonify(body), status
+
+class ChatResponseError(Exception):
+    """プロバイダがエラー応答を返した (status はクライアントに返す HTTP ステータス)"""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def _generate_chat_response(model_name, context, chat_history, user_message, thinking_enabled, chat_context,
+                            enable_search, image_data_base64, image_mime_type, job_mode=False):
+    """モデル名に応じて get_* を呼び、{message, sources} を返す"""
+    max_output_tokens = JOB_MAX_OUTPUT_TOKENS if job_mode else MAX_OUTPUT_TOKENS
+    timeout = JOB_LLM_TIMEOUT if job_mode else LLM_TIMEOUT
+    if model_name.startswith('gemini'):
+        if not GOOGLE_API_KEY:
+            raise ValueError("Google API Keyが設定されていません。")
+        return get_gemini_response(
+            model_name, context, chat_history, user_message, chat_context, enable_search,
+            image_data_base64, image_mime_type, max_output_tokens=max_output_tokens
+        )
+    if model_name.startswith('claude'):
+        if not ANTHROPIC_API_KEY:
+            raise ValueError("Anthropic API Keyが設定されていません。")
+        claude_response = get_claude_response(
+            model_name, context, chat_history, user_message, thinking_enabled, chat_context,
+            max_tokens=JOB_MAX_OUTPUT_TOKENS if job_mode else CLAUDE_MAX_TOKENS,
+            thinking_budget=JOB_THINKING_BUDGET_TOKENS if job_mode and thinking_enabled else None,
+            timeout=timeout,
+        )
+        return {"message": claude_response, "sources": []} # sources は空
+    if model_name.startswith('o3'):
+        if not OPENAI_API_KEY:
+            raise ValueError("OpenAI API Keyが設定されていません。")
+        o3_result = get_openai_o3_response(
+            model_name, context, chat_history, user_message, chat_context, timeout=timeout
+        )
+        # get_openai_o3_response は dict 形式で返す
+        if not o3_result.get("success", False):
+            raise ChatResponseError(o3_result.get("message", "OpenAI APIエラー"), o3_result.get("status", 500))
+        return {"message": o3_result.get("message", ""), "sources": []}
+    if model_name.startswith('gpt'):
+        if not OPENAI_API_KEY:
+            raise ValueError("OpenAI API Keyが設定されていません。")
+        gpt_response = get_openai_response(
+            model_name, context, chat_history, user_message, chat_context, timeout=timeout
+        )
+        return {"message": gpt_response, "sources": []} # sources は空
+    return {"message": "エラー: サポートされていないモデル...", "sources": []}
+
+def _complete_chat_turn(doc_id, data, job_mode=False):
+    """
+    1 ターン分の応答生成と保存を行い、(レスポンス dict, HTTP ステータス) を返す。
+    /send (同期) とジョブのワーカーの両方から呼ばれる。
+    """
     user_message = data.get('message', '')
     model_name = data.get('model', 'gemini-2.0-flash')
     thinking_enabled = data.get('thinking_enabled', False)
@@ -129,181 +325,176 @@ def send_message(doc_id):
     if image_data_base64 and ',' in image_data_base64:
         image_data_base64 = image_data_base64.split(',', 1)[1]
 
-    # Supabaseにユーザーメッセージを保存
-    supa_create_chat_message(
-        document_id=doc_id,
-        role='user',
-        content=user_message,
-        model_used=model_name,
-        thinking_enabled=thinking_enabled,
-        user_id=g.current_user,
+    # ユーザーメッセージを保存し、ドキュメントと直近のチャット履歴 (画像情報は含まれない) を取得
+    turn = _begin_chat_turn(doc_id, user_message, model_name, thinking_enabled)
+    if turn is None:
+        return {'success': False, 'message': 'Document not found'}, 404
+    budget = int(context_budget(model_name) * JOB_CONTEXT_BUDGET_MULTIPLIER) if job_mode else None
+    context, chat_history, chat_context = _assemble_context(
+        doc_id, model_name, document_markdown(turn['document']), turn['messages'], user_message, chat_context,
+        turn['summary'], budget
     )
 
-    # チャット履歴を取得 (画像情報は含まれない)
-    chat_history = supa_get_chat_messages(doc_id) or []
-    context = document.get('content', '')
-
-    ai_response_data = {}
     try:
-        if model_name.startswith('gemini'):
-            if not GOOGLE_API_KEY:
-                raise ValueError("Google API Keyが設定されていません。")
-            ai_response_data = get_gemini_response(
-                model_name, context, chat_history, user_message, chat_context, enable_search,
-                image_data_base64, image_mime_type
-            )
-        elif model_name.startswith('claude'):
-            if not ANTHROPIC_API_KEY:
-                raise ValueError("Anthropic API Keyが設定されていません。")
-            claude_response = get_claude_response(model_name, context, chat_history, user_message, thinking_enabled, chat_context)
-            ai_response_data = {"message": claude_response, "sources": []} # sources は空
-        elif model_name.startswith('o3'):
-            if not OPENAI_API_KEY:
-                raise ValueError("OpenAI API Keyが設定されていません。")
-            o3_result = get_openai_o3_response(
-                model_name, context, chat_history, user_message, chat_context
-            )
-
-            # get_openai_o3_response は dict 形式で返す
-            if not o3_result.get("success", False):
-                status_code = o3_result.get("status", 500)
-                return jsonify({
-                    'success': False,
-                    'message': o3_result.get("message", "OpenAI APIエラー"),
-                }), status_code
-
-            ai_response_data = {
-                "message": o3_result.get("message", ""),
-                "sources": []
-            }
-        elif model_name.startswith('gpt'):
-             if not OPENAI_API_KEY:
-                raise ValueError("OpenAI API Keyが設定されていません。")
-             gpt_response = get_openai_response(model_name, context, chat_history, user_message, chat_context)
-             ai_response_data = {"message": gpt_response, "sources": []} # sources は空
-        else:
-            ai_response_data = {"message": "エラー: サポートされていないモデル...", "sources": []}
-
+        ai_response_data = _generate_chat_response(
+            model_name, context, chat_history, user_message, thinking_enabled, chat_context,
+            enable_search, image_data_base64, image_mime_type, job_mode=job_mode
+        )
+    except ChatResponseError as e:
+        return {'success': False, 'message': e.message}, e.status
     except Exception as e:
         print(f"AI応答エラー: {str(e)}", file=sys.stderr)
         # エラーレスポンスを返す前に処理を終了
-        return jsonify({'success': False, 'message': f"AI応答取得エラー: {str(e)}"}), 500
-
-    # SupabaseにAI応答を保存
-    supa_create_chat_message(
-        document_id=doc_id,
-        role='assistant',
-        content=ai_response_data.get("message", ""),
-        model_used=model_name,
-        thinking_enabled=thinking_enabled,
-        user_id=g.current_user,
-    )
+        return {'success': False, 'message': f"AI応答取得エラー: {str(e)}"}, 500
+
+    # ★ 応答の先頭が "ny" であれば削除する (ストリーミングと同じく、補正後のメッセージを保存する)
+    ai_message = _strip_ny_prefix(ai_response_data.get("message", ""))
 
-    ai_message = ai_response_data.get("message", "")
-    # ★ 応答の先頭が "ny" であれば削除する処理を追加
-    if ai_message.startswith("ny"):
-        print(f"--- AI応答の先頭から 'ny' を削除しました: {ai_message[:10]}... ---") # デバッグ用ログ
-        ai_message = ai_message[2:] # 先頭の2文字を削除
+    # AI 応答を保存 (ユーザーメッセージは保存済み)
+    # (保存後、古い会話の要約をバックグラウンドで更新)
+    _save_chat_turn(doc_id, [
+        chat_message_row(doc_id, 'assistant', ai_message, model_name, thinking_enabled, g.current_user),
+    ], compact=True)
 
     # ★ フロントエンドに返すJSONに sources を含める
-    return jsonify({
+    return {
         'success': True, # 成功フラグを追加
         'message': ai_message, # ★ 修正後のメッセージを返す
         'sources': ai_response_data.get("sources", []), # 情報源リストを追加
         'model': model_name,
         'thinking_enabled': thinking_enabled
-    })
-
-def execute_web_search(search_query: str) -> dict: # ★ 返り値を dict に変更
-    """Web検索を実行し、結果テキストと情報源リストを含む辞書を返す"""
-    print(f"--- 実行する検索クエリ (AI提案): {search_query} ---")
+    }, 200
+
+def _run_chat_job(payload):
+    """ジョブのワーカーで実行する /send (結果は /send の同期レスポンスと同じ形 + status)"""
+    body, status = _complete_chat_turn(payload['doc_id'], payload, job_mode=True)
+    return dict(body, status=status)
+
+job_queue.register('chat', _run_chat_job)
+
+def _job_response(job):
+    """ジョブの状態を /api/chat/job と 'chat_job_done' のレスポンスにする"""
+    response = {'job_id': job['id'], 'state': job['status']}
+    if job['status'] == 'done':
+        response.update(job['result'] or {})
+    elif job['status'] == 'error':
+        response.update({'success': False, 'message': f"AI応答取得エラー: {job['error']}", 'status': 500})
+    return response
+
+def _get_own_job(job_id):
+    """ログイン中のユーザーが投入したジョブだけを返す"""
+    job = job_queue.get(job_id)
+    if job is None or job['kind'] != 'chat' or job['user_id'] != g.current_user:
+        return None
+    return job
+
+@chat_bp.route('/job/<job_id>', methods=['GET'])
+@require_auth
+def get_chat_job(job_id):
+    """ジョブモードの /send の状態・結果 (state: queued / running / done / error)"""
+    job = _get_own_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+    return jsonify(_job_response(job))
+
+def _save_chat_turn(doc_id, rows, compact=False):
+    """1 ターン分のメッセージを 1 回の INSERT で保存する (CHAT_WRITE_BEHIND ならバックグラウンド)"""
+    app = current_app._get_current_object()
+    jwt_token, user_id = g.jwt_token, g.current_user
+    on_saved = None
+    if compact:
+        def on_saved():
+            schedule_compaction(app, doc_id, jwt_token, user_id)
+    chat_writer.save(app, jwt_token, user_id, rows, on_saved=on_saved)
+
+def _format_search_results(results) -> dict:
+    """検索結果リストを AI に渡すテキストと情報源リストに整形する"""
     search_results_text = ""
     sources = [] # ★ 情報源リスト
-    try:
-        with DDGS() as ddgs:
-            results = [r for r in ddgs.text(search_query, region='jp-jp', max_results=3)]
-            if results:
-                search_results_text = "\n--- Web検索結果 ---\n" # AIに渡すテキスト用
-                for i, result in enumerate(results):
-                    title = result.get('title')
-                    body = result.get('body')
-                    url = result.get('href') # ★ URLを取得
-
-                    # AIに渡すテキストの整形
-                    if title and body:
-                         search_results_text += f"{i+1}. {title}\n   {body}\n"
-                    elif title:
-                         search_results_text += f"{i+1}. {title}\n"
-                    elif body:
-                         search_results_text += f"{i+1}. {body}\n"
-
-                    # ★ 情報源リストに追加 (タイトルとURLがあれば)
-                    if title and url:
-                        try:
-                            # ドメイン名を抽出。失敗したらURLそのまま
-                            parsed_url = urlparse(url)
-                            domain = parsed_url.netloc if parsed_url.netloc else url
-                        except Exception:
-                            domain = url
-                        sources.append({"title": title, "url": url, "domain": domain})
-
-                search_results_text += "--- Web検索結果ここまで ---\n"
-                print(f"検索結果 (Sources): {sources}") # デバッグ用
-            else:
-                print("Web検索結果が見つかりませんでした。")
-                search_results_text = "Web検索結果は見つかりませんでした。"
-    except Exception as e:
-        print(f"Web検索中にエラーが発生しました: {e}", file=sys.stderr)
-        search_results_text = "Web検索中にエラーが発生しました。"
+    if results:
+        search_results_text = "\n--- Web検索結果 ---\n" # AIに渡すテキスト用
+        for i, result in enumerate(results):
+            title = result.get('title')
+            body = result.get('body')
+            url = result.get('href') # ★ URLを取得
+
+            # AIに渡すテキストの整形
+            if title and body:
+                 search_results_text += f"{i+1}. {title}\n   {body}\n"
+            elif title:
+                 search_results_text += f"{i+1}. {title}\n"
+            elif body:
+                 search_results_text += f"{i+1}. {body}\n"
+
+            # ★ 情報源リストに追加 (タイトルとURLがあれば)
+            if title and url:
+                try:
+                    # ドメイン名を抽出。失敗したらURLそのまま
+                    parsed_url = urlparse(url)
+                    domain = parsed_url.netloc if parsed_url.netloc else url
+                except Exception:
+                    domain = url
+                sources.append({"title": title, "url": url, "domain": domain})
+
+        search_results_text += "--- Web検索結果ここまで ---\n"
+        print(f"検索結果 (Sources): {sources}") # デバッグ用
+    else:
+        print("Web検索結果が見つかりませんでした。")
+        search_results_text = "Web検索結果は見つかりませんでした。"
 
     # ★ 結果テキストと情報源リストを辞書で返す
     return {"result_text": search_results_text, "sources": sources}
 
-def get_gemini_response(model_name, context, chat_history, user_message, chat_context, enable_search,
-                        image_data_base64=None, image_mime_type=None): 
-    """Google Geminiモデルを使用して応答を生成 (Function Calling & 今回の画像入力対応)"""
-
-    if not GOOGLE_API_KEY:
-        raise ValueError("Google API Keyが設定されていません。")
-
-    # ★ 画像入力がある場合、マルチモーダル対応モデルか確認/促す
-    #    例: gemini-1.5-flash-latest などを使う
-    if image_data_base64:
-        # マルチモーダル非対応モデルが選択されていた場合の警告/変更（必要に応じて）
-        if not ('flash' in model_name or 'pro' in model_name): # 簡単なチェック
-             print(f"警告: 画像入力は Gemini Flash/Pro モデルでのみサポートされます。現在のモデル: {model_name}")
-             # ここでエラーを返すか、モデル名を強制変更するかの選択肢あり
-             # return {"message": f"エラー: 画像入力は Gemini Flash/Pro モデルを選択してください。", "sources": []}
-             # model_name = 'gemini-1.5-flash-latest' # 強制変更例
+def execute_web_search(search_query: str) -> dict: # ★ 返り値を dict に変更
+    """Web検索を実行し、結果テキストと情報源リストを含む辞書を返す (結果はキャッシュされる)"""
+    print(f"--- 実行する検索クエリ (AI提案): {search_query} ---")
+    try:
+        results = web_search.search(search_query)
+    except Exception as e:
+        print(f"Web検索中にエラーが発生しました: {e}", file=sys.stderr)
+        return {"result_text": "Web検索中にエラーが発生しました。", "sources": []}
+    return _format_search_results(results)
+
+def execute_web_searches(search_queries) -> list:
+    """複数の検索クエリを並列に実行し、クエリ順に execute_web_search と同じ形式の辞書を返す"""
+    print(f"--- 並列実行する検索クエリ (AI提案): {search_queries} ---")
+    formatted = []
+    for query, results in zip(search_queries, web_search.search_many(search_queries)):
+        if isinstance(results, Exception):
+            print(f"Web検索中にエラーが発生しました ({query}): {results}", file=sys.stderr)
+            formatted.append({"result_text": "Web検索中にエラーが発生しました。", "sources": []})
+        else:
+            formatted.append(_format_search_results(results))
+    return formatted
 
-        # マルチモーダル対応モデルでも古いバージョンの可能性もあるため注意喚起
-        if not ('1.5' in model_name or 'latest' in model_name):
-             print(f"情報: より新しいモデル(gemini-1.5-flash-latestなど)の方が画像認識性能が高い可能性があります。現在のモデル: {model_name}")
+def _build_gemini_model(model_name, enable_search, max_output_tokens=MAX_OUTPUT_TOKENS):
+    """GenerativeModel と tool_config を構築して返す"""
+    from google.generativeai.types import GenerationConfig
 
     # ---------------- GenerationConfig を最適化 ----------------
     generation_config = GenerationConfig(
-        max_output_tokens=MAX_OUTPUT_TOKENS,
+        max_output_tokens=max_output_tokens,
         candidate_count=1,        # 複数候補生成は遅延の元なので 1 に固定
     )
     model_kwargs = {"generation_config": generation_config}
     tool_config = None
     if enable_search:
         print("--- Web検索ツールを有効にしてGeminiを初期化 ---")
-        model_kwargs["tools"] = [search_tool]
-        tool_config = {"function_calling_config": {"mode": "ANY"}}
+        model_kwargs["tools"] = [_get_search_tool()]
+        tool_config = {"function_calling_config": {"mode": GEMINI_TOOL_MODE}}
         print(f"--- Tool config mode set to: {tool_config['function_calling_config']['mode']} ---")
 
-    model = genai.GenerativeModel(model_name, **model_kwargs)
-
-    # ---------------- コンテキスト・履歴サイズを制限 ----------------
-    # ドキュメント全文が非常に長い場合は末尾だけを使用
-    if context and len(context) > MAX_CONTEXT_CHARS:
-        context = context[-MAX_CONTEXT_CHARS:]
-
-    # チャット履歴は直近 N 件のみに絞る
-    if chat_history and len(chat_history) > MAX_CHAT_HISTORY_MSG:
-        chat_history = chat_history[-MAX_CHAT_HISTORY_MSG:]
+    # 同じ設定のモデルはゲートウェイ側で使い回す
+    model = llm_gateway.gemini_model(model_name, cache_key=(bool(enable_search), max_output_tokens), **model_kwargs)
+    return model, tool_config
 
+def _build_gemini_history(context, chat_history, user_message, chat_context,
+                          image_data_base64=None, image_mime_type=None):
+    """
+    Gemini に渡す contents（システム指示＋履歴＋最新入力）を組み立てる。
+    先頭2件 (指示＋ドキュメントとその了解応答) はリクエスト間で変化しない安定部分で、
+    追加コンテキストは最新のユーザー入力側に置く (プロンプトキャッシュを効かせるため)。
+    """
     # ---------------- チャット履歴の作成 (★ 過去の画像は考慮しない) ----------------
     gemini_history = []
     system_instruction_content = f"""あなたは親切で知識豊富なアシスタントです。
@@ -313,12 +504,6 @@ Web検索ツールが利用可能な場合は、最新情報や外部情報が
 --- ドキュメント ---
 {context}
 --- ドキュメントここまで ---
-"""
-    if chat_context:
-         system_instruction_content += f"""
---- ユーザー指定の重要コンテキスト ---
-{chat_context}
---- コンテキストここまで ---
 """
     gemini_history.append({"role": "user", "parts": [system_instruction_content]})
     gemini_history.append({"role": "model", "parts": ["承知しました。"]})
@@ -336,8 +521,13 @@ Web検索ツールが利用可能な場合は、最新情報や外部情報が
         if msg_parts:
             gemini_history.append({"role": role, "parts": msg_parts})
     
-    # 最新のユーザー入力（テキスト＋今回の添付画像）を履歴に追加
+    # 最新のユーザー入力（追加コンテキスト＋テキスト＋今回の添付画像）を履歴に追加
     latest_user_parts = []
+    if chat_context:
+        latest_user_parts.append(f"""--- ユーザー指定の重要コンテキスト ---
+{chat_context}
+--- コンテキストここまで ---
+""")
     if user_message:
         latest_user_parts.append(user_message)
     if image_data_base64 and image_mime_type:
@@ -352,114 +542,198 @@ Web検索ツールが利用可能な場合は、最新情報や外部情報が
     if latest_user_parts:
         gemini_history.append({"role": "user", "parts": latest_user_parts})
 
+    return gemini_history
+
+def _gemini_text_history(gemini_history):
+    """Function Call 後の再呼び出し用のベース履歴 (テキストのみで再構築、画像は除外)"""
+    return [
+        item for item in gemini_history
+        # 簡単な実装: role='function' 以外で、parts が文字列のみのものを抽出
+        if item['role'] != 'function' and all(isinstance(p, str) for p in item['parts'])
+    ]
+
+def _gemini_function_calls(parts):
+    """応答パーツから Function Call をすべて取り出す (1 ターンに複数ありうる)"""
+    return [part.function_call for part in parts
+            if 'function_call' in part and part.function_call.name]
+
+def _execute_gemini_function_calls(function_calls, sources):
+    """
+    1 ターン分の Function Call をまとめて実行し、同じ順序の function_response パーツを返す。
+    web_search は並列に検索する。情報源は sources に追記する。
+    """
+    queries = [fc.args.get("search_query") for fc in function_calls if fc.name == "web_search"]
+    search_results = iter(execute_web_searches([q for q in queries if q]))
+
+    response_parts = []
+    for fc in function_calls:
+        if fc.name != "web_search":
+            result_text = f"ツール {fc.name} は利用できません。"
+        elif not fc.args.get("search_query"):
+            result_text = "検索クエリが指定されていません。"
+        else:
+            search_result_data = next(search_results)
+            result_text = search_result_data["result_text"]
+            for source in search_result_data["sources"]:
+                if source not in sources:
+                    sources.append(source)
+        response_parts.append({
+            "function_response": {"name": fc.name, "response": {"result": result_text}}
+        })
+    return response_parts
+
+def _gemini_followup_tool_config(iteration, deadline):
+    """ツール実行後の再呼び出し用 tool_config。上限に達したらツールを使わせない"""
+    if iteration >= GEMINI_TOOL_MAX_ITERATIONS or time.monotonic() >= deadline:
+        print(f"--- ツール実行の上限に到達 (iteration={iteration}) : 最終応答を要求 ---")
+        return {"function_calling_config": {"mode": "NONE"}}
+    return {"function_calling_config": {"mode": "AUTO"}}
+
+def _gemini_with_prefix_cache(model_name, model, gemini_history, enable_search,
+                              max_output_tokens=MAX_OUTPUT_TOKENS):
+    """
+    安定部分 (先頭2件) が十分に長ければ CachedContent に載せ、(キャッシュ参照モデル, 残りの contents) を返す。
+    使えない場合 (検索ツール有効時・短い・作成失敗) は (model, gemini_history) をそのまま返す。
+    """
+    if enable_search or len(gemini_history) < 3:
+        return model, gemini_history
+    prefix = gemini_history[:2]
+    if estimate_tokens(prefix[0]['parts'][0], model_name) < GEMINI_CACHE_MIN_TOKENS:
+        return model, gemini_history
+    from google.generativeai.types import GenerationConfig
+    cached_model = llm_gateway.gemini_cached_model(
+        model_name, prefix,
+        generation_config=GenerationConfig(max_output_tokens=max_output_tokens, candidate_count=1),
+    )
+    if cached_model is None:
+        return model, gemini_history
+    return cached_model, gemini_history[2:]
+
+def _record_gemini_usage(model_name, response):
+    """Gemini の usage_metadata からキャッシュヒット分を含むトークン数を記録"""
+    usage = getattr(response, 'usage_metadata', None)
+    if not usage:
+        return
+    llm_gateway.record_usage(
+        'google', model_name,
+        input_tokens=getattr(usage, 'prompt_token_count', 0),
+        output_tokens=getattr(usage, 'candidates_token_count', 0),
+        cache_read_tokens=getattr(usage, 'cached_content_token_count', 0),
+    )
+
+def _record_claude_usage(model_name, usage):
+    """Claude の usage からキャッシュ読み込み/作成トークン数を記録"""
+    if not usage:
+        return
+    llm_gateway.record_usage(
+        'anthropic', model_name,
+        input_tokens=getattr(usage, 'input_tokens', 0),
+        output_tokens=getattr(usage, 'output_tokens', 0),
+        cache_read_tokens=getattr(usage, 'cache_read_input_tokens', 0) or 0,
+        cache_write_tokens=getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+    )
+
+def get_gemini_response(model_name, context, chat_history, user_message, chat_context, enable_search,
+                        image_data_base64=None, image_mime_type=None, max_output_tokens=MAX_OUTPUT_TOKENS):
+    """Google Geminiモデルを使用して応答を生成 (Function Calling & 今回の画像入力対応)"""
+
+    if not GOOGLE_API_KEY:
+        raise ValueError("Google API Keyが設定されていません。")
+
+    # ★ 画像入力がある場合、マルチモーダル対応モデルか確認/促す
+    #    例: gemini-1.5-flash-latest などを使う
+    if image_data_base64:
+        # マルチモーダル非対応モデルが選択されていた場合の警告/変更（必要に応じて）
+        if not ('flash' in model_name or 'pro' in model_name): # 簡単なチェック
+             print(f"警告: 画像入力は Gemini Flash/Pro モデルでのみサポートされます。現在のモデル: {model_name}")
+             # ここでエラーを返すか、モデル名を強制変更するかの選択肢あり
+             # return {"message": f"エラー: 画像入力は Gemini Flash/Pro モデルを選択してください。", "sources": []}
+             # model_name = 'gemini-1.5-flash-latest' # 強制変更例
+
+        # マルチモーダル対応モデルでも古いバージョンの可能性もあるため注意喚起
+        if not ('1.5' in model_name or 'latest' in model_name):
+             print(f"情報: より新しいモデル(gemini-1.5-flash-latestなど)の方が画像認識性能が高い可能性があります。現在のモデル: {model_name}")
+
+    model, tool_config = _build_gemini_model(model_name, enable_search, max_output_tokens)
+    gemini_history = _build_gemini_history(
+        context, chat_history, user_message, chat_context, image_data_base64, image_mime_type
+    )
+
+    # 安定部分が長ければコンテキストキャッシュを参照するモデルに切り替える
+    call_model, contents = _gemini_with_prefix_cache(
+        model_name, model, gemini_history, enable_search, max_output_tokens
+    )
+
     # --- Gemini API呼び出し --- 
     print(f"--- Geminiへ送信 (検索有効: {enable_search}, Tool Mode: {tool_config['function_calling_config']['mode'] if tool_config else 'AUTO'}) ---")
 
     final_response_text = ""
     sources = []
+    deadline = time.monotonic() + GEMINI_TOOL_TIME_BUDGET
+    history = None  # Function Call 後の再呼び出し用履歴
 
     try:
-        # ★ Function Call後の再呼び出し時の履歴からは画像が除外される
-        response = model.generate_content(
-            gemini_history, 
-            stream=False,
-            tool_config=tool_config 
-        )
-        print("--- Geminiからの最初の応答受信 ---")
-
-        # response.candidates が存在するか、空でないか確認
-        if not response.candidates:
-            print("--- 応答候補が存在しません --- ")
-            # finish_reason など詳細があれば取得
-            finish_reason = getattr(response, 'prompt_feedback', {}).get('block_reason', '不明')
-            final_response_text = f"応答がブロックされたか、空でした。理由: {finish_reason}"
-            return {"message": final_response_text, "sources": sources}
-            
-        candidate = response.candidates[0]
-
-        # 安全性などで応答がない場合も考慮
-        if not candidate.content or not candidate.content.parts:
-             print("--- 応答候補にコンテンツまたはパーツがありません --- ")
-             finish_reason = getattr(candidate, 'finish_reason', '不明')
-             safety_ratings = getattr(candidate, 'safety_ratings', [])
-             final_response_text = f"応答がブロックされたか、空でした。理由: {finish_reason}, Safety: {safety_ratings}"
-             return {"message": final_response_text, "sources": sources}
-
-        part = candidate.content.parts[0]
-
-        # Function Call 処理
-        if hasattr(part, 'function_call') and part.function_call.name == "web_search":
-            print(f"--- Function Call検出: {part.function_call.name} ---")
-            function_call = part.function_call
-            args = function_call.args
-            search_query = args.get("search_query")
-
-            if search_query:
-                search_result_data = execute_web_search(search_query)
-                search_results_text_for_ai = search_result_data["result_text"]
-                sources = search_result_data["sources"] # ★ sources に代入
-
-                function_response_part = {
-                    "function_response": {
-                        "name": "web_search",
-                        "response": {"result": search_results_text_for_ai}
-                    }
-                }
-                # ★ Function Call後の再呼び出し履歴 (テキストのみで再構築)
-                history_for_final_call = []
-                for item in gemini_history:
-                     # 簡単な実装: role='function' 以外で、parts が文字列のみのものを抽出
-                     if item['role'] != 'function' and all(isinstance(p, str) for p in item['parts']):
-                         history_for_final_call.append(item)
-                history_for_final_call.append(candidate.content) # AIのFunctionCall要求
-                history_for_final_call.append({"role": "function", "parts": [function_response_part]}) # Function Response
-                
-                response = model.generate_content(history_for_final_call, stream=False)
-                print("--- Geminiからの最終応答受信 ---")
-
-                # 最終応答の候補とパーツを再取得、存在チェック
-                if not response.candidates:
-                    print("--- 最終応答に候補が存在しません --- ")
-                    finish_reason = getattr(response, 'prompt_feedback', {}).get('block_reason', '不明')
-                    final_response_text = f"検索後の応答がブロックされたか、空でした。理由: {finish_reason}"
-                    # sources は保持されているので返す
-                    return {"message": final_response_text, "sources": sources}
-                    
-                final_candidate = response.candidates[0]
-                if not final_candidate.content or not final_candidate.content.parts:
-                    print("--- 最終応答にコンテンツまたはパーツがありません --- ")
-                    finish_reason = getattr(final_candidate, 'finish_reason', '不明')
-                    safety_ratings = getattr(final_candidate, 'safety_ratings', [])
-                    final_response_text = f"検索後の応答がブロックされたか、空でした。理由: {finish_reason}, Safety: {safety_ratings}"
-                    # sources は保持されているので返す
-                    return {"message": final_response_text, "sources": sources}
-                
-                final_part = final_candidate.content.parts[0]
-                if hasattr(final_part, 'text'):
-                    final_response_text = final_part.text
+        for iteration in range(GEMINI_TOOL_MAX_ITERATIONS + 1):
+            # ★ Function Call後の再呼び出し時の履歴からは画像が除外される
+            with llm_gateway.slot('google'):
+                if history is None:
+                    response = call_model.generate_content(contents, stream=False, tool_config=tool_config)
                 else:
+                    response = model.generate_content(history, stream=False, tool_config=tool_config)
+            _record_gemini_usage(model_name, response)
+            print(f"--- Geminiからの応答受信 (iteration={iteration}) ---")
+            after_search = "検索後の" if history is not None else ""
+
+            # response.candidates が存在するか、空でないか確認
+            if not response.candidates:
+                print("--- 応答候補が存在しません --- ")
+                # finish_reason など詳細があれば取得
+                finish_reason = getattr(response, 'prompt_feedback', {}).get('block_reason', '不明')
+                final_response_text = f"{after_search}応答がブロックされたか、空でした。理由: {finish_reason}"
+                # sources は保持されているので返す
+                return {"message": final_response_text, "sources": sources}
+
+            candidate = response.candidates[0]
+
+            # 安全性などで応答がない場合も考慮
+            if not candidate.content or not candidate.content.parts:
+                print("--- 応答候補にコンテンツまたはパーツがありません --- ")
+                finish_reason = getattr(candidate, 'finish_reason', '不明')
+                safety_ratings = getattr(candidate, 'safety_ratings', [])
+                final_response_text = f"{after_search}応答がブロックされたか、空でした。理由: {finish_reason}, Safety: {safety_ratings}"
+                return {"message": final_response_text, "sources": sources}
+
+            # Function Call 処理 (同じターンの呼び出しはまとめて並列実行)
+            function_calls = _gemini_function_calls(candidate.content.parts)
+            if function_calls and iteration < GEMINI_TOOL_MAX_ITERATIONS:
+                print(f"--- Function Call検出: {[fc.name for fc in function_calls]} ---")
+                function_response_parts = _execute_gemini_function_calls(function_calls, sources)
+                if history is None:
+                    history = _gemini_text_history(gemini_history)
+                history.append(candidate.content) # AIのFunctionCall要求
+                history.append({"role": "function", "parts": function_response_parts}) # Function Response
+                tool_config = _gemini_followup_tool_config(iteration + 1, deadline)
+                continue
+
+            # Function Call がなかった場合 (最終応答)
+            final_response_text = "".join(
+                part.text for part in candidate.content.parts if getattr(part, 'text', None)
+            )
+            if not final_response_text:
+                print("--- 応答にテキストが含まれていません ---")
+                if history is not None:
                     final_response_text = "検索結果を踏まえた応答を生成できませんでした。"
-            else:
-                print("--- Function Callに検索クエリが含まれていません ---")
-                if hasattr(part, 'text'): final_response_text = part.text
-                else: final_response_text = "検索クエリがAIから指定されませんでした。"
-        
-        # Function Call がなかった場合
-        else:
-            print("--- Function Callなし ---")
-            if hasattr(part, 'text'):
-                final_response_text = part.text
-            else:
-                 print("--- 通常応答にテキストが含まれていません ---")
-                 finish_reason = getattr(candidate, 'finish_reason', '不明')
-                 safety_ratings = getattr(candidate, 'safety_ratings', [])
-                 final_response_text = f"応答がブロックされたか、空でした。理由: {finish_reason}, Safety: {safety_ratings}"
+                else:
+                    finish_reason = getattr(candidate, 'finish_reason', '不明')
+                    safety_ratings = getattr(candidate, 'safety_ratings', [])
+                    final_response_text = f"応答がブロックされたか、空でした。理由: {finish_reason}, Safety: {safety_ratings}"
+            break
 
     except Exception as e:
          print(f"--- 応答処理中に例外 ({type(e).__name__}): {e} ---")
          try:
              if 'response' in locals() and response and response.candidates and response.candidates[0].content.parts[0].text:
-                 print("--- 例外発生、最初の応答テキストを返します ---")
+                 print("--- 例外発生、直前の応答テキストを返します ---")
                  final_response_text = response.candidates[0].content.parts[0].text
              else:
                  final_response_text = f"AIからの応答処理中にエラーが発生しました: {type(e).__name__}"
@@ -470,41 +744,72 @@ Web検索ツールが利用可能な場合は、最新情報や外部情報が
     # ★ 最終的なテキスト応答と情報源リストを辞書で返す
     return {"message": final_response_text, "sources": sources}
 
-def get_claude_response(model_name, context, chat_history, user_message, thinking_enabled, chat_context):
+def _build_claude_request(context, chat_history, user_message, chat_context):
     """
-    Anthropic Claude 3 / 3.5 / 3.7 系 (Messages API) で応答を生成します。
-    Claude‑2 はサポート対象外とし、Completions API は使用しません。
+    Claude Messages API 用の (system, messages) を組み立てる。
+    system (指示＋ドキュメント) と過去履歴の末尾に cache_control を付けてプロンプトキャッシュの
+    区切りとし、毎回変わる追加コンテキストと最新メッセージはその後ろに置く。
     """
-    if not ANTHROPIC_API_KEY or not anthropic_client:
-        raise ValueError("Anthropic API Keyまたはクライアントが設定されていません。")
+    cache_control = {"type": "ephemeral"}
 
     # --- Claude Messages 配列の構築 ---
     messages = []
 
-    # 既存履歴を追加
+    # 既存履歴を追加 (空のテキストは API で拒否されるため除外)
     for msg in chat_history:
+        if not msg['content']:
+            continue
         role = "assistant" if msg['role'] == "assistant" else "user"
         messages.append({"role": role, "content": msg['content']})
+    if messages:
+        last = messages[-1]
+        last["content"] = [{"type": "text", "text": last["content"], "cache_control": cache_control}]
 
-    # 最新のユーザーメッセージ
-    messages.append({"role": "user", "content": user_message})
+    # 最新のユーザーメッセージ (追加コンテキストはここに含める)
+    latest = user_message
+    if chat_context:
+        latest = f"[追加コンテキスト]\n{chat_context}\n\n{user_message}"
+    messages.append({"role": "user", "content": latest})
 
     # Claude Messages API では system プロンプトはトップレベル `system` 引数で渡す
     system_prompt = (
         "You are a helpful, knowledgeable assistant. "
         "Use the provided document, conversation history and any additional context to answer the user."
     )
-    if chat_context:
-        system_prompt += f"\n\n[追加コンテキスト]\n{chat_context}"
+    if context:
+        system_prompt += f"\n\n--- ドキュメント ---\n{context}\n--- ドキュメントここまで ---"
+    system = [{"type": "text", "text": system_prompt, "cache_control": cache_control}]
+
+    return system, messages
+
+def get_claude_response(model_name, context, chat_history, user_message, thinking_enabled, chat_context,
+                        max_tokens=CLAUDE_MAX_TOKENS, thinking_budget=None, timeout=LLM_TIMEOUT):
+    """
+    Anthropic Claude 3 / 3.5 / 3.7 系 (Messages API) で応答を生成します。
+    Claude‑2 はサポート対象外とし、Completions API は使用しません。
+    thinking_budget を指定すると extended thinking を有効にする (ジョブモードのみ)。
+    """
+    if not ANTHROPIC_API_KEY:
+        raise ValueError("Anthropic API Keyまたはクライアントが設定されていません。")
+
+    system_prompt, messages = _build_claude_request(context, chat_history, user_message, chat_context)
+
+    request_options = {}
+    if thinking_budget:
+        request_options['thinking'] = {"type": "enabled", "budget_tokens": thinking_budget}
 
     # --- Claude Messages API 呼び出し ---
     try:
-        result = anthropic_client.messages.create(
-            model=model_name,        # 例: claude-3-7-sonnet-20250219
-            max_tokens=1024,
-            system=system_prompt,
-            messages=messages
-        )
+        with llm_gateway.slot('anthropic'):
+            result = llm_gateway.anthropic().messages.create(
+                model=model_name,        # 例: claude-3-7-sonnet-20250219
+                max_tokens=max_tokens,
+                system=system_prompt,
+                messages=messages,
+                timeout=timeout,
+                **request_options
+            )
+        _record_claude_usage(model_name, result.usage)
 
         # result.content は list[ContentBlock]. Text を取り出して連結
         output_chunks = []
@@ -519,8 +824,8 @@ def get_claude_response(model_name, context, chat_history, user_message, thinkin
         print(f"Claude Messages API エラー: {e}", file=sys.stderr)
         raise RuntimeError(f"Claude API呼び出し中にエラーが発生しました: {type(e).__name__}")
 
-def get_openai_response(model_name, context, chat_history, user_message, chat_context):
-    """OpenAI GPTモデルを使用して応答を生成"""
+def _build_openai_messages(context, chat_history, user_message, chat_context):
+    """Chat Completions API 用の messages 配列を組み立てる"""
     messages = []
     
     # システムプロンプトの組み立て
@@ -549,8 +854,8 @@ def get_openai_response(model_name, context, chat_history, user_message, chat_co
         "content": system_prompt
     })
     
-    # すべての会話履歴を追加
-    for msg in chat_history:  # すべてのメッセージを使用（制限なし）
+    # 会話履歴を追加 (build_context でトークン予算内に調整済み)
+    for msg in chat_history:
         messages.append({
             "role": msg['role'],
             "content": msg['content']
@@ -561,26 +866,34 @@ def get_openai_response(model_name, context, chat_history, user_message, chat_co
         "role": "user",
         "content": user_message
     })
+    return messages
+
+def get_openai_response(model_name, context, chat_history, user_message, chat_context, timeout=LLM_TIMEOUT):
+    """OpenAI GPTモデルを使用して応答を生成"""
+    messages = _build_openai_messages(context, chat_history, user_message, chat_context)
     
-    # --- OpenAI 新SDK (>=1.14) での呼び出し ---
-    from openai import OpenAI   # 関数内 import（循環回避）
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    response = client.chat.completions.create(
-        model=model_name,         # 例: gpt-4o, gpt-4o-mini, gpt-4.5-turbo 等
-        messages=messages
-    )
+    # --- OpenAI 新SDK (>=1.14) での呼び出し (共有クライアント) ---
+    with llm_gateway.slot('openai'):
+        response = llm_gateway.openai().chat.completions.create(
+            model=model_name,         # 例: gpt-4o, gpt-4o-mini, gpt-4.5-turbo 等
+            messages=messages,
+            timeout=timeout
+        )
+    usage = getattr(response, 'usage', None)
+    if usage:
+        # OpenAI は先頭一致のプロンプトを自動でキャッシュする (cached_tokens がヒット分)
+        details = getattr(usage, 'prompt_tokens_details', None)
+        llm_gateway.record_usage(
+            'openai', model_name,
+            input_tokens=usage.prompt_tokens,
+            output_tokens=usage.completion_tokens,
+            cache_read_tokens=getattr(details, 'cached_tokens', 0) or 0,
+        )
     return response.choices[0].message.content
 
 
-def get_openai_o3_response(model_name, context, chat_history, user_message, chat_context):
-    """OpenAI o3 系モデル (Responses API) で応答を生成し、成功/失敗を dict で返す"""
-
-    from openai import APIStatusError, APIConnectionError
-
-    if not os.getenv("OPENAI_API_KEY"):
-        raise RuntimeError("環境変数 OPENAI_API_KEY が設定されていません。")
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
+def _build_o3_request(context, chat_history, user_message, chat_context):
+    """Responses API 用の (instructions, input_text) を組み立てる"""
     # --- 会話履歴を1本の文字列にまとめる ---
     history_text = ""
     for m in chat_history:
@@ -599,14 +912,27 @@ def get_openai_o3_response(model_name, context, chat_history, user_message, chat
 
     # --- input ---
     input_text = history_text + f"ユーザー: {user_message}"
+    return system_prompt, input_text
+
+def get_openai_o3_response(model_name, context, chat_history, user_message, chat_context, timeout=LLM_TIMEOUT):
+    """OpenAI o3 系モデル (Responses API) で応答を生成し、成功/失敗を dict で返す"""
+
+    from openai import APIStatusError, APIConnectionError
+
+    if not os.getenv("OPENAI_API_KEY"):
+        raise RuntimeError("環境変数 OPENAI_API_KEY が設定されていません。")
+
+    system_prompt, input_text = _build_o3_request(context, chat_history, user_message, chat_context)
 
     try:
         # o3 の Responses API 呼び出し
-        rsp = client.responses.create(
-            model=model_name,
-            instructions=system_prompt,
-            input=input_text
-        )
+        with llm_gateway.slot('openai'):
+            rsp = llm_gateway.openai().responses.create(
+                model=model_name,
+                instructions=system_prompt,
+                input=input_text,
+                timeout=timeout
+            )
         return {"success": True, "message": rsp.output_text}
     except (APIStatusError, APIConnectionError) as e:
         # OpenAI 側エラーを呼び出し元に伝える
@@ -614,4 +940,253 @@ def get_openai_o3_response(model_name, context, chat_history, user_message, chat
             "success": False,
             "status": getattr(e, "status_code", 500),
             "message": f"OpenAI APIエラー: {getattr(e, 'message', str(e))}",
-        }
\ No newline at end of file
+        }
+
+# ==================== ストリーミング応答 (SocketIO) ====================
+# 各 stream_* 関数は get_* と同じプロンプトを組み立て、プロバイダが返す
+# テキスト断片を順に yield するジェネレータ。Web検索の情報源は引数 sources
+# (list) に追記される。
+
+def stream_gemini_response(model_name, context, chat_history, user_message, chat_context, enable_search,
+                           image_data_base64=None, image_mime_type=None, sources=None):
+    """get_gemini_response のストリーミング版"""
+    from google.generativeai import protos
+
+    if not GOOGLE_API_KEY:
+        raise ValueError("Google API Keyが設定されていません。")
+
+    model, tool_config = _build_gemini_model(model_name, enable_search)
+    gemini_history = _build_gemini_history(
+        context, chat_history, user_message, chat_context, image_data_base64, image_mime_type
+    )
+
+    call_model, contents = _gemini_with_prefix_cache(model_name, model, gemini_history, enable_search)
+
+    if sources is None:
+        sources = []
+    deadline = time.monotonic() + GEMINI_TOOL_TIME_BUDGET
+    history = None  # Function Call 後の再呼び出し用履歴
+
+    for iteration in range(GEMINI_TOOL_MAX_ITERATIONS + 1):
+        function_calls = []
+        chunk = None
+        # ストリームを読み切るまで同時実行枠を保持する
+        with llm_gateway.slot('google'):
+            if history is None:
+                response = call_model.generate_content(contents, stream=True, tool_config=tool_config)
+            else:
+                response = model.generate_content(history, stream=True, tool_config=tool_config)
+            for chunk in response:
+                if not chunk.candidates or not chunk.candidates[0].content:
+                    continue
+                parts = chunk.candidates[0].content.parts
+                function_calls.extend(_gemini_function_calls(parts))
+                for part in parts:
+                    if getattr(part, 'text', None):
+                        yield part.text
+        # usage_metadata は最後のチャンクに含まれる
+        _record_gemini_usage(model_name, chunk)
+
+        if not function_calls or iteration >= GEMINI_TOOL_MAX_ITERATIONS:
+            return
+
+        # Function Call 処理: 同じターンの呼び出しを並列実行し、結果を渡して再呼び出し
+        print(f"--- Function Call検出 (stream): {[fc.name for fc in function_calls]} ---")
+        function_response_parts = _execute_gemini_function_calls(function_calls, sources)
+        if history is None:
+            history = _gemini_text_history(gemini_history)
+        history.append({"role": "model", "parts": [protos.Part(function_call=fc) for fc in function_calls]})
+        history.append({"role": "function", "parts": function_response_parts})
+        tool_config = _gemini_followup_tool_config(iteration + 1, deadline)
+
+def stream_claude_response(model_name, context, chat_history, user_message, thinking_enabled, chat_context):
+    """get_claude_response のストリーミング版"""
+    if not ANTHROPIC_API_KEY:
+        raise ValueError("Anthropic API Keyまたはクライアントが設定されていません。")
+
+    system_prompt, messages = _build_claude_request(context, chat_history, user_message, chat_context)
+    with llm_gateway.slot('anthropic'), llm_gateway.anthropic().messages.stream(
+        model=model_name,
+        max_tokens=CLAUDE_MAX_TOKENS,
+        system=system_prompt,
+        messages=messages
+    ) as stream:
+        for text in stream.text_stream:
+            yield text
+        _record_claude_usage(model_name, stream.get_final_message().usage)
+
+def stream_openai_response(model_name, context, chat_history, user_message, chat_context):
+    """get_openai_response のストリーミング版"""
+    messages = _build_openai_messages(context, chat_history, user_message, chat_context)
+    with llm_gateway.slot('openai'):
+        response = llm_gateway.openai().chat.completions.create(
+            model=model_name,
+            messages=messages,
+            stream=True
+        )
+        for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+def stream_openai_o3_response(model_name, context, chat_history, user_message, chat_context):
+    """get_openai_o3_response のストリーミング版 (エラーは例外として送出)"""
+    if not os.getenv("OPENAI_API_KEY"):
+        raise RuntimeError("環境変数 OPENAI_API_KEY が設定されていません。")
+
+    system_prompt, input_text = _build_o3_request(context, chat_history, user_message, chat_context)
+    with llm_gateway.slot('openai'):
+        stream = llm_gateway.openai().responses.create(
+            model=model_name,
+            instructions=system_prompt,
+            input=input_text,
+            stream=True
+        )
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+
+def stream_ai_response(model_name, context, chat_history, user_message, thinking_enabled, chat_context,
+                       enable_search=False, image_data_base64=None, image_mime_type=None, sources=None):
+    """モデル名に応じて stream_* を選び、テキスト断片を yield する"""
+    if model_name.startswith('gemini'):
+        return stream_gemini_response(
+            model_name, context, chat_history, user_message, chat_context, enable_search,
+            image_data_base64, image_mime_type, sources
+        )
+    if model_name.startswith('claude'):
+        if not ANTHROPIC_API_KEY:
+            raise ValueError("Anthropic API Keyが設定されていません。")
+        return stream_claude_response(model_name, context, chat_history, user_message, thinking_enabled, chat_context)
+    if model_name.startswith('o3'):
+        return stream_openai_o3_response(model_name, context, chat_history, user_message, chat_context)
+    if model_name.startswith('gpt'):
+        if not OPENAI_API_KEY:
+            raise ValueError("OpenAI API Keyが設定されていません。")
+        return stream_openai_response(model_name, context, chat_history, user_message, chat_context)
+    raise ValueError("サポートされていないモデルです。")
+
+def _strip_ny_prefix(text):
+    """応答の先頭が "ny" であれば削除する (/send とストリーミングで共通の補正)"""
+    if text.startswith("ny"):
+        print(f"--- AI応答の先頭から 'ny' を削除しました: {text[:10]}... ---") # デバッグ用ログ
+        return text[2:]
+    return text
+
+def register_socketio_events(socketio):
+    """
+    チャットのストリーミング用 SocketIO イベントを登録する。
+
+    クライアントは 'chat_send' に /api/chat/send と同じペイロード
+    (+ doc_id, access_token, request_id) を送る。サーバーは
+      • 'chat_token' {request_id, delta}    : 生成されたテキスト断片
+      • 'chat_done'  {request_id, message, sources, model, thinking_enabled}
+      • 'chat_error' {request_id, message, status}
+    を順に emit する。ユーザーメッセージは生成前に、アシスタントメッセージは完了後に保存する。
+
+    ジョブモードの /send で受け取った job_id を 'chat_job_subscribe' {job_id, access_token} で
+    購読すると、完了時に 'chat_job_done' (GET /api/chat/job/<job_id> と同じ内容) を受け取れる。
+    """
+    from flask_socketio import emit, join_room
+    from app.controllers.auth_controller import verify_token
+
+    def job_room(job_id):
+        return f"chat_job:{job_id}"
+
+    def notify_job_done(job):
+        if job and job['kind'] == 'chat':
+            socketio.emit('chat_job_done', _job_response(job), to=job_room(job['id']))
+
+    job_queue.add_listener(notify_job_done)
+
+    @socketio.on('chat_job_subscribe')
+    def handle_chat_job_subscribe(data):
+        data = data or {}
+        job_id = data.get('job_id')
+        # 認証に失敗した場合は何も送らない (クライアントはポーリングで結果を受け取る)
+        if not job_id or not data.get('access_token') or verify_token(data['access_token']) is None:
+            return
+        if _get_own_job(job_id) is None:
+            return
+        # 購読してから状態を確認し直し、その間に完了したジョブの通知を取りこぼさないようにする
+        join_room(job_room(job_id))
+        job = _get_own_job(job_id)
+        if job is not None and job['status'] in ('done', 'error'):
+            emit('chat_job_done', _job_response(job))
+
+    @socketio.on('chat_send')
+    def handle_chat_send(data):
+        data = data or {}
+        request_id = data.get('request_id')
+
+        def emit_error(message, status):
+            emit('chat_error', {'request_id': request_id, 'success': False, 'message': message, 'status': status})
+
+        if not data.get('access_token') or verify_token(data['access_token']) is None:
+            return emit_error('Token invalid', 401)
+
+        # HTTP の <int:doc_id> と同じく整数 (数字の文字列も可) だけを受け付ける
+        doc_id = data.get('doc_id')
+        if isinstance(doc_id, str) and doc_id.isdigit():
+            doc_id = int(doc_id)
+        if not isinstance(doc_id, int) or isinstance(doc_id, bool) or doc_id <= 0:
+            return emit_error('doc_id must be a positive integer', 400)
+        user_message = data.get('message', '')
+        model_name = data.get('model', 'gemini-2.0-flash')
+        thinking_enabled = data.get('thinking_enabled', False)
+        chat_context = data.get('chat_context')
+        enable_search = data.get('enable_search', False)
+        image_data_base64 = data.get('image_data')
+        image_mime_type = data.get('image_mime_type')
+        if image_data_base64 and ',' in image_data_base64:
+            image_data_base64 = image_data_base64.split(',', 1)[1]
+
+        turn = _begin_chat_turn(doc_id, user_message, model_name, thinking_enabled)
+        if turn is None:
+            return emit_error('Document not found', 404)
+        context, chat_history, chat_context = _assemble_context(
+            doc_id, model_name, document_markdown(turn['document']), turn['messages'], user_message, chat_context,
+            turn['summary']
+        )
+
+        sources = []
+        chunks = []
+        head = ''            # 先頭の "ny" 補正のため、最初の2文字が揃うまで送信を保留する
+        head_checked = False
+        try:
+            for delta in stream_ai_response(
+                model_name, context, chat_history, user_message, thinking_enabled, chat_context,
+                enable_search, image_data_base64, image_mime_type, sources
+            ):
+                if not head_checked:
+                    head += delta or ''
+                    if len(head) < 2:
+                        continue
+                    delta = _strip_ny_prefix(head)
+                    head_checked = True
+                if not delta:
+                    continue
+                chunks.append(delta)
+                emit('chat_token', {'request_id': request_id, 'delta': delta})
+                socketio.sleep(0)  # gevent/eventlet 環境で送信を詰まらせない
+        except Exception as e:
+            print(f"AI応答エラー (stream): {str(e)}", file=sys.stderr)
+            return emit_error(f"AI応答取得エラー: {str(e)}", 500)
+
+        if not head_checked and head:
+            chunks.append(head)
+            emit('chat_token', {'request_id': request_id, 'delta': head})
+        ai_message = ''.join(chunks)
+
+        # 生成完了後にアシスタントメッセージを保存 (ユーザーメッセージは保存済み)
+        _save_chat_turn(doc_id, [
+            chat_message_row(doc_id, 'assistant', ai_message, model_name, thinking_enabled, g.current_user),
+        ], compact=True)
+
+        emit('chat_done', {
+            'request_id': request_id,
+            'success': True,
+            'message': ai_message,
+            'sources': sources,
+            'model': model_name,
+            'thinking_enabled': thinking_enabled
+        })
@@ -1,30 +1,99 @@
 from flask import Blueprint, request, jsonify, g
-# Supabase 用ヘルパー関数をインポート
-from app.models.database import (
+# ストレージ (STORAGE_BACKEND) のヘルパー関数をインポート
+from app.models.storage import (
     get_documents as supa_get_documents,
+    get_latest_document_id as supa_get_latest_document_id,
     get_document as supa_get_document,
     create_document as supa_create_document,
     update_document as supa_update_document,
+    apply_document_delta as supa_apply_document_delta,
+    DocumentVersionConflict,
     delete_document as supa_delete_document,
+    search_documents as supa_search_documents,
 )
 from app.controllers.auth_controller import require_auth
+from app.utils.retrieval import refresh_document_index, forget_document_index
+from app.utils.delta import DeltaError
 
 document_bp = Blueprint('document', __name__, url_prefix='/api/document')
 
+# /list のページサイズ上限
+MAX_LIST_PAGE_SIZE = 200
+# /recent で返す件数
+RECENT_DOCUMENTS_LIMIT = 10
+# /search のページサイズ (既定と上限)
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+SEARCH_SCOPES = ('all', 'documents', 'chats')
+
 @document_bp.route('/list', methods=['GET'])
 @require_auth
 def list_documents():
-    """全てのドキュメントをJSON形式で返す (Supabase)"""
-    documents = supa_get_documents() or []
-    return jsonify(documents)
+    """
+    ドキュメント一覧 (id, title, updated_at) をJSON形式で返す (Supabase)。
+    ?preview=1 で本文先頭のプレビューを含める。
+    ?limit=N を指定するとページ単位で返す:
+      {"documents": [...], "has_more": bool, "next_cursor": {"updated_at", "id"} | null}
+    続きは ?before_updated_at=<next_cursor.updated_at>&before_id=<next_cursor.id> で取得する。
+    limit を指定しない場合は従来通り全件を配列で返す。
+    """
+    with_preview = request.args.get('preview') in ('1', 'true')
+    limit = request.args.get('limit', type=int)
+    if limit is None:
+        return jsonify(supa_get_documents(with_preview=with_preview) or [])
+
+    limit = max(1, min(limit, MAX_LIST_PAGE_SIZE))
+    before_updated_at = request.args.get('before_updated_at')
+    before_id = request.args.get('before_id', type=int)
+    # 1 件多く取得して続きがあるかを判定する
+    rows = supa_get_documents(
+        limit=limit + 1,
+        before_updated_at=before_updated_at,
+        before_id=before_id,
+        with_preview=with_preview,
+    ) or []
+    has_more = len(rows) > limit
+    documents = rows[:limit]
+    next_cursor = None
+    if has_more:
+        next_cursor = {"updated_at": documents[-1]['updated_at'], "id": documents[-1]['id']}
+    return jsonify({"documents": documents, "has_more": has_more, "next_cursor": next_cursor})
 
 @document_bp.route('/recent', methods=['GET'])
 @require_auth
 def get_recent_documents():
     """最近更新された10件のドキュメントをJSON形式で返す (Supabase)"""
-    recent_docs = (supa_get_documents() or [])[:10]
+    recent_docs = supa_get_documents(limit=RECENT_DOCUMENTS_LIMIT) or []
     return jsonify(recent_docs)
 
+@document_bp.route('/search', methods=['GET'])
+@require_auth
+def search_documents():
+    """
+    ドキュメントとチャット履歴の全文検索 (Supabase の RPC search_documents)。
+    ?q=検索語 (必須) &scope=all|documents|chats &limit=N &offset=N
+      {"results": [...], "has_more": bool, "next_offset": int | null}
+    results は順位順で、kind が 'document' ならドキュメント本文/タイトル、
+    'chat' ならチャットメッセージ (message_id, role) への一致。snippet は一致箇所の前後。
+    """
+    query = (request.args.get('q') or '').strip()
+    if not query:
+        return jsonify({"error": "検索語 (q) が指定されていません"}), 400
+    scope = request.args.get('scope', 'all')
+    if scope not in SEARCH_SCOPES:
+        return jsonify({"error": f"scope は {' / '.join(SEARCH_SCOPES)} のいずれかです"}), 400
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), MAX_SEARCH_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+
+    # 1 件多く取得して続きがあるかを判定する
+    rows = supa_search_documents(query, scope=scope, limit=limit + 1, offset=offset)
+    has_more = len(rows) > limit
+    return jsonify({
+        "results": rows[:limit],
+        "has_more": has_more,
+        "next_offset": offset + limit if has_more else None,
+    })
+
 @document_bp.route('/<int:doc_id>', methods=['GET'])
 @require_auth
 def get_document(doc_id):
@@ -48,39 +117,82 @@ def create_document():
     return jsonify(new_doc), 201
 
 @document_bp.route('/<int:doc_id>', methods=['PUT'])
+@require_auth
 def update_document(doc_id):
     """指定されたIDのドキュメントを更新 (Supabase)"""
     data = request.get_json()
     updated_doc = supa_update_document(doc_id, data)
     if not updated_doc:
-        return jsonify({"error": "Failed to update document"}), 500
+        return jsonify({"error": "Document not found"}), 404
+    if 'content' in data:
+        # チャット用の関連チャンク検索インデックスを差分更新
+        refresh_document_index(doc_id, updated_doc.get('content'))
     return jsonify(updated_doc)
 
+@document_bp.route('/<int:doc_id>', methods=['PATCH'])
+@require_auth
+def patch_document(doc_id):
+    """
+    Quill の変更 Delta を適用して保存 (Supabase)。
+    body: {"base_version": <int>, "ops": [...]} / 応答: {"id", "version", "updated_at"}
+    base_version が古い場合は 409 と現在の version を返す。
+    """
+    data = request.get_json(silent=True) or {}
+    base_version = data.get('base_version')
+    ops = data.get('ops')
+    if not isinstance(base_version, int) or not isinstance(ops, list):
+        return jsonify({"error": "base_version and ops are required"}), 400
+    try:
+        result = supa_apply_document_delta(doc_id, ops, base_version)
+    except DocumentVersionConflict as conflict:
+        return jsonify({
+            "error": "Document has been modified",
+            "version": conflict.current.get('version'),
+            "updated_at": conflict.current.get('updated_at'),
+        }), 409
+    except DeltaError as e:
+        return jsonify({"error": f"Invalid delta: {e}"}), 400
+    if result is None:
+        return jsonify({"error": "Document not found"}), 404
+    # チャット用の関連チャンク検索インデックスを差分更新 (保持している場合のみ)
+    cached = supa_get_document(doc_id)
+    if cached:
+        refresh_document_index(doc_id, cached.get('content'))
+    return jsonify(result)
+
 @document_bp.route('/<int:doc_id>/duplicate', methods=['POST'])
+@require_auth
 def duplicate_document(doc_id):
     """指定されたIDのドキュメントを複製 (Supabase)"""
     document = supa_get_document(doc_id)
     if not document:
         return jsonify({"error": "Document not found"}), 404
 
-    new_doc = supa_create_document(f"{document['title']} (コピー)", document.get('content', ''))
+    new_doc = supa_create_document(f"{document['title']} (コピー)", document.get('content', ''),
+                                   user_id=g.current_user)
     if not new_doc:
         return jsonify({"error": "Failed to duplicate document"}), 500
     return jsonify(new_doc), 201
 
 @document_bp.route('/<int:doc_id>', methods=['DELETE'])
+@require_auth
 def delete_document(doc_id):
     """指定されたIDのドキュメントを削除 (Supabase)"""
     # 削除結果は Supabase のレスポンスに含まれる (deleted rows)
     result = supa_delete_document(doc_id)
     if result is None:
         return jsonify({"error": "Failed to delete document"}), 500
+    if not result:
+        # 削除された行が無い (存在しない、または他のユーザーのドキュメント)
+        return jsonify({"error": "Document not found"}), 404
+    forget_document_index(doc_id)
     return jsonify({"message": "ドキュメントが削除されました", "id": doc_id})
 
 @document_bp.route('/latest_id', methods=['GET'])
+@require_auth
 def get_latest_document_id():
     """最新のドキュメントIDを返す (Supabase)"""
-    docs = supa_get_documents() or []
-    if docs:
-        return jsonify({"latest_id": docs[0]['id']})
+    latest_id = supa_get_latest_document_id()
+    if latest_id is not None:
+        return jsonify({"latest_id": latest_id})
     return jsonify({"error": "No documents found"}), 404 
\ No newline at end of file
@@ -1,6 +1,7 @@
 from flask import Blueprint, request, jsonify, current_app
 import os
 from dotenv import set_key, find_dotenv
+from app.utils.llm_gateway import get_llm_gateway
 
 settings_bp = Blueprint('settings', __name__, url_prefix='/api/settings')
 
@@ -40,6 +41,13 @@ def save_api_keys():
         if anthropic_key:
             set_key(dotenv_path, 'ANTHROPIC_API_KEY', anthropic_key)
             current_app.logger.info("Anthropic API Keyを.envに保存しました")
+        # 保存したキーを os.environ にも反映し、共有クライアントを作り直させる
+        for env_name, value in (('OPENAI_API_KEY', openai_key),
+                                ('GOOGLE_API_KEY', google_key),
+                                ('ANTHROPIC_API_KEY', anthropic_key)):
+            if value:
+                os.environ[env_name] = value
+        get_llm_gateway().reset()
 
         return jsonify({"message": "APIキーを .env に保存しました（ローカル環境）"})
 
@@ -53,6 +61,7 @@ def save_api_keys():
                 os.environ['GOOGLE_API_KEY'] = google_key
             if anthropic_key:
                 os.environ['ANTHROPIC_API_KEY'] = anthropic_key
+            get_llm_gateway().reset()
 
             current_app.logger.warning("読み取り専用ファイルシステムのため .env には書き込めませんでした。環境変数にのみ設定しました。")
             return jsonify({
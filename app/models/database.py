@@ -1,38 +1,264 @@
-from flask_sqlalchemy import SQLAlchemy  
-from datetime import datetime  
+from collections import OrderedDict
 import json  
-from app.models.supabase_client import get_supabase  
-from flask import g, has_request_context
-  
-# SQLAlchemyインスタンスの初期化（互換性のため維持）  
-db = SQLAlchemy()  
-  
-def init_db():  
-    """データベーステーブルの初期化関数"""  
-    db.create_all()  
-  
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.models.supabase_client import get_supabase, get_postgrest_session
+from app.utils.delta import apply_delta
+from postgrest.types import ReturnMethod
+from flask import current_app, g, has_app_context, has_request_context
+
 # Supabaseの機能を使用するヘルパー関数  
 def _supabase():
-    supabase = get_supabase()
-    # リクエストコンテキスト内かつ jwt_token があればセッションを上書き
-    if has_request_context() and hasattr(g, 'jwt_token'):
-        supabase.postgrest.auth(g.jwt_token)
-    return supabase
+    """
+    アプリ/リクエストコンテキスト内かつ jwt_token があれば、そのユーザーの PostgREST セッションを
+    セッションプールから返す (共有クライアントの認証状態は書き換えないので並行実行しても安全)。
+    バックグラウンドジョブは app_context 内で g.jwt_token を設定して呼び出す。
+    """
+    if has_app_context() and getattr(g, 'jwt_token', None):
+        return get_postgrest_session(g.jwt_token)
+    return get_supabase()
 
-def get_documents():  
-    supabase = _supabase()  
-    response = supabase.table('documents').select('*').order('updated_at', desc=True).execute()  
-    return response.data  
+# ---------------- 並行実行 ----------------
+# 互いに依存しない問い合わせを並行に送り、待ち時間を「合計」から「最も遅い 1 件」にする。
+# ワーカーは app_context 内で呼び出し元の g (jwt_token / current_user / リクエスト内キャッシュ) を
+# 引き継いで実行するため、RLS とドキュメントキャッシュは呼び出し元と同じように効く。
+# HTTP コネクションは PostgREST セッションプールと共有する (POSTGREST_MAX_CONNECTIONS)。
+
+POSTGREST_MAX_WORKERS = int(os.getenv('POSTGREST_MAX_WORKERS', '8'))
+
+_executor = ThreadPoolExecutor(max_workers=POSTGREST_MAX_WORKERS, thread_name_prefix='postgrest')
+_worker_state = threading.local()
+
+def _call_in_context(app, values, call):
+    _worker_state.active = True
+    try:
+        if app is None:
+            return call()
+        with app.app_context():
+            for name, value in values.items():
+                setattr(g, name, value)
+            return call()
+    finally:
+        _worker_state.active = False
+
+def run_concurrently(*calls):
+    """
+    引数なしの関数 calls (lambda や functools.partial) を並行に実行し、結果を同じ順序のリストで返す。
+    いずれかが例外を送出した場合は、すべての完了を待ってから最初の例外を送出する。
+    ワーカー内からの呼び出しや 1 件だけの場合は (プールを使い切らないよう) 順に実行する。
+    """
+    if len(calls) <= 1 or getattr(_worker_state, 'active', False):
+        return [call() for call in calls]
+    app, values = None, {}
+    if has_app_context():
+        app = current_app._get_current_object()
+        values = {name: getattr(g, name) for name in ('jwt_token', 'current_user') if name in g}
+        if has_request_context() or '_document_cache' in g:
+            values['_document_cache'] = _request_cache()
+    futures = [_executor.submit(_call_in_context, app, values, call) for call in calls]
+    errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [future.result() for future in futures]
+
+# ---------------- ドキュメントキャッシュ ----------------
+# documents 行をリクエスト内 (g) とプロセス内 (TTL 付き LRU) の2段でキャッシュする。
+# RLS を迂回しないよう、キーには呼び出し元ユーザー (g.current_user) を含め、
+# 行の user_id が呼び出し元と一致しない場合はキャッシュしない。
+# JWT の無い呼び出し (リクエスト外など) はキャッシュを使わない。
+# run_concurrently のワーカーは呼び出し元のリクエスト内キャッシュ (g._document_cache) を引き継ぐ。
+# プロセス内キャッシュの行は他のインスタンスで更新されている可能性があるため、get_document では
+# (updated_at, version) だけを取得して一致を確認してから返す (同じリクエスト内で確認済みの行はそのまま)。
+
+DOCUMENT_CACHE_TTL = float(os.getenv('DOCUMENT_CACHE_TTL', '30'))   # 秒
+DOCUMENT_CACHE_SIZE = int(os.getenv('DOCUMENT_CACHE_SIZE', '128'))  # エントリ数
+
+class _DocumentCache:
+    """(user, doc_id) -> {'row', 'exists', 'updated_at', 'expires'} の TTL + LRU キャッシュ"""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry['expires'] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, row=None, exists=True):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        updated_at = row.get('updated_at') if row else None
+        with self._lock:
+            current = self._entries.get(key)
+            # より新しい updated_at を持つ行を古い行で上書きしない
+            if (current and current['row'] and row and current['updated_at'] and updated_at
+                    and str(current['updated_at']) > str(updated_at)):
+                return
+            self._entries[key] = {
+                'row': row,
+                'exists': exists,
+                'updated_at': updated_at,
+                'expires': time.monotonic() + self.ttl,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, doc_id):
+        """全ユーザー分の doc_id のエントリを破棄"""
+        with self._lock:
+            for key in [k for k in self._entries if k[1] == doc_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+_document_cache = _DocumentCache(DOCUMENT_CACHE_TTL, DOCUMENT_CACHE_SIZE)
+
+def _cache_scope():
+    """キャッシュキーに使う呼び出し元ユーザー。キャッシュ不可なら None"""
+    if not has_app_context() or not getattr(g, 'jwt_token', None) or not getattr(g, 'current_user', None):
+        return None
+    # リクエスト内か、リクエストから呼ばれた run_concurrently のワーカーだけがキャッシュを使う
+    if has_request_context() or '_document_cache' in g:
+        return g.current_user
+    return None
+
+def _request_cache():
+    """リクエスト内キャッシュ (doc_id -> entry)"""
+    cache = getattr(g, '_document_cache', None)
+    if cache is None:
+        cache = g._document_cache = {}
+    return cache
+
+def _is_current_row(doc_id, row):
+    """キャッシュした行が DB の最新か (updated_at と version だけを取得して比較)"""
+    supabase = _supabase()
+    response = supabase.table('documents').select('updated_at, version').eq('id', doc_id).limit(1).execute()
+    data = response.data or []
+    return bool(data) and (
+        data[0].get('updated_at') == row.get('updated_at') and data[0].get('version') == row.get('version')
+    )
+
+def _lookup_cached_document(doc_id, revalidate=False):
+    """
+    キャッシュのエントリを返す。revalidate=True なら、プロセス内キャッシュの行は
+    DB の最新と一致する場合だけ返す (一致しなければ破棄して None)。
+    """
+    scope = _cache_scope()
+    if scope is None:
+        return None
+    entry = _request_cache().get(doc_id)
+    if entry is None:
+        entry = _document_cache.get((scope, doc_id))
+        if entry is None:
+            return None
+        if revalidate and entry['row'] is not None and not _is_current_row(doc_id, entry['row']):
+            _forget_document(doc_id)
+            return None
+        _request_cache()[doc_id] = entry
+    return entry
+
+def _remember_document(doc_id, row=None, exists=True):
+    scope = _cache_scope()
+    if scope is None:
+        return
+    # 他ユーザーの行 (service role で取得した場合など) はキャッシュしない
+    if row and row.get('user_id') and str(row['user_id']) != str(scope):
+        return
+    entry = {'row': row, 'exists': exists, 'updated_at': row.get('updated_at') if row else None}
+    _request_cache()[doc_id] = entry
+    _document_cache.put((scope, doc_id), row=row, exists=exists)
+
+def _forget_document(doc_id):
+    _document_cache.invalidate(doc_id)
+    if has_request_context() or (has_app_context() and '_document_cache' in g):
+        _request_cache().pop(doc_id, None)
+
+def clear_document_cache():
+    """プロセス内ドキュメントキャッシュを全破棄する"""
+    _document_cache.clear()
+
+# 一覧表示に必要な列 (content 本体は取得しない)
+DOCUMENT_LIST_COLUMNS = 'id, title, updated_at'
+
+def get_documents(limit=None, before_updated_at=None, before_id=None, with_preview=False):
+    """
+    ドキュメント一覧 (更新日時の新しい順)。メタデータ列だけを取得する。
+    with_preview=True なら本文先頭のプレーンテキスト (preview 列) も含める。
+    (before_updated_at, before_id) を渡すと、その行より古いものを返す (キーセットページング)。
+    """
+    supabase = _supabase()
+    columns = DOCUMENT_LIST_COLUMNS + (', preview' if with_preview else '')
+    query = (
+        supabase.table('documents')
+        .select(columns)
+        .order('updated_at', desc=True)
+        .order('id', desc=True)
+    )
+    if before_updated_at is not None and before_id is not None:
+        query = query.or_(
+            f'updated_at.lt."{before_updated_at}",'
+            f'and(updated_at.eq."{before_updated_at}",id.lt.{int(before_id)})'
+        )
+    if limit is not None:
+        query = query.limit(limit)
+    response = query.execute()
+    return response.data
+
+def get_latest_document_id():
+    """最も新しく更新されたドキュメントの ID (無ければ None)"""
+    supabase = _supabase()
+    response = supabase.table('documents').select('id').order('updated_at', desc=True).limit(1).execute()
+    data = response.data or []
+    return data[0]['id'] if data else None
   
-def get_document(doc_id):
-    """ID で 1 件取得。存在しなければ None を返す。"""
+def get_document(doc_id, use_cache=True):
+    """
+    ID で 1 件取得。存在しなければ None を返す。
+    use_cache=True でもプロセス内キャッシュの行は最新か確認してから返す (_lookup_cached_document)。
+    """
+    if use_cache:
+        entry = _lookup_cached_document(doc_id, revalidate=True)
+        if entry is not None and entry['row'] is not None:
+            return entry['row']
     supabase = _supabase()
     response = supabase.table('documents').select('*').eq('id', doc_id).execute()
     if getattr(response, 'error', None):
         # エラー内容をログなどで参照したい場合は呼び出し側で response.error を参照
         return None
     data = response.data or []
-    return data[0] if data else None
+    row = data[0] if data else None
+    if row:
+        _remember_document(doc_id, row=row)
+    return row
+
+def document_exists(doc_id):
+    """ID のドキュメントが (呼び出し元から見えて) 存在するか。id 列だけを取得する。"""
+    entry = _lookup_cached_document(doc_id)
+    if entry is not None:
+        return entry['exists']
+    supabase = _supabase()
+    response = supabase.table('documents').select('id').eq('id', doc_id).limit(1).execute()
+    if getattr(response, 'error', None):
+        return False
+    exists = bool(response.data)
+    if exists:
+        _remember_document(doc_id, row=None, exists=True)
+    return exists
   
 def create_document(title, content, user_id=None):
     """ドキュメントを作成し、作成後の行を返す"""
@@ -47,25 +273,128 @@ def create_document(title, content, user_id=None):
     return response.data[0]
   
 def update_document(doc_id, data):  
+    """ドキュメントを更新して更新後の行を返す (見つからなければ None)"""
     supabase = _supabase()  
+    _forget_document(doc_id)
     response = supabase.table('documents').update(data).eq('id', doc_id).execute()  
-    return response.data[0]  
+    if not response.data:
+        # 存在しない (または RLS で見えない) ドキュメント
+        return None
+    row = response.data[0]
+    _remember_document(doc_id, row=row)
+    return row
   
+class DocumentVersionConflict(Exception):
+    """base_version が現在の version と一致しない (他の保存が先に反映された)"""
+
+    def __init__(self, current):
+        super().__init__(f"document {current.get('id')} is at version {current.get('version')}")
+        self.current = current
+
+def apply_document_delta(doc_id, ops, base_version):
+    """
+    Quill の変更 Delta (ops) を base_version のドキュメントに適用して保存する。
+    version 列での楽観的排他制御を行い、結果として {'id', 'version', 'updated_at'} を返す
+    (content 全体は返さない)。ドキュメントが無ければ None。
+    version が一致しなければ DocumentVersionConflict、ops が不正なら DeltaError を送出する。
+    version は documents の更新トリガーが content 変更時に 1 つ進める。
+    """
+    row = get_document(doc_id)
+    if row is not None and row.get('version') != base_version:
+        # キャッシュが古い可能性があるので DB から取り直して確認
+        row = get_document(doc_id, use_cache=False)
+    if row is None:
+        return None
+    if row.get('version') != base_version:
+        raise DocumentVersionConflict(row)
+
+    content = apply_delta(row.get('content'), ops)
+    if content == row.get('content'):
+        return {'id': doc_id, 'version': base_version, 'updated_at': row.get('updated_at')}
+
+    supabase = _supabase()
+    _forget_document(doc_id)
+    # version と updated_at はトリガーが設定した DB の値だけを返させる (content 全体は返さない)
+    response = (
+        supabase.table('documents')
+        .update({'content': content}, returning=ReturnMethod.representation)
+        .eq('id', doc_id)
+        .eq('version', base_version)
+        .select('version, updated_at')
+        .execute()
+    )
+    if not response.data:
+        # 読み込みから更新までの間に別の保存が入った
+        raise DocumentVersionConflict(get_document(doc_id, use_cache=False) or row)
+    stored = response.data[0]
+    saved = dict(row, content=content, version=stored['version'], updated_at=stored['updated_at'])
+    _remember_document(doc_id, row=saved)
+    return {'id': doc_id, 'version': saved['version'], 'updated_at': saved['updated_at']}
+
 def delete_document(doc_id):  
     supabase = _supabase()  
+    _forget_document(doc_id)
     response = supabase.table('documents').delete().eq('id', doc_id).execute()  
     return response.data  
   
-def get_chat_messages(doc_id):
-    """指定ドキュメントのチャット履歴（昇順）。存在しなくても空配列を返す。"""
+def search_documents(query, scope='all', limit=20, offset=0):
+    """
+    ドキュメントとチャット履歴の全文検索 (RPC search_documents)。
+    scope は 'all' / 'documents' / 'chats'。順位の高い順に
+    {'kind', 'document_id', 'title', 'message_id', 'role', 'snippet', 'rank', 'updated_at',
+    'document_updated_at'} のリストを返す (kind は 'document' か 'chat')。
+    """
+    supabase = _supabase()
+    response = supabase.rpc('search_documents', {
+        'query_text': query,
+        'scope': scope,
+        'page_size': limit,
+        'page_offset': offset,
+    }).execute()
+    return response.data or []
+
+# プロンプト組み立てに必要な列 (user_id などは取得しない)
+CHAT_MESSAGE_COLUMNS = 'id, role, content, timestamp, model_used, thinking_enabled'
+
+def get_chat_messages(doc_id, limit=None, before_id=None, after_id=None, after_timestamp=None,
+                      offset=0, columns='*'):
+    """
+    指定ドキュメントのチャット履歴（昇順）。存在しなくても空配列を返す。
+
+    • limit 指定時は条件に合う「最新の」limit 件だけを取得する (order desc + range を DB 側で実行)
+    • before_id 指定時はその ID より古いメッセージ (過去ページの遅延読み込み用)
+    • after_id / after_timestamp 指定時はカーソルより新しいメッセージを古い順に limit 件
+    • offset は limit と組み合わせて range(offset, offset + limit - 1) として渡す
+    id は採番順 = 時系列順である前提でカーソルに使う。
+    """
     supabase = _supabase()
-    response = supabase.table('chat_messages').select('*').eq('document_id', doc_id).order('timestamp').execute()
+    query = supabase.table('chat_messages').select(columns).eq('document_id', doc_id)
+    if before_id is not None:
+        query = query.lt('id', before_id)
+    if after_id is not None:
+        query = query.gt('id', after_id)
+    if after_timestamp is not None:
+        query = query.gt('timestamp', after_timestamp)
+
+    forward = limit is None or after_id is not None or after_timestamp is not None
+    query = query.order('timestamp', desc=not forward).order('id', desc=not forward)
+    if limit is not None:
+        query = query.range(offset, offset + limit - 1)
+
+    response = query.execute()
     if getattr(response, 'error', None):
         return []
-    return response.data or []
+    messages = response.data or []
+    if not forward:
+        messages.reverse()
+    return messages
+
+def get_recent_chat_messages(doc_id, limit):
+    """直近 limit 件のチャット履歴（昇順）。プロンプト用の列のみ取得する。"""
+    return get_chat_messages(doc_id, limit=limit, columns=CHAT_MESSAGE_COLUMNS)
   
-def create_chat_message(document_id, role, content, model_used=None, thinking_enabled=False, user_id=None):
-    supabase = _supabase()
+def chat_message_row(document_id, role, content, model_used=None, thinking_enabled=False, user_id=None):
+    """chat_messages に挿入する1行分の dict"""
     data = {
         'document_id': document_id,
         'role': role,
@@ -75,9 +404,46 @@ def create_chat_message(document_id, role, content, model_used=None, thinking_en
     }
     if user_id:
         data['user_id'] = user_id
+    return data
+
+def create_chat_message(document_id, role, content, model_used=None, thinking_enabled=False, user_id=None):
+    supabase = _supabase()
+    data = chat_message_row(document_id, role, content, model_used, thinking_enabled, user_id)
     response = supabase.table('chat_messages').insert(data).execute()
     return response.data[0]
+
+def create_chat_messages(rows):
+    """
+    複数のメッセージ (chat_message_row の dict) を1回のリクエストでまとめて挿入する。
+    挿入した行は返さない (returning=minimal)。id はリストの順に採番される。
+    """
+    if not rows:
+        return
+    supabase = _supabase()
+    supabase.table('chat_messages').insert(list(rows), returning=ReturnMethod.minimal).execute()
   
+def begin_chat_turn(doc_id, user_message, model_name=None, thinking_enabled=False, history_limit=25):
+    """
+    チャット 1 ターンの開始 (RPC begin_chat_turn)。1 回の呼び出しで
+    ドキュメント・会話要約・直近 history_limit 件の履歴 (昇順) を取得し、ユーザーメッセージを保存する。
+    {'document', 'messages', 'summary', 'user_message_id'} を返す
+    (summary は {'summary', 'last_message_id'} か None)。
+    ドキュメントが存在しない (呼び出し元から見えない) 場合は何も保存せず None を返す。
+    """
+    supabase = _supabase()
+    response = supabase.rpc('begin_chat_turn', {
+        'doc_id': doc_id,
+        'user_message': user_message,
+        'model_name': model_name,
+        'thinking': bool(thinking_enabled),
+        'history_limit': history_limit,
+    }).execute()
+    turn = response.data
+    if not turn or not turn.get('document'):
+        return None
+    _remember_document(doc_id, row=turn['document'])
+    return turn
+
 # 指定ドキュメントIDのチャットメッセージを全削除
 def delete_chat_messages(document_id):
     """指定ドキュメントIDに紐づくチャットメッセージを削除して削除件数を返す"""
@@ -86,52 +452,34 @@ def delete_chat_messages(document_id):
     # Supabase からは削除した行データが返るので、その件数を返す
     return len(response.data or [])
   
-# 以下は互換性のためにSQLAlchemyモデルを維持  
-# ドキュメントモデル  
-class Document(db.Model):  
-    # 既存のモデル定義を維持  
-    __tablename__ = 'documents'  
-      
-    id = db.Column(db.Integer, primary_key=True)  
-    title = db.Column(db.String(100), nullable=False, default='無題のドキュメント')  
-    content = db.Column(db.Text, nullable=False, default='')  
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)  
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  
-      
-    # ドキュメントに関連するチャットメッセージへの関係定義  
-    chat_messages = db.relationship('ChatMessage', backref='document', lazy=True, cascade='all, delete-orphan')  
-      
-    def to_dict(self):  
-        """ドキュメントをJSONシリアライズ可能な辞書に変換"""  
-        return {  
-            'id': self.id,  
-            'title': self.title,  
-            'content': self.content,  
-            'created_at': self.created_at.isoformat() if self.created_at else None,  
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None  
-        }  
-  
-# チャットメッセージモデル  
-class ChatMessage(db.Model):  
-    # 既存のモデル定義を維持  
-    __tablename__ = 'chat_messages'  
-      
-    id = db.Column(db.Integer, primary_key=True)  
-    document_id = db.Column(db.Integer, db.ForeignKey('documents.id'), nullable=False)  
-    role = db.Column(db.String(10), nullable=False)  # 'user' or 'assistant'  
-    content = db.Column(db.Text, nullable=False)  
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)  
-    model_used = db.Column(db.String(100))  # 使用されたAIモデル名  
-    thinking_enabled = db.Column(db.Boolean, default=False)  # Claudeの思考モードなど  
-      
-    def to_dict(self):  
-        """チャットメッセージをJSONシリアライズ可能な辞書に変換"""  
-        return {  
-            'id': self.id,  
-            'document_id': self.document_id,  
-            'role': self.role,  
-            'content': self.content,  
-            'timestamp': self.timestamp.isoformat() if self.timestamp else None,  
-            'model_used': self.model_used,  
-            'thinking_enabled': self.thinking_enabled,  
-        }
\ No newline at end of file
+# ---------------- 会話の要約 (chat_summaries) ----------------
+# 古い会話を要約した文章と、要約に含めた最後のメッセージ ID をドキュメント毎に1行保持する。
+# スキーマは supabase/migrations を参照。
+
+def get_chat_summary(doc_id):
+    """ドキュメントの会話要約行。無ければ None"""
+    supabase = _supabase()
+    response = supabase.table('chat_summaries').select('summary, last_message_id').eq('document_id', doc_id).execute()
+    if getattr(response, 'error', None):
+        return None
+    data = response.data or []
+    return data[0] if data else None
+
+def upsert_chat_summary(doc_id, summary, last_message_id, user_id=None):
+    """
+    会話要約を作成または更新する (RPC save_chat_summary)。
+    last_message_id のメッセージが削除済み (要約中にチャット履歴がリセットされた) なら保存せず None を返す。
+    user_id は RPC 側で auth.uid() を使うため指定不要 (sqlite_storage と同じ引数を受け付ける)。
+    """
+    supabase = _supabase()
+    response = supabase.rpc('save_chat_summary', {
+        'doc_id': doc_id,
+        'summary_text': summary,
+        'last_message_id': last_message_id,
+    }).execute()
+    return response.data or None
+
+def delete_chat_summary(doc_id):
+    """会話要約を削除する (チャット履歴リセット時)"""
+    supabase = _supabase()
+    supabase.table('chat_summaries').delete().eq('document_id', doc_id).execute()
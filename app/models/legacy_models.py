@@ -0,0 +1,67 @@
+"""
+SQLAlchemy のモデル (互換性のため維持)。
+
+データの読み書きは app/models/database.py (Supabase / PostgREST) で行い、これらのモデルは使わない。
+flask_sqlalchemy / SQLAlchemy の import はコールドスタートで数百 ms かかるため、
+app.py は SUPABASE_DB_URL (Postgres への直接接続 URI) が設定されている場合だけこのモジュールを読み込む。
+"""
+from datetime import datetime
+
+from flask_sqlalchemy import SQLAlchemy
+
+# SQLAlchemyインスタンスの初期化（互換性のため維持）  
+db = SQLAlchemy()  
+  
+def init_db():  
+    """データベーステーブルの初期化関数"""  
+    db.create_all()  
+  
+# 以下は互換性のためにSQLAlchemyモデルを維持  
+# ドキュメントモデル  
+class Document(db.Model):  
+    # 既存のモデル定義を維持  
+    __tablename__ = 'documents'  
+      
+    id = db.Column(db.Integer, primary_key=True)  
+    title = db.Column(db.String(100), nullable=False, default='無題のドキュメント')  
+    content = db.Column(db.Text, nullable=False, default='')  
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)  
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  
+      
+    # ドキュメントに関連するチャットメッセージへの関係定義  
+    chat_messages = db.relationship('ChatMessage', backref='document', lazy=True, cascade='all, delete-orphan')  
+      
+    def to_dict(self):  
+        """ドキュメントをJSONシリアライズ可能な辞書に変換"""  
+        return {  
+            'id': self.id,  
+            'title': self.title,  
+            'content': self.content,  
+            'created_at': self.created_at.isoformat() if self.created_at else None,  
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None  
+        }  
+  
+# チャットメッセージモデル  
+class ChatMessage(db.Model):  
+    # 既存のモデル定義を維持  
+    __tablename__ = 'chat_messages'  
+      
+    id = db.Column(db.Integer, primary_key=True)  
+    document_id = db.Column(db.Integer, db.ForeignKey('documents.id'), nullable=False)  
+    role = db.Column(db.String(10), nullable=False)  # 'user' or 'assistant'  
+    content = db.Column(db.Text, nullable=False)  
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)  
+    model_used = db.Column(db.String(100))  # 使用されたAIモデル名  
+    thinking_enabled = db.Column(db.Boolean, default=False)  # Claudeの思考モードなど  
+      
+    def to_dict(self):  
+        """チャットメッセージをJSONシリアライズ可能な辞書に変換"""  
+        return {  
+            'id': self.id,  
+            'document_id': self.document_id,  
+            'role': self.role,  
+            'content': self.content,  
+            'timestamp': self.timestamp.isoformat() if self.timestamp else None,  
+            'model_used': self.model_used,  
+            'thinking_enabled': self.thinking_enabled,  
+        }
\ No newline at end of file
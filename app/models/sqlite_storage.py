@@ -0,0 +1,565 @@
+"""
+組み込み SQLite のストレージ (STORAGE_BACKEND=sqlite)。app/models/database.py と同じ名前・引数の関数を持つ。
+
+単一ノードのセルフホストや負荷試験向け。問い合わせは Supabase への HTTP の往復なしにプロセス内で完結する。
+• WAL モード (読み込みは書き込みを待たない)、synchronous=NORMAL、外部キー有効
+• SQL は定数の文字列にプレースホルダ (?) で値を渡し、接続毎の文キャッシュ (cached_statements) で
+  コンパイル済みの文を使い回す (プリペアドステートメント)
+• インデックスは supabase/migrations と同じ (user_id, updated_at desc, id desc) / (document_id, timestamp, id)
+• RLS の代わりに、すべての問い合わせを g.current_user (verify_token が設定) の行に限定する
+• 全文検索は FTS5。retrieval.search_index_tokens (英数字の単語 + 日本語の文字 bi-gram と 1 文字) を索引化し、
+  検索語は retrieval.tokenize で分割する (Postgres の search_documents と同じ規則)
+• 接続は SQLITE_POOL_SIZE 本までプールして使い回す
+認証 (JWT の検証) は Supabase Auth のまま。ドキュメントキャッシュは使わない (読み込みがプロセス内で済むため)。
+"""
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from flask import g, has_app_context
+
+from app.models.database import (
+    CHAT_MESSAGE_COLUMNS,
+    DOCUMENT_LIST_COLUMNS,
+    DocumentVersionConflict,
+    chat_message_row,
+)
+from app.utils.delta import apply_delta
+from app.utils.document_text import document_text
+from app.utils.retrieval import search_index_tokens, tokenize
+
+SQLITE_DB_PATH = os.getenv('SQLITE_DB_PATH', 'instance/kabeuchi.db')
+# プールして使い回す接続数 (超えた分は使用後に閉じる)
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))
+# 接続毎にコンパイル済みの文を保持する数
+SQLITE_STATEMENT_CACHE = 256
+# 一覧のプレビュー・検索スニペットの文字数 (Postgres 側と同じ)
+PREVIEW_CHARS = 150
+SNIPPET_CHARS = 120
+# 検索索引のトークンの規則の版 (PRAGMA user_version)。規則を変えたら上げると、起動時に索引を作り直す
+SEARCH_INDEX_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    title      TEXT NOT NULL DEFAULT '無題のドキュメント',
+    content    TEXT NOT NULL DEFAULT '',
+    preview    TEXT NOT NULL DEFAULT '',
+    user_id    TEXT,
+    version    INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS documents_user_updated_at_idx
+    ON documents (user_id, updated_at DESC, id DESC);
+
+CREATE TABLE IF NOT EXISTS chat_messages (
+    id               INTEGER PRIMARY KEY AUTOINCREMENT,
+    document_id      INTEGER NOT NULL REFERENCES documents (id) ON DELETE CASCADE,
+    role             TEXT NOT NULL,
+    content          TEXT NOT NULL DEFAULT '',
+    timestamp        TEXT NOT NULL,
+    model_used       TEXT,
+    thinking_enabled INTEGER NOT NULL DEFAULT 0,
+    user_id          TEXT
+);
+CREATE INDEX IF NOT EXISTS chat_messages_document_timestamp_idx
+    ON chat_messages (document_id, timestamp, id);
+
+CREATE TABLE IF NOT EXISTS chat_summaries (
+    document_id     INTEGER PRIMARY KEY REFERENCES documents (id) ON DELETE CASCADE,
+    user_id         TEXT,
+    summary         TEXT NOT NULL DEFAULT '',
+    last_message_id INTEGER NOT NULL,
+    updated_at      TEXT NOT NULL
+);
+
+-- 検索用のトークン (空白区切り)。rowid は documents.id / chat_messages.id
+-- ascii トークナイザは非 ASCII 文字をそのままトークンの一部として扱うため、bi-gram が分割されない
+CREATE VIRTUAL TABLE IF NOT EXISTS document_search
+    USING fts5(title, body, tokenize = "ascii tokenchars '_'");
+CREATE VIRTUAL TABLE IF NOT EXISTS message_search
+    USING fts5(body, tokenize = "ascii tokenchars '_'");
+"""
+
+# ---------------- SQL ----------------
+
+_SELECT_DOCUMENT = "SELECT * FROM documents WHERE id = ? AND user_id IS ?"
+_DOCUMENT_EXISTS = "SELECT 1 FROM documents WHERE id = ? AND user_id IS ? LIMIT 1"
+_LATEST_DOCUMENT_ID = (
+    "SELECT id FROM documents WHERE user_id IS ? ORDER BY updated_at DESC, id DESC LIMIT 1"
+)
+_INSERT_DOCUMENT = (
+    "INSERT INTO documents (title, content, preview, user_id, created_at, updated_at) "
+    "VALUES (?, ?, ?, ?, ?, ?) RETURNING *"
+)
+_UPDATE_DOCUMENT = (
+    "UPDATE documents SET title = ?, content = ?, preview = ?, version = ?, updated_at = ? "
+    "WHERE id = ? AND user_id IS ? RETURNING *"
+)
+_UPDATE_DOCUMENT_CONTENT = (
+    "UPDATE documents SET content = ?, preview = ?, version = version + 1, updated_at = ? "
+    "WHERE id = ? AND user_id IS ? AND version = ?"
+)
+_DELETE_DOCUMENT = "DELETE FROM documents WHERE id = ? AND user_id IS ? RETURNING *"
+_INDEX_DOCUMENT = "INSERT OR REPLACE INTO document_search (rowid, title, body) VALUES (?, ?, ?)"
+_UNINDEX_DOCUMENT = "DELETE FROM document_search WHERE rowid = ?"
+
+_INSERT_MESSAGE = (
+    "INSERT INTO chat_messages (document_id, role, content, timestamp, model_used, thinking_enabled, user_id) "
+    "SELECT ?, ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM documents WHERE id = ? AND user_id IS ?) "
+    "RETURNING id"
+)
+_INDEX_MESSAGE = "INSERT INTO message_search (rowid, body) VALUES (?, ?)"
+_UNINDEX_DOCUMENT_MESSAGES = (
+    "DELETE FROM message_search WHERE rowid IN "
+    "(SELECT id FROM chat_messages WHERE document_id = ? AND user_id IS ?)"
+)
+_DELETE_MESSAGES = "DELETE FROM chat_messages WHERE document_id = ? AND user_id IS ?"
+
+_SELECT_SUMMARY = (
+    "SELECT summary, last_message_id FROM chat_summaries WHERE document_id = ? AND user_id IS ?"
+)
+_UPSERT_SUMMARY = (
+    "INSERT INTO chat_summaries (document_id, user_id, summary, last_message_id, updated_at) "
+    "SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM documents WHERE id = ? AND user_id IS ?) "
+    # 要約した最後のメッセージが削除済み (要約中にリセットされた) なら保存しない
+    "AND EXISTS (SELECT 1 FROM chat_messages WHERE id = ? AND document_id = ? AND user_id IS ?) "
+    "ON CONFLICT (document_id) DO UPDATE SET summary = excluded.summary, "
+    "last_message_id = excluded.last_message_id, updated_at = excluded.updated_at "
+    "WHERE chat_summaries.user_id IS excluded.user_id "
+    "RETURNING *"
+)
+_DELETE_SUMMARY = "DELETE FROM chat_summaries WHERE document_id = ? AND user_id IS ?"
+
+# 順位は bm25 (小さいほど良い)。タイトル > 本文 > チャットの順に重みを付ける
+_SEARCH_DOCUMENTS = (
+    "SELECT 'document' AS kind, d.id AS document_id, NULL AS message_id, "
+    "bm25(document_search, 4.0, 2.0) AS score, d.updated_at AS updated_at "
+    "FROM document_search JOIN documents AS d ON d.id = document_search.rowid "
+    "WHERE document_search MATCH ? AND d.user_id IS ?"
+)
+_SEARCH_MESSAGES = (
+    "SELECT 'chat' AS kind, m.document_id AS document_id, m.id AS message_id, "
+    "bm25(message_search) AS score, m.timestamp AS updated_at "
+    "FROM message_search JOIN chat_messages AS m ON m.id = message_search.rowid "
+    "WHERE message_search MATCH ? AND m.user_id IS ?"
+)
+_SEARCH_ORDER = " ORDER BY score, updated_at DESC, document_id DESC, message_id LIMIT ? OFFSET ?"
+
+_CHAT_MESSAGE_FIELDS = (
+    'id', 'document_id', 'role', 'content', 'timestamp', 'model_used', 'thinking_enabled', 'user_id',
+)
+
+# ---------------- 接続 ----------------
+
+class _ConnectionPool:
+    """SQLite 接続のプール (1 つの接続を同時に使うのは 1 スレッドだけ)"""
+
+    def __init__(self, path, size):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        con = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False,
+                              cached_statements=SQLITE_STATEMENT_CACHE)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.execute("PRAGMA foreign_keys=ON")
+        with self._lock:
+            if not self._initialized:
+                con.executescript(_SCHEMA)
+                if con.execute("PRAGMA user_version").fetchone()[0] < SEARCH_INDEX_VERSION:
+                    _rebuild_search_index(con)
+                self._initialized = True
+        return con
+
+    @contextmanager
+    def connection(self):
+        try:
+            con = self._idle.get_nowait()
+        except queue.Empty:
+            con = self._connect()
+        try:
+            yield con
+        finally:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            try:
+                self._idle.put_nowait(con)
+            except queue.Full:
+                con.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pool = _ConnectionPool(SQLITE_DB_PATH, SQLITE_POOL_SIZE)
+
+def _rows(cursor):
+    rows = []
+    for row in cursor.fetchall():
+        data = dict(row)
+        if 'thinking_enabled' in data:
+            data['thinking_enabled'] = bool(data['thinking_enabled'])
+        rows.append(data)
+    return rows
+
+def _query(sql, params=()):
+    with _pool.connection() as con:
+        return _rows(con.execute(sql, params))
+
+@contextmanager
+def _transaction():
+    """書き込みのトランザクション (BEGIN IMMEDIATE で先に書き込みロックを取る)"""
+    with _pool.connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+
+def _owner():
+    """行の所有者 (Supabase の RLS の auth.uid() に相当)。認証されていない呼び出しは None"""
+    return getattr(g, 'current_user', None) if has_app_context() else None
+
+def _writer():
+    """
+    書き込みを行うユーザー。認証されていない呼び出し (g.current_user が無い) では PermissionError を送出する
+    (所有者の無い行を作ったり、何も変更せずに成功を返したりしないため)
+    """
+    owner = _owner()
+    if owner is None:
+        raise PermissionError("認証されていない呼び出しではドキュメント・チャット履歴を変更できません")
+    return owner
+
+def _now():
+    # Supabase (timestamptz) と同じく UTC のオフセット付き ISO 形式。文字列の順序 = 時刻の順序
+    return datetime.now(timezone.utc).isoformat()
+
+def _search_tokens(text):
+    return ' '.join(sorted(search_index_tokens(text)))
+
+def _plain_text(content):
+    return document_text(content or '')
+
+def _rebuild_search_index(con):
+    """全ドキュメント・メッセージの検索索引を現在の規則で作り直す (索引の規則を変えたとき)"""
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        con.execute("DELETE FROM document_search")
+        con.execute("DELETE FROM message_search")
+        for row in con.execute("SELECT id, title, content FROM documents").fetchall():
+            _index_document(con, row)
+        for row in con.execute("SELECT id, content FROM chat_messages").fetchall():
+            con.execute(_INDEX_MESSAGE, (row['id'], _search_tokens(row['content'])))
+        con.execute(f"PRAGMA user_version = {SEARCH_INDEX_VERSION}")
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+
+def _index_document(con, row):
+    con.execute(_INDEX_DOCUMENT, (row['id'], _search_tokens(row['title']), _search_tokens(_plain_text(row['content']))))
+
+def _insert_message(con, row, owner):
+    """chat_message_row の dict を 1 行挿入して id を返す (呼び出し元のドキュメントでなければ ValueError)"""
+    user_id = row.get('user_id') or owner
+    message = con.execute(_INSERT_MESSAGE, (
+        row['document_id'], row['role'], row['content'], _now(), row.get('model_used'),
+        int(bool(row.get('thinking_enabled'))), user_id, row['document_id'], owner,
+    )).fetchone()
+    if message is None:
+        raise ValueError(f"document {row['document_id']} が見つかりません")
+    con.execute(_INDEX_MESSAGE, (message['id'], _search_tokens(row['content'])))
+    return message['id']
+
+# ---------------- ドキュメント ----------------
+
+def get_documents(limit=None, before_updated_at=None, before_id=None, with_preview=False):
+    """ドキュメント一覧 (更新日時の新しい順)。引数は database.get_documents と同じ"""
+    sql = f"SELECT {DOCUMENT_LIST_COLUMNS}{', preview' if with_preview else ''} FROM documents WHERE user_id IS ?"
+    params = [_owner()]
+    if before_updated_at is not None and before_id is not None:
+        sql += " AND (updated_at < ? OR (updated_at = ? AND id < ?))"
+        params += [before_updated_at, before_updated_at, int(before_id)]
+    sql += " ORDER BY updated_at DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return _query(sql, params)
+
+def get_latest_document_id():
+    """最も新しく更新されたドキュメントの ID (無ければ None)"""
+    rows = _query(_LATEST_DOCUMENT_ID, (_owner(),))
+    return rows[0]['id'] if rows else None
+
+def get_document(doc_id, use_cache=True):
+    """ID で 1 件取得。存在しなければ None を返す (use_cache は互換のためだけの引数)"""
+    rows = _query(_SELECT_DOCUMENT, (doc_id, _owner()))
+    return rows[0] if rows else None
+
+def document_exists(doc_id):
+    """ID のドキュメントが (呼び出し元から見えて) 存在するか"""
+    return bool(_query(_DOCUMENT_EXISTS, (doc_id, _owner())))
+
+def create_document(title, content, user_id=None):
+    """ドキュメントを作成し、作成後の行を返す"""
+    now = _now()
+    content = content or ''
+    with _transaction() as con:
+        row = _rows(con.execute(_INSERT_DOCUMENT, (
+            title, content, _plain_text(content)[:PREVIEW_CHARS], user_id or _writer(), now, now,
+        )))[0]
+        _index_document(con, row)
+    return row
+
+def update_document(doc_id, data):
+    """
+    title / content を更新して更新後の行を返す (ドキュメントが無ければ None)。
+    content が変わった場合は version を 1 つ進める (Postgres のトリガーと同じ)。
+    """
+    owner = _writer()
+    with _transaction() as con:
+        current = _rows(con.execute(_SELECT_DOCUMENT, (doc_id, owner)))
+        if not current:
+            return None
+        current = current[0]
+        title = data.get('title', current['title'])
+        content = data.get('content', current['content'])
+        version = current['version'] + (1 if content != current['content'] else 0)
+        row = _rows(con.execute(_UPDATE_DOCUMENT, (
+            title, content, _plain_text(content)[:PREVIEW_CHARS], version, _now(), doc_id, owner,
+        )))[0]
+        _index_document(con, row)
+    return row
+
+def apply_document_delta(doc_id, ops, base_version):
+    """
+    Quill の変更 Delta を base_version のドキュメントに適用して保存し、{'id', 'version', 'updated_at'} を返す。
+    ドキュメントが無ければ None。version が一致しなければ DocumentVersionConflict、ops が不正なら DeltaError。
+    """
+    owner = _writer()
+    with _transaction() as con:
+        rows = _rows(con.execute(_SELECT_DOCUMENT, (doc_id, owner)))
+        if not rows:
+            return None
+        row = rows[0]
+        if row['version'] != base_version:
+            raise DocumentVersionConflict(row)
+
+        content = apply_delta(row['content'], ops)
+        if content == row['content']:
+            return {'id': doc_id, 'version': base_version, 'updated_at': row['updated_at']}
+        updated_at = _now()
+        con.execute(_UPDATE_DOCUMENT_CONTENT, (
+            content, _plain_text(content)[:PREVIEW_CHARS], updated_at, doc_id, owner, base_version,
+        ))
+        _index_document(con, dict(row, content=content))
+    return {'id': doc_id, 'version': base_version + 1, 'updated_at': updated_at}
+
+def delete_document(doc_id):
+    """ドキュメント (とチャット履歴・要約) を削除し、削除した行のリストを返す"""
+    owner = _writer()
+    with _transaction() as con:
+        con.execute(_UNINDEX_DOCUMENT_MESSAGES, (doc_id, owner))
+        deleted = _rows(con.execute(_DELETE_DOCUMENT, (doc_id, owner)))
+        if deleted:
+            con.execute(_UNINDEX_DOCUMENT, (doc_id,))
+    return deleted
+
+def search_documents(query, scope='all', limit=20, offset=0):
+    """ドキュメントとチャット履歴の全文検索。戻り値は database.search_documents と同じ形"""
+    tokens = sorted(set(tokenize(query)))
+    if not tokens:
+        return []
+    match = ' '.join(f'"{token}"' for token in tokens)
+    owner = _owner()
+    parts, params = [], []
+    if scope in ('all', 'documents'):
+        parts.append(_SEARCH_DOCUMENTS)
+        params += [match, owner]
+    if scope in ('all', 'chats'):
+        parts.append(_SEARCH_MESSAGES)
+        params += [match, owner]
+    if not parts:
+        return []
+
+    with _pool.connection() as con:
+        hits = _rows(con.execute(' UNION ALL '.join(parts) + _SEARCH_ORDER, params + [limit, offset]))
+        if not hits:
+            return []
+        # スニペットは返すページの行だけで作る
+        doc_ids = sorted({hit['document_id'] for hit in hits})
+        documents = {row['id']: row for row in _rows(con.execute(
+            f"SELECT id, title, content, updated_at FROM documents WHERE id IN ({','.join('?' * len(doc_ids))})",
+            doc_ids,
+        ))}
+        message_ids = [hit['message_id'] for hit in hits if hit['message_id'] is not None]
+        messages = {}
+        if message_ids:
+            messages = {row['id']: row for row in _rows(con.execute(
+                f"SELECT id, role, content FROM chat_messages WHERE id IN ({','.join('?' * len(message_ids))})",
+                message_ids,
+            ))}
+
+    results = []
+    for hit in hits:
+        document = documents.get(hit['document_id'])
+        if document is None:
+            continue
+        message = messages.get(hit['message_id']) if hit['message_id'] is not None else None
+        body = message['content'] if message else _plain_text(document['content'])
+        results.append({
+            'kind': hit['kind'],
+            'document_id': hit['document_id'],
+            'title': document['title'],
+            'message_id': hit['message_id'],
+            'role': message['role'] if message else None,
+            'snippet': _snippet(body, tokens),
+            'rank': -hit['score'],
+            'updated_at': hit['updated_at'],
+            'document_updated_at': document['updated_at'],
+        })
+    return results
+
+def _snippet(body, tokens, width=SNIPPET_CHARS):
+    """検索語が最初に現れる位置の前後を切り出す (Postgres の search_snippet と同じ)"""
+    body = ' '.join((body or '').split())
+    lowered = body.lower()
+    positions = [p for p in (lowered.find(token) for token in tokens) if p >= 0]
+    start = max(min(positions, default=0) - width // 4, 0)
+    return ('…' if start > 0 else '') + body[start:start + width] + ('…' if len(body) > start + width else '')
+
+def clear_document_cache():
+    """互換のための関数 (SQLite ではドキュメントキャッシュを使わない)"""
+
+# ---------------- チャットメッセージ ----------------
+
+def _message_columns(columns):
+    """PostgREST の select 形式の列指定 ('*' または 'id, role, ...') を検証して SQL に使う"""
+    if columns == '*':
+        return '*'
+    names = [name.strip() for name in columns.split(',')]
+    unknown = [name for name in names if name not in _CHAT_MESSAGE_FIELDS]
+    if unknown:
+        raise ValueError(f"chat_messages に無い列です: {', '.join(unknown)}")
+    return ', '.join(names)
+
+def get_chat_messages(doc_id, limit=None, before_id=None, after_id=None, after_timestamp=None,
+                      offset=0, columns='*'):
+    """指定ドキュメントのチャット履歴 (昇順)。引数は database.get_chat_messages と同じ"""
+    sql = f"SELECT {_message_columns(columns)} FROM chat_messages WHERE document_id = ? AND user_id IS ?"
+    params = [doc_id, _owner()]
+    if before_id is not None:
+        sql += " AND id < ?"
+        params.append(before_id)
+    if after_id is not None:
+        sql += " AND id > ?"
+        params.append(after_id)
+    if after_timestamp is not None:
+        sql += " AND timestamp > ?"
+        params.append(after_timestamp)
+
+    forward = limit is None or after_id is not None or after_timestamp is not None
+    sql += " ORDER BY timestamp, id" if forward else " ORDER BY timestamp DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
+    messages = _query(sql, params)
+    if not forward:
+        messages.reverse()
+    return messages
+
+def get_recent_chat_messages(doc_id, limit):
+    """直近 limit 件のチャット履歴（昇順）。プロンプト用の列のみ取得する。"""
+    return get_chat_messages(doc_id, limit=limit, columns=CHAT_MESSAGE_COLUMNS)
+
+def create_chat_message(document_id, role, content, model_used=None, thinking_enabled=False, user_id=None):
+    row = chat_message_row(document_id, role, content, model_used, thinking_enabled, user_id)
+    owner = _writer()
+    with _transaction() as con:
+        message_id = _insert_message(con, row, owner)
+        return _rows(con.execute("SELECT * FROM chat_messages WHERE id = ?", (message_id,)))[0]
+
+def create_chat_messages(rows):
+    """複数のメッセージ (chat_message_row の dict) を 1 つのトランザクションで挿入する"""
+    if not rows:
+        return
+    owner = _writer()
+    with _transaction() as con:
+        for row in rows:
+            _insert_message(con, row, owner)
+
+def delete_chat_messages(document_id):
+    """指定ドキュメントIDに紐づくチャットメッセージを削除して削除件数を返す"""
+    owner = _writer()
+    with _transaction() as con:
+        con.execute(_UNINDEX_DOCUMENT_MESSAGES, (document_id, owner))
+        return con.execute(_DELETE_MESSAGES, (document_id, owner)).rowcount
+
+def begin_chat_turn(doc_id, user_message, model_name=None, thinking_enabled=False, history_limit=25):
+    """
+    チャット 1 ターンの開始 (1 トランザクション)。戻り値は database.begin_chat_turn と同じ
+    {'document', 'messages', 'summary', 'user_message_id'}。ドキュメントが無ければ何も保存せず None。
+    """
+    owner = _writer()
+    with _transaction() as con:
+        documents = _rows(con.execute(_SELECT_DOCUMENT, (doc_id, owner)))
+        if not documents:
+            return None
+        history = _rows(con.execute(
+            f"SELECT {CHAT_MESSAGE_COLUMNS} FROM chat_messages WHERE document_id = ? AND user_id IS ? "
+            "ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (doc_id, owner, history_limit),
+        ))
+        history.reverse()
+        summaries = _rows(con.execute(_SELECT_SUMMARY, (doc_id, owner)))
+        message_id = _insert_message(
+            con, chat_message_row(doc_id, 'user', user_message, model_name, thinking_enabled, owner), owner
+        )
+    return {
+        'document': documents[0],
+        'messages': history,
+        'summary': summaries[0] if summaries else None,
+        'user_message_id': message_id,
+    }
+
+# ---------------- 会話の要約 (chat_summaries) ----------------
+
+def get_chat_summary(doc_id):
+    """ドキュメントの会話要約行。無ければ None"""
+    rows = _query(_SELECT_SUMMARY, (doc_id, _owner()))
+    return rows[0] if rows else None
+
+def upsert_chat_summary(doc_id, summary, last_message_id, user_id=None):
+    """
+    会話要約を作成または更新する。
+    last_message_id のメッセージが削除済み (要約中にチャット履歴がリセットされた) なら保存せず None を返す。
+    """
+    owner = _writer()
+    with _transaction() as con:
+        rows = _rows(con.execute(_UPSERT_SUMMARY, (
+            doc_id, user_id or owner, summary, last_message_id, _now(), doc_id, owner,
+            last_message_id, doc_id, owner,
+        )))
+    return rows[0] if rows else None
+
+def delete_chat_summary(doc_id):
+    """会話要約を削除する (チャット履歴リセット時)"""
+    owner = _writer()
+    with _transaction() as con:
+        con.execute(_DELETE_SUMMARY, (doc_id, owner))
@@ -0,0 +1,52 @@
+"""
+ストレージのバックエンドの切り替え。コントローラーやユーティリティはこのモジュールから import する。
+
+STORAGE_BACKEND:
+• supabase (既定) : app/models/database.py (PostgREST 経由。RLS・RPC は supabase/migrations)
+• sqlite          : app/models/sqlite_storage.py (組み込み SQLite。単一ノードのセルフホスト・負荷試験向け)
+どちらも同じ名前・引数・戻り値の関数を持つ。認証 (JWT の検証) はどちらでも Supabase Auth を使う。
+"""
+import importlib
+import os
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'supabase').lower()
+
+_BACKEND_MODULES = {
+    'supabase': 'app.models.database',
+    'sqlite': 'app.models.sqlite_storage',
+}
+
+if STORAGE_BACKEND not in _BACKEND_MODULES:
+    raise RuntimeError(
+        f"STORAGE_BACKEND={STORAGE_BACKEND} は使用できません ({' / '.join(_BACKEND_MODULES)} のいずれか)"
+    )
+
+_backend = importlib.import_module(_BACKEND_MODULES[STORAGE_BACKEND])
+
+# 例外・行の組み立て・並行実行はバックエンド共通 (database.py で定義)
+from app.models.database import DocumentVersionConflict, chat_message_row, run_concurrently  # noqa: E402
+
+# ドキュメント
+get_documents = _backend.get_documents
+get_latest_document_id = _backend.get_latest_document_id
+get_document = _backend.get_document
+document_exists = _backend.document_exists
+create_document = _backend.create_document
+update_document = _backend.update_document
+apply_document_delta = _backend.apply_document_delta
+delete_document = _backend.delete_document
+search_documents = _backend.search_documents
+clear_document_cache = _backend.clear_document_cache
+
+# チャットメッセージ
+get_chat_messages = _backend.get_chat_messages
+get_recent_chat_messages = _backend.get_recent_chat_messages
+create_chat_message = _backend.create_chat_message
+create_chat_messages = _backend.create_chat_messages
+delete_chat_messages = _backend.delete_chat_messages
+begin_chat_turn = _backend.begin_chat_turn
+
+# 会話の要約
+get_chat_summary = _backend.get_chat_summary
+upsert_chat_summary = _backend.upsert_chat_summary
+delete_chat_summary = _backend.delete_chat_summary
@@ -1,5 +1,9 @@
-from supabase import create_client  
+from postgrest import SyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+import httpx
 import os  
+import threading
+from collections import OrderedDict
   
 # --- 環境変数の取得 --- #
 url = os.getenv("SUPABASE_URL")
@@ -16,7 +20,97 @@ if not key or not url:
           "ANON present:", bool(os.getenv("SUPABASE_ANON_KEY")),
           "SERVICE_ROLE present:", bool(os.getenv("SUPABASE_SERVICE_ROLE_KEY")))
 
-supabase = create_client(url, key)  
+# JWT を持たない呼び出し用の共有クライアント (get_supabase で初回使用時に生成)。
+# ユーザー毎の認証ヘッダーは PostgREST セッションプール (get_postgrest_session) 側で持ち、
+# この共有クライアントの認証状態 (postgrest.auth) は書き換えない。
+# supabase パッケージは storage / realtime なども読み込み import が重いため、
+# リクエストの大半 (JWT 付き) では import しない。
+_supabase_client = None
+_supabase_lock = threading.Lock()
+
+# --- PostgREST セッションプールの設定 --- #
+# 保持するユーザー (JWT) 毎のセッション数。超えたら最も古く使われたものから破棄
+POSTGREST_SESSION_POOL_SIZE = int(os.getenv("POSTGREST_SESSION_POOL_SIZE", "256"))
+# 全セッションで共有する HTTP コネクションプールの上限
+POSTGREST_MAX_CONNECTIONS = int(os.getenv("POSTGREST_MAX_CONNECTIONS", "50"))
+POSTGREST_MAX_KEEPALIVE = int(os.getenv("POSTGREST_MAX_KEEPALIVE", "20"))
+POSTGREST_TIMEOUT = float(os.getenv("POSTGREST_TIMEOUT", "120"))
+
+_http_client = None
+_http_lock = threading.Lock()
+
+def _shared_http_client():
+    """ユーザー毎の PostgREST セッションで共有する HTTP コネクションプール (スレッドセーフ)"""
+    global _http_client
+    if _http_client is None:
+        with _http_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(
+                    timeout=POSTGREST_TIMEOUT,
+                    follow_redirects=True,
+                    limits=httpx.Limits(max_connections=POSTGREST_MAX_CONNECTIONS,
+                                        max_keepalive_connections=POSTGREST_MAX_KEEPALIVE),
+                )
+    return _http_client
+
+def create_postgrest_session(jwt_token):
+    """
+    jwt_token の権限 (RLS) で PostgREST にアクセスするセッション。
+    認証ヘッダーはセッション毎に持ち、HTTP コネクションは全セッションで共有する。
+    """
+    return SyncPostgrestClient(
+        f"{url}/rest/v1",
+        headers={
+            **DEFAULT_POSTGREST_CLIENT_HEADERS,
+            "apikey": key,
+            "Authorization": f"Bearer {jwt_token}",
+        },
+        http_client=_shared_http_client(),
+    )
+
+
+class PostgrestSessionPool:
+    """
+    JWT 毎の PostgREST セッションを LRU で保持する。
+    セッションは認証ヘッダーだけを持つ軽量なオブジェクトで、HTTP コネクションは共有プールを使うため、
+    破棄時に接続を閉じる必要はない。同じユーザーの連続したリクエストはセッションを使い回す。
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, jwt_token):
+        with self._lock:
+            session = self._sessions.get(jwt_token)
+            if session is not None:
+                self._sessions.move_to_end(jwt_token)
+                return session
+        session = create_postgrest_session(jwt_token)
+        with self._lock:
+            self._sessions[jwt_token] = session
+            self._sessions.move_to_end(jwt_token)
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+        return session
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+
+_session_pool = PostgrestSessionPool(POSTGREST_SESSION_POOL_SIZE)
+
+def get_postgrest_session(jwt_token):
+    """jwt_token 用の PostgREST セッションをプールから取得する"""
+    return _session_pool.get(jwt_token)
   
 def get_supabase():  
-    return supabase
\ No newline at end of file
+    global _supabase_client
+    if _supabase_client is None:
+        with _supabase_lock:
+            if _supabase_client is None:
+                from supabase import create_client
+                _supabase_client = create_client(url, key)
+    return _supabase_client
\ No newline at end of file
@@ -8,6 +8,10 @@ let thinkingEnabled = false;
 let currentChatContext = null; // 追加されたコンテキストテキストを保持する変数
 let attachedImageBase64 = null; // ★ 添付画像のBase64データを保持
 let attachedImageMimeType = null; // ★ 添付画像のMIMEタイプを保持
+let chatSocket = null; // ストリーミング応答用の SocketIO 接続 (未接続時は HTTP にフォールバック)
+const CHAT_HISTORY_PAGE_SIZE = 50; // チャット履歴を1回に読み込む件数
+const CHAT_JOB_POLL_INITIAL_MS = 1000; // ジョブモードの応答を確認する最初の間隔
+const CHAT_JOB_POLL_MAX_MS = 5000; // ジョブモードの応答を確認する間隔の上限
 
 // DOMが読み込まれた後に実行
 document.addEventListener('DOMContentLoaded', function() {
@@ -32,8 +36,21 @@ document.addEventListener('DOMContentLoaded', function() {
     setupChatInputAutoResize(); // ★ 新しい関数呼び出しを追加
     updateSearchToggleVisibility(); // ★ 初期表示時のチェックボックス表示更新を追加
     setupImageAttachment(); // ★ 画像添付関連のイベント設定を追加
+    setupChatSocket(); // ストリーミング応答用の SocketIO 接続
 });
 
+/**
+ * ストリーミング応答用の SocketIO 接続を開始
+ * socket.io クライアントが読み込まれていない環境では何もしない
+ */
+function setupChatSocket() {
+    if (typeof io === 'undefined') return;
+    chatSocket = io();
+    chatSocket.on('connect_error', (error) => {
+        console.warn('SocketIO に接続できません。HTTP で送信します:', error);
+    });
+}
+
 /**
  * チャット関連のイベントを設定
  */
@@ -117,23 +134,58 @@ function sendChatMessage() {
     const loadingElement = createLoadingIndicator();
     document.getElementById('chat-messages').appendChild(loadingElement);
     
-    const contextToSend = currentChatContext;
-    const enableSearch = document.getElementById('enable-search-checkbox').checked;
+    const payload = {
+        message: messageToSend,
+        model: currentChatModel,
+        thinking_enabled: thinkingEnabled,
+        chat_context: currentChatContext,
+        enable_search: document.getElementById('enable-search-checkbox').checked,
+        image_data: imageBase64ToSend, // ★ 画像データ (Base64)
+        image_mime_type: imageMimeTypeToSend // ★ 画像MIMEタイプ
+    };
     
+    if (chatSocket && chatSocket.connected) {
+        sendChatMessageStreaming(documentId, payload, loadingElement);
+    } else {
+        sendChatMessageHttp(documentId, payload, loadingElement);
+    }
+}
+
+/**
+ * 送信成功時に入力欄と添付画像をリセット
+ */
+function resetChatInputAfterSend() {
+    const chatInput = document.getElementById('chat-input');
+    chatInput.value = '';
+    removeAttachedImage();
+    // ★ 送信成功後にテキストエリアの高さをリセット
+    chatInput.style.height = 'auto'; // 高さを自動に戻す
+}
+
+/**
+ * ローディングインジケータを取り除く
+ * @param {HTMLElement} loadingElement - ローディングインジケータ要素
+ */
+function removeLoadingIndicator(loadingElement) {
+    if (loadingElement && loadingElement.parentNode) {
+        loadingElement.parentNode.removeChild(loadingElement);
+    }
+}
+
+/**
+ * /api/chat/send に POST し、応答全体を受け取ってから表示する
+ * サーバーがジョブモード (CHAT_JOBS=1) の場合は job_id が返るため、完了を待ってから表示する
+ * @param {number} documentId - ドキュメントID
+ * @param {object} payload - 送信データ
+ * @param {HTMLElement} loadingElement - ローディングインジケータ要素
+ */
+function sendChatMessageHttp(documentId, payload, loadingElement) {
     fetch(`/api/chat/send/${documentId}`, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json'
         },
-        body: JSON.stringify({
-            message: messageToSend,
-            model: currentChatModel,
-            thinking_enabled: thinkingEnabled,
-            chat_context: contextToSend,
-            enable_search: enableSearch,
-            image_data: imageBase64ToSend, // ★ 画像データ (Base64)
-            image_mime_type: imageMimeTypeToSend // ★ 画像MIMEタイプ
-        })
+        body: JSON.stringify(Object.assign({ job: true }, payload))
     })
     .then(response => {
         if (!response.ok) {
@@ -141,17 +193,13 @@ function sendChatMessage() {
         }
         return response.json();
     })
+    .then(data => data.job_id ? waitForChatJob(data.job_id) : data)
     .then(data => {
-        if (loadingElement && loadingElement.parentNode) {
-            loadingElement.parentNode.removeChild(loadingElement);
-        }
+        removeLoadingIndicator(loadingElement);
         if (data.success) {
             addMessageToChat('assistant', data.message, data.sources);
             // ★ 送信成功時にUIをリセット
-            chatInput.value = '';
-            removeAttachedImage();
-            // ★ 送信成功後にテキストエリアの高さをリセット
-            chatInput.style.height = 'auto'; // 高さを自動に戻す
+            resetChatInputAfterSend();
         } else {
             addMessageToChat('assistant', data.message || 'エラーが発生しました。');
             // ★ エラー時は入力内容を保持する
@@ -162,9 +210,7 @@ function sendChatMessage() {
     })
     .catch(error => {
         console.error('チャットエラー:', error);
-        if (loadingElement && loadingElement.parentNode) {
-            loadingElement.parentNode.removeChild(loadingElement);
-        }
+        removeLoadingIndicator(loadingElement);
         addMessageToChat('assistant', 'エラーが発生しました。しばらく経ってからもう一度お試しください。');
         scrollChatToBottom();
         clearContext();
@@ -172,17 +218,154 @@ function sendChatMessage() {
 }
 
 /**
- * チャット履歴を読み込む
+ * ジョブモードの /api/chat/send の完了を待ち、/send と同じ形の応答で resolve する
+ * SocketIO に接続していれば 'chat_job_done' で通知を受け、取りこぼしに備えて /api/chat/job もポーリングする
+ * @param {string} jobId - ジョブID
+ * @returns {Promise<object>} ジョブの結果
+ */
+function waitForChatJob(jobId) {
+    return new Promise((resolve, reject) => {
+        const socketConnected = chatSocket && chatSocket.connected;
+        let finished = false;
+        let pollTimer = null;
+        let delay = CHAT_JOB_POLL_INITIAL_MS;
+
+        const finish = () => {
+            finished = true;
+            clearTimeout(pollTimer);
+            if (socketConnected) chatSocket.off('chat_job_done', onJobDone);
+        };
+
+        const onJobDone = (data) => {
+            if (finished || data.job_id !== jobId) return;
+            finish();
+            resolve(data);
+        };
+
+        const poll = () => {
+            fetch(`/api/chat/job/${jobId}`)
+                .then(response => {
+                    if (!response.ok) {
+                        throw new Error('ジョブの状態を取得できませんでした');
+                    }
+                    return response.json();
+                })
+                .then(data => {
+                    if (finished) return;
+                    if (data.state === 'done' || data.state === 'error') {
+                        finish();
+                        resolve(data);
+                        return;
+                    }
+                    delay = Math.min(delay * 2, CHAT_JOB_POLL_MAX_MS);
+                    pollTimer = setTimeout(poll, delay);
+                })
+                .catch(error => {
+                    if (finished) return;
+                    finish();
+                    reject(error);
+                });
+        };
+
+        if (socketConnected) {
+            chatSocket.on('chat_job_done', onJobDone);
+            chatSocket.emit('chat_job_subscribe', {
+                job_id: jobId,
+                access_token: localStorage.getItem('access_token')
+            });
+        }
+        pollTimer = setTimeout(poll, socketConnected ? CHAT_JOB_POLL_MAX_MS : delay);
+    });
+}
+
+/**
+ * SocketIO の 'chat_send' で送信し、生成中のテキストを逐次表示する
+ * 認証エラー (トークン期限切れ) の場合はトークンを更新できる HTTP 送信にフォールバックする
+ * @param {number} documentId - ドキュメントID
+ * @param {object} payload - 送信データ
+ * @param {HTMLElement} loadingElement - ローディングインジケータ要素
+ */
+function sendChatMessageStreaming(documentId, payload, loadingElement) {
+    const requestId = `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    const chatMessages = document.getElementById('chat-messages');
+    let streamingElement = null;
+    let streamingContent = null;
+    let streamedText = '';
+
+    const cleanup = () => {
+        chatSocket.off('chat_token', onToken);
+        chatSocket.off('chat_done', onDone);
+        chatSocket.off('chat_error', onError);
+        removeLoadingIndicator(loadingElement);
+        if (streamingElement && streamingElement.parentNode) {
+            streamingElement.parentNode.removeChild(streamingElement);
+        }
+    };
+
+    const onToken = (data) => {
+        if (data.request_id !== requestId) return;
+        if (!streamingElement) {
+            removeLoadingIndicator(loadingElement);
+            streamingElement = document.createElement('div');
+            streamingElement.className = 'chat-message assistant-message';
+            streamingContent = document.createElement('div');
+            streamingContent.className = 'message-content';
+            streamingElement.appendChild(streamingContent);
+            chatMessages.appendChild(streamingElement);
+        }
+        // 生成中はプレーンテキストで表示し、完了時に Markdown で描画し直す
+        streamedText += data.delta;
+        streamingContent.textContent = streamedText;
+        scrollChatToBottom();
+    };
+
+    const onDone = (data) => {
+        if (data.request_id !== requestId) return;
+        cleanup();
+        addMessageToChat('assistant', data.message, data.sources);
+        resetChatInputAfterSend();
+        scrollChatToBottom();
+        clearContext();
+    };
+
+    const onError = (data) => {
+        if (data.request_id !== requestId) return;
+        if (data.status === 401) {
+            chatSocket.off('chat_token', onToken);
+            chatSocket.off('chat_done', onDone);
+            chatSocket.off('chat_error', onError);
+            sendChatMessageHttp(documentId, payload, loadingElement);
+            return;
+        }
+        cleanup();
+        addMessageToChat('assistant', data.message || 'エラーが発生しました。');
+        scrollChatToBottom();
+        clearContext();
+    };
+
+    chatSocket.on('chat_token', onToken);
+    chatSocket.on('chat_done', onDone);
+    chatSocket.on('chat_error', onError);
+    chatSocket.emit('chat_send', Object.assign({
+        doc_id: documentId,
+        request_id: requestId,
+        access_token: localStorage.getItem('access_token')
+    }, payload));
+}
+
+/**
+ * チャット履歴を読み込む (最新ページのみ。古いメッセージは「さらに読み込む」で遅延取得)
  * @param {number} documentId - ドキュメントID
  */
 function loadChatHistory(documentId) {
-    fetch(`/api/chat/history/${documentId}`)
+    fetch(`/api/chat/history/${documentId}?limit=${CHAT_HISTORY_PAGE_SIZE}`)
         .then(response => response.json())
-        .then(messages => {
+        .then(page => {
             // チャットエリアをクリア
             const chatMessages = document.getElementById('chat-messages');
             chatMessages.innerHTML = '';
             
+            const messages = page.messages || [];
             // メッセージがない場合は何もしない
             if (messages.length === 0) return;
             
@@ -190,6 +373,7 @@ function loadChatHistory(documentId) {
             messages.forEach(msg => {
                 addMessageToChat(msg.role, msg.content);
             });
+            updateLoadOlderButton(documentId, page);
             
             // チャットエリアを最下部にスクロール
             scrollChatToBottom();
@@ -199,6 +383,67 @@ function loadChatHistory(documentId) {
         });
 }
 
+/**
+ * 表示中より古いチャット履歴を1ページ読み込み、先頭に追加する
+ * @param {number} documentId - ドキュメントID
+ * @param {number} beforeId - このIDより古いメッセージを取得する
+ */
+function loadOlderChatMessages(documentId, beforeId) {
+    fetch(`/api/chat/history/${documentId}?limit=${CHAT_HISTORY_PAGE_SIZE}&before_id=${beforeId}`)
+        .then(response => response.json())
+        .then(page => {
+            const chatMessages = document.getElementById('chat-messages');
+            const previousHeight = chatMessages.scrollHeight;
+            const previousTop = chatMessages.scrollTop;
+            removeLoadOlderButton();
+            const anchor = chatMessages.firstChild;
+
+            // addMessageToChat は末尾に追加するので、追加された要素を anchor の前へ移動する
+            (page.messages || []).forEach(msg => {
+                const countBefore = chatMessages.children.length;
+                addMessageToChat(msg.role, msg.content);
+                if (chatMessages.children.length > countBefore) {
+                    chatMessages.insertBefore(chatMessages.lastElementChild, anchor);
+                }
+            });
+            updateLoadOlderButton(documentId, page);
+
+            // 読んでいた位置を維持する
+            chatMessages.scrollTop = previousTop + (chatMessages.scrollHeight - previousHeight);
+        })
+        .catch(error => {
+            console.error('過去のチャット履歴の読み込みに失敗しました:', error);
+        });
+}
+
+/**
+ * 過去ページがあれば「さらに読み込む」ボタンを履歴の先頭に表示する
+ * @param {number} documentId - ドキュメントID
+ * @param {object} page - /api/chat/history のページレスポンス
+ */
+function updateLoadOlderButton(documentId, page) {
+    removeLoadOlderButton();
+    if (!page.has_more || !page.next_before_id) return;
+
+    const chatMessages = document.getElementById('chat-messages');
+    const button = document.createElement('button');
+    button.id = 'load-older-chat-btn';
+    button.className = 'load-older-btn';
+    button.textContent = '過去のメッセージを読み込む';
+    button.addEventListener('click', () => loadOlderChatMessages(documentId, page.next_before_id));
+    chatMessages.insertBefore(button, chatMessages.firstChild);
+}
+
+/**
+ * 「さらに読み込む」ボタンを取り除く
+ */
+function removeLoadOlderButton() {
+    const button = document.getElementById('load-older-chat-btn');
+    if (button && button.parentNode) {
+        button.parentNode.removeChild(button);
+    }
+}
+
 /**
  * メッセージをチャットUIに追加
  * @param {string} role - メッセージの送信者のロール ('user' または 'assistant')
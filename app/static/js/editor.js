@@ -7,6 +7,12 @@ let editor;
 let currentDocumentId = null;
 let saveTimeout = null;
 const AUTO_SAVE_DELAY = 2000; // 自動保存の遅延時間（ミリ秒）
+// 差分保存: 前回保存以降の変更 (Quill Delta) だけを PATCH で送る
+let currentDocumentVersion = null; // サーバー上の version (null なら全文を PUT で保存)
+let pendingDelta = null; // 未保存の変更
+let savedContents = null; // サーバー上の version (currentDocumentVersion) の内容。競合時の取り込みに使う
+let saveInFlight = false; // 保存リクエスト送信中
+let saveQueued = false; // 送信中に保存が要求された
 const EDITOR_FONT_SIZE_KEY = 'editorFontSizePreference'; // LocalStorageキー
 
 // DOMが読み込まれた後に実行
@@ -159,8 +165,9 @@ function initEditor() {
     // --- ボタンの動的生成 ここまで ---
 
     // エディタの変更を検知して自動保存
-    editor.on('text-change', function() {
+    editor.on('text-change', function(delta) {
         updateSaveStatus('保存中...');
+        pendingDelta = pendingDelta ? pendingDelta.compose(delta) : delta;
         
         // エディタの内容が変更されたら、新規作成済みフラグをクリア
         sessionStorage.removeItem('emptyDocumentCreated');
@@ -354,6 +361,8 @@ function loadDocument(docId) {
                 console.error('ドキュメント内容の解析に失敗しました:', err);
                 editor.setContents([]);
             }
+            // 読み込んだ内容はサーバーと同じなので未保存の変更として扱わない
+            resetPendingChanges(docData.version);
             
             // URLを更新（既に正しいURLのはずだが念のため）
             window.history.pushState({}, '', `/?id=${docData.id}`);
@@ -378,6 +387,7 @@ function loadDocument(docId) {
             editor.setContents([]);
             document.getElementById('document-title').value = '';
             currentDocumentId = null;
+            resetPendingChanges(null);
             localStorage.removeItem('lastActiveDocumentId');
         });
 }
@@ -420,6 +430,7 @@ function createNewDocument() {
         // タイトルとエディタの内容を設定
         document.getElementById('document-title').value = docData.title;
         editor.setContents([]);
+        resetPendingChanges(docData.version);
         
         // URLを更新
         window.history.pushState({}, '', `/?id=${docData.id}`);
@@ -446,11 +457,30 @@ function createNewDocument() {
         editor.setContents([]);
         document.getElementById('document-title').value = '';
         currentDocumentId = null;
+        resetPendingChanges(null);
     });
 }
 
+/**
+ * 未保存の変更を破棄し、サーバー上の version と内容を記録する
+ * (ドキュメントの読み込み・新規作成直後、エディタに内容を設定してから呼ぶ)
+ * @param {number|null} version - サーバー上の version (未対応の場合は null)
+ */
+function resetPendingChanges(version) {
+    const Delta = Quill.import('delta');
+    pendingDelta = new Delta();
+    currentDocumentVersion = (typeof version === 'number') ? version : null;
+    savedContents = editor.getContents();
+    if (saveTimeout) {
+        clearTimeout(saveTimeout);
+        saveTimeout = null;
+    }
+}
+
 /**
  * 現在のドキュメントを保存
+ * version が分かっていれば前回保存以降の変更 (Delta) だけを PATCH で送り、分からない場合は全文を PUT で保存する。
+ * 他の場所で先に更新されていた場合は、サーバーの内容に未保存の変更を取り込み直してから送る。
  */
 function saveDocument() {
     if (!currentDocumentId) {
@@ -458,12 +488,139 @@ function saveDocument() {
         updateSaveStatus('保存エラー: ドキュメントIDがありません');
         return;
     }
+    // 保存は 1 件ずつ順番に送る (version の整合性を保つため)
+    if (saveInFlight) {
+        saveQueued = true;
+        return;
+    }
+
+    const docId = currentDocumentId;
+    let request;
+    if (currentDocumentVersion === null) {
+        request = saveFullDocument(docId);
+    } else if (!pendingDelta || pendingDelta.ops.length === 0) {
+        updateSaveStatus('保存済み');
+        return;
+    } else {
+        request = saveDocumentDelta(docId);
+    }
+
+    saveInFlight = true;
+    request.finally(() => {
+        saveInFlight = false;
+        if (saveQueued) {
+            saveQueued = false;
+            saveDocument();
+        }
+    });
+}
+
+/**
+ * 前回保存以降の変更 (Delta) を PATCH で送る
+ * @param {number} docId - ドキュメントID
+ */
+function saveDocumentDelta(docId) {
+    const Delta = Quill.import('delta');
+    const sent = pendingDelta;
+    pendingDelta = new Delta();
+
+    console.log('ドキュメントの変更を保存します:', docId, `(${sent.ops.length} ops)`);
+
+    return fetch(`/api/document/${docId}`, {
+        method: 'PATCH',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            base_version: currentDocumentVersion,
+            ops: sent.ops
+        })
+    })
+    .then(response => {
+        if (response.status === 409) {
+            return { conflict: true };
+        }
+        if (!response.ok) {
+            throw new Error('ドキュメントの保存に失敗しました');
+        }
+        return response.json();
+    })
+    .then(result => {
+        if (docId !== currentDocumentId) return;
+        if (result.conflict) {
+            // 他のタブなどで先に更新された: 上書きせず、サーバーの内容に未保存の変更を取り込む
+            console.warn('ドキュメントが他の場所で更新されていました。最新の内容に変更を取り込みます:', docId);
+            return rebaseOnServerVersion(docId, sent);
+        }
+        currentDocumentVersion = result.version;
+        savedContents = savedContents.compose(sent);
+        console.log('ドキュメントが保存されました:', docId, 'version', result.version);
+        updateSaveStatus('保存済み');
+    })
+    .catch(error => {
+        console.error('ドキュメントの保存に失敗しました:', error);
+        updateSaveStatus('保存エラー: ' + error.message);
+        // 送れなかった変更は次回の保存で再送する
+        if (docId === currentDocumentId) {
+            pendingDelta = sent.compose(pendingDelta);
+        }
+    });
+}
+
+/**
+ * PATCH が 409 (他の場所で更新済み) のとき、サーバーの最新の内容を取得し、
+ * 未保存の変更 (sent + pendingDelta) をその上に載せ直す (サーバー側の変更を優先)。
+ * エディタにはサーバー側の変更だけを反映し、載せ直した変更は次の PATCH で送る。
+ * @param {number} docId - ドキュメントID
+ * @param {Delta} sent - 409 になった PATCH で送った変更
+ */
+function rebaseOnServerVersion(docId, sent) {
+    const Delta = Quill.import('delta');
+    return fetch(`/api/document/${docId}`)
+    .then(response => {
+        if (!response.ok) {
+            throw new Error('最新のドキュメントの取得に失敗しました');
+        }
+        return response.json();
+    })
+    .then(docData => {
+        if (docId !== currentDocumentId) return;
+        const serverContents = new Delta(docData.content ? JSON.parse(docData.content) : []);
+        const local = sent.compose(pendingDelta);
+        const serverChange = savedContents.diff(serverContents);
+
+        editor.updateContents(local.transform(serverChange, false), 'silent');
+        savedContents = serverContents;
+        currentDocumentVersion = (typeof docData.version === 'number') ? docData.version : null;
+        pendingDelta = serverChange.transform(local, true);
+        if (pendingDelta.ops.length > 0) {
+            saveQueued = true;
+        }
+        updateSaveStatus('他の場所での変更を取り込みました');
+    })
+    .catch(error => {
+        console.error('他の場所での変更の取り込みに失敗しました:', error);
+        updateSaveStatus('保存エラー: 他の場所で更新されています。再読み込みしてください');
+        // 変更は破棄せず残しておく (次回の保存で再試行する)
+        if (docId === currentDocumentId) {
+            pendingDelta = sent.compose(pendingDelta);
+        }
+    });
+}
+
+/**
+ * ドキュメントの内容全体を PUT で保存する
+ * @param {number} docId - ドキュメントID
+ */
+function saveFullDocument(docId) {
+    console.log('ドキュメントを保存します:', docId);
     
-    console.log('ドキュメントを保存します:', currentDocumentId);
-    
-    const content = JSON.stringify(editor.getContents());
+    const Delta = Quill.import('delta');
+    const contents = editor.getContents();
+    const content = JSON.stringify(contents);
+    pendingDelta = new Delta();
     
-    fetch(`/api/document/${currentDocumentId}`, {
+    return fetch(`/api/document/${docId}`, {
         method: 'PUT',
         headers: {
             'Content-Type': 'application/json'
@@ -479,12 +636,20 @@ function saveDocument() {
         return response.json();
     })
     .then(result => {
-        console.log('ドキュメントが保存されました:', currentDocumentId);
+        console.log('ドキュメントが保存されました:', docId);
+        if (docId === currentDocumentId) {
+            currentDocumentVersion = (typeof result.version === 'number') ? result.version : null;
+            savedContents = contents;
+        }
         updateSaveStatus('保存済み');
     })
     .catch(error => {
         console.error('ドキュメントの保存に失敗しました:', error);
         updateSaveStatus('保存エラー: ' + error.message);
+        // 次回も全文を保存する
+        if (docId === currentDocumentId) {
+            currentDocumentVersion = null;
+        }
     });
 }
 
@@ -602,6 +767,7 @@ function loadLatestDocumentOrShowEmpty() {
                     editor.setContents([]);
                     document.getElementById('document-title').value = '';
                     currentDocumentId = null;
+                    resetPendingChanges(null);
                     updateSaveStatus('新規作成をスキップしました');
                 } else {
                     // 新規ドキュメントを作成し、フラグをセット
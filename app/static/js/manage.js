@@ -8,14 +8,26 @@ document.addEventListener('DOMContentLoaded', function() {
     setupEventListeners();
 });
 
+const DOCUMENT_LIST_PAGE_SIZE = 60; // 一覧を1回に読み込む件数
+let nextDocumentCursor = null; // 続きを読み込むためのカーソル {updated_at, id}
+const DOCUMENT_SEARCH_PAGE_SIZE = 20; // 検索結果を1回に読み込む件数
+const DOCUMENT_SEARCH_DELAY_MS = 300; // 入力が止まってから検索するまでの待ち時間
+// 検索中の状態 {query, nextOffset, shownIds}。null なら通常の一覧を表示中
+let currentSearch = null;
+let searchTimer = null;
+let searchSequence = 0; // 古い検索の応答を無視するための連番
+
 /**
- * 全てのドキュメントを読み込んで表示
+ * ドキュメント一覧の最初のページを読み込んで表示
  */
 function loadDocuments() {
-    fetch('/api/document/list')
-        .then(response => response.json())
-        .then(documents => {
-            renderDocuments(documents);
+    const sequence = ++searchSequence;
+    fetchDocumentPage(null)
+        .then(page => {
+            if (sequence !== searchSequence) return;
+            renderDocuments(page.documents);
+            nextDocumentCursor = page.has_more ? page.next_cursor : null;
+            updateLoadMoreButton(!!nextDocumentCursor);
         })
         .catch(error => {
             console.error('ドキュメント一覧の取得に失敗しました:', error);
@@ -23,6 +35,180 @@ function loadDocuments() {
         });
 }
 
+/**
+ * 続きのページを読み込んでグリッドの末尾に追加
+ */
+function loadMoreDocuments() {
+    if (currentSearch) {
+        loadMoreSearchResults();
+        return;
+    }
+    if (!nextDocumentCursor) return;
+    const button = document.getElementById('load-more-docs-btn');
+    if (button) button.disabled = true;
+
+    const sequence = searchSequence;
+    fetchDocumentPage(nextDocumentCursor)
+        .then(page => {
+            if (sequence !== searchSequence) return;
+            const grid = document.getElementById('documents-grid');
+            page.documents.forEach(doc => {
+                grid.appendChild(createDocumentCard(doc));
+            });
+            nextDocumentCursor = page.has_more ? page.next_cursor : null;
+            updateLoadMoreButton(!!nextDocumentCursor);
+            // 現在の並び替え条件を追加分にも適用
+            sortDocuments(document.getElementById('sort-select').value);
+        })
+        .catch(error => {
+            console.error('ドキュメント一覧の取得に失敗しました:', error);
+            showError('ドキュメント一覧の読み込みに失敗しました。もう一度お試しください。');
+        })
+        .finally(() => {
+            if (button) button.disabled = false;
+        });
+}
+
+/**
+ * ドキュメント一覧を1ページ分取得 (本文は取得せずプレビューのみ)
+ * @param {Object|null} cursor - 前ページの next_cursor
+ * @returns {Promise<Object>} {documents, has_more, next_cursor}
+ */
+function fetchDocumentPage(cursor) {
+    const params = new URLSearchParams({ limit: DOCUMENT_LIST_PAGE_SIZE, preview: 1 });
+    if (cursor) {
+        params.set('before_updated_at', cursor.updated_at);
+        params.set('before_id', cursor.id);
+    }
+    return fetch(`/api/document/list?${params.toString()}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('ドキュメント一覧の取得に失敗しました');
+            }
+            return response.json();
+        });
+}
+
+/**
+ * ドキュメントとチャット履歴をサーバー側で全文検索 (1ページ分)
+ * @param {string} query - 検索語
+ * @param {number} offset - 取得開始位置
+ * @returns {Promise<Object>} {results, has_more, next_offset}
+ */
+function fetchSearchPage(query, offset) {
+    const params = new URLSearchParams({ q: query, limit: DOCUMENT_SEARCH_PAGE_SIZE, offset: offset });
+    return fetch(`/api/document/search?${params.toString()}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('ドキュメントの検索に失敗しました');
+            }
+            return response.json();
+        });
+}
+
+/**
+ * 検索ボックスの入力に応じて検索する (入力が止まるまで待つ)
+ * @param {string} value - 検索ボックスの値
+ */
+function scheduleSearch(value) {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => searchDocuments(value.trim()), DOCUMENT_SEARCH_DELAY_MS);
+}
+
+/**
+ * 検索結果の最初のページを表示 (検索語が空なら通常の一覧に戻す)
+ * @param {string} query - 検索語
+ */
+function searchDocuments(query) {
+    if (!query) {
+        currentSearch = null;
+        loadDocuments();
+        return;
+    }
+    const sequence = ++searchSequence;
+    fetchSearchPage(query, 0)
+        .then(page => {
+            if (sequence !== searchSequence) return;
+            currentSearch = { query: query, nextOffset: page.next_offset, shownIds: new Set() };
+            const grid = document.getElementById('documents-grid');
+            grid.innerHTML = '';
+            appendSearchResults(page.results);
+            if (currentSearch.shownIds.size === 0) {
+                grid.innerHTML = '<div class="no-documents">一致するドキュメントがありません。</div>';
+            }
+            updateLoadMoreButton(page.has_more);
+        })
+        .catch(error => {
+            console.error('ドキュメントの検索に失敗しました:', error);
+            showError('ドキュメントの検索に失敗しました。もう一度お試しください。');
+        });
+}
+
+/**
+ * 検索結果の続きを読み込んでグリッドの末尾に追加
+ */
+function loadMoreSearchResults() {
+    if (currentSearch.nextOffset === null) return;
+    const button = document.getElementById('load-more-docs-btn');
+    if (button) button.disabled = true;
+
+    const sequence = searchSequence;
+    fetchSearchPage(currentSearch.query, currentSearch.nextOffset)
+        .then(page => {
+            if (sequence !== searchSequence) return;
+            currentSearch.nextOffset = page.next_offset;
+            appendSearchResults(page.results);
+            updateLoadMoreButton(page.has_more);
+        })
+        .catch(error => {
+            console.error('ドキュメントの検索に失敗しました:', error);
+            showError('ドキュメントの検索に失敗しました。もう一度お試しください。');
+        })
+        .finally(() => {
+            if (button) button.disabled = false;
+        });
+}
+
+/**
+ * 検索結果をドキュメント毎にまとめてカードとして追加
+ * (結果は順位順なので、各ドキュメントの最初の一致箇所をプレビューに表示する)
+ * @param {Array} results - /api/document/search の results
+ */
+function appendSearchResults(results) {
+    const grid = document.getElementById('documents-grid');
+    results.forEach(hit => {
+        if (currentSearch.shownIds.has(hit.document_id)) return;
+        currentSearch.shownIds.add(hit.document_id);
+        grid.appendChild(createDocumentCard({
+            id: hit.document_id,
+            title: hit.title,
+            updated_at: hit.document_updated_at,
+            preview: (hit.kind === 'chat' ? '[チャット] ' : '') + (hit.snippet || ''),
+        }));
+    });
+}
+
+/**
+ * 「さらに読み込む」ボタンの表示を更新
+ * @param {boolean} hasMore - 続きがあるか
+ */
+function updateLoadMoreButton(hasMore) {
+    let button = document.getElementById('load-more-docs-btn');
+    if (!hasMore) {
+        if (button) button.remove();
+        return;
+    }
+    if (!button) {
+        button = document.createElement('button');
+        button.id = 'load-more-docs-btn';
+        button.className = 'load-older-btn';
+        button.textContent = 'さらに読み込む';
+        button.addEventListener('click', loadMoreDocuments);
+        const grid = document.getElementById('documents-grid');
+        grid.parentNode.insertBefore(button, grid.nextSibling);
+    }
+}
+
 /**
  * ドキュメント一覧をグリッドに表示
  * @param {Array} documents - ドキュメントの配列
@@ -61,10 +247,10 @@ function createDocumentCard(doc) {
     const jpDate = new Date(updatedDate.getTime() + (9 * 60 * 60 * 1000));
     const formattedDate = `${jpDate.getFullYear()}-${(jpDate.getMonth()+1).toString().padStart(2, '0')}-${jpDate.getDate().toString().padStart(2, '0')} ${jpDate.getHours().toString().padStart(2, '0')}:${jpDate.getMinutes().toString().padStart(2, '0')}`;
     
-    // ドキュメント内容のプレビューを作成（HTMLタグを除去）
-    let contentPreview = '';
+    // ドキュメント内容のプレビューを作成（一覧 API は preview 列、作成・複製の応答は content から）
+    let contentPreview = doc.preview || '';
     try {
-        if (doc.content) {
+        if (!contentPreview && doc.content) {
             const contentObj = JSON.parse(doc.content);
             if (contentObj.ops && contentObj.ops.length > 0) {
                 contentPreview = contentObj.ops
@@ -145,9 +331,9 @@ function setupEventListeners() {
         createNewDocument();
     });
     
-    // 検索ボックス
+    // 検索ボックス (サーバー側で本文とチャット履歴を検索)
     document.getElementById('doc-search').addEventListener('input', function() {
-        filterDocuments(this.value);
+        scheduleSearch(this.value);
     });
     
     // 並び替え
@@ -329,29 +515,6 @@ function createNewDocument() {
     });
 }
 
-/**
- * ドキュメントをタイトルでフィルタリング
- * @param {string} query - 検索クエリ
- */
-function filterDocuments(query) {
-    // 全てのドキュメントカードを取得
-    const cards = document.querySelectorAll('.document-card');
-    
-    query = query.toLowerCase();
-    
-    cards.forEach(card => {
-        const title = card.querySelector('h3').textContent.toLowerCase();
-        const content = card.querySelector('.document-card-content').textContent.toLowerCase();
-        
-        // タイトルまたは内容に検索クエリが含まれている場合は表示、それ以外は非表示
-        if (title.includes(query) || content.includes(query)) {
-            card.style.display = '';
-        } else {
-            card.style.display = 'none';
-        }
-    });
-}
-
 /**
  * ドキュメントを並び替え
  * @param {string} sortBy - 並び替え基準
@@ -0,0 +1,146 @@
+"""
+長いチャットスレッドの古い会話を、バックグラウンドで要約 (compaction) する。
+
+• 要約はドキュメント毎に chat_summaries へ保存し、last_message_id までの会話を含む
+• 要約中にチャット履歴がリセットされた場合 (last_message_id のメッセージが無い) は保存しない
+• 要約されていないメッセージが COMPACTION_TRIGGER_MESSAGES 件を超えたら、
+  直近 COMPACTION_KEEP_RECENT 件を残してそれより古い分を既存の要約に追記する形で要約し直す
+• 実行はリクエスト処理後にスレッドプールで行い、応答時間には影響させない
+"""
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g
+
+from app.models.storage import (
+    get_chat_messages,
+    get_chat_summary,
+    upsert_chat_summary,
+)
+from app.utils.llm_gateway import get_llm_gateway
+
+# 要約されていないメッセージがこの件数を超えたら要約を更新する
+COMPACTION_TRIGGER_MESSAGES = int(os.getenv('COMPACTION_TRIGGER_MESSAGES', '20'))
+# 要約せずに生のまま残す直近メッセージ数
+COMPACTION_KEEP_RECENT = int(os.getenv('COMPACTION_KEEP_RECENT', '10'))
+# 1 回の要約で読み込むメッセージ数の上限 (溜まっている場合は次回に持ち越す)
+COMPACTION_BATCH_LIMIT = 200
+# 要約の出力トークン上限
+SUMMARY_MAX_OUTPUT_TOKENS = 1_024
+# 要約に使うモデル (未指定なら API キーのあるプロバイダの軽量モデル)
+SUMMARY_MODEL = os.getenv('SUMMARY_MODEL')
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chat-compaction')
+_in_flight = set()
+_lock = threading.Lock()
+
+SUMMARY_PROMPT = """以下は、ユーザーとAIアシスタントの会話の「これまでの要約」と「その後の会話」です。
+両方を統合し、今後の会話で参照できるよう、決定事項・前提・ユーザーの意図・未解決の論点を落とさずに
+日本語で簡潔に要約し直してください。要約本文のみを出力してください。
+
+--- これまでの要約 ---
+{summary}
+--- これまでの要約ここまで ---
+
+--- その後の会話 ---
+{conversation}
+--- その後の会話ここまで ---
+"""
+
+
+def _summary_model():
+    if SUMMARY_MODEL:
+        return SUMMARY_MODEL
+    if os.getenv('GOOGLE_API_KEY'):
+        return 'gemini-2.0-flash'
+    if os.getenv('OPENAI_API_KEY'):
+        return 'gpt-4o-mini'
+    if os.getenv('ANTHROPIC_API_KEY'):
+        return 'claude-3-5-haiku-latest'
+    return None
+
+
+def _summarize(prompt):
+    """軽量モデルで要約文を生成する"""
+    model_name = _summary_model()
+    if model_name is None:
+        raise RuntimeError("要約に使える API キーが設定されていません。")
+    gateway = get_llm_gateway()
+
+    if model_name.startswith('gemini'):
+        from google.generativeai.types import GenerationConfig
+        model = gateway.gemini_model(
+            model_name, cache_key='summary',
+            generation_config=GenerationConfig(max_output_tokens=SUMMARY_MAX_OUTPUT_TOKENS, candidate_count=1),
+        )
+        with gateway.slot('google'):
+            return model.generate_content(prompt).text.strip()
+    if model_name.startswith('claude'):
+        with gateway.slot('anthropic'):
+            result = gateway.anthropic().messages.create(
+                model=model_name,
+                max_tokens=SUMMARY_MAX_OUTPUT_TOKENS,
+                messages=[{"role": "user", "content": prompt}],
+            )
+        return "".join(getattr(blk, "text", "") for blk in result.content).strip()
+    with gateway.slot('openai'):
+        response = gateway.openai().chat.completions.create(
+            model=model_name,
+            max_tokens=SUMMARY_MAX_OUTPUT_TOKENS,
+            messages=[{"role": "user", "content": prompt}],
+        )
+    return (response.choices[0].message.content or '').strip()
+
+
+def compact_chat_history(doc_id, user_id=None):
+    """
+    要約されていない古い会話があれば要約を更新する。更新した場合は True。
+    呼び出し側で g.jwt_token を設定した app_context 内から呼ぶこと。
+    """
+    current = get_chat_summary(doc_id) or {}
+    last_message_id = current.get('last_message_id')
+    pending = get_chat_messages(
+        doc_id, after_id=last_message_id, limit=COMPACTION_BATCH_LIMIT,
+        columns='id, role, content',
+    )
+    if len(pending) <= COMPACTION_TRIGGER_MESSAGES:
+        return False
+
+    to_summarize = pending[:-COMPACTION_KEEP_RECENT] if COMPACTION_KEEP_RECENT else pending
+    conversation = "\n".join(
+        f"{'ユーザー' if m['role'] == 'user' else 'AI'}: {m['content']}" for m in to_summarize
+    )
+    summary = _summarize(SUMMARY_PROMPT.format(
+        summary=current.get('summary') or '(なし)',
+        conversation=conversation,
+    ))
+    if upsert_chat_summary(doc_id, summary, to_summarize[-1]['id'], user_id=user_id) is None:
+        # 要約している間にチャット履歴がリセットされた
+        print(f"--- ドキュメントID {doc_id} の会話要約を破棄 (要約中に履歴が削除されました) ---")
+        return False
+    print(f"--- ドキュメントID {doc_id} の会話要約を更新 ({len(to_summarize)} 件を追加) ---")
+    return True
+
+
+def _run_compaction(app, doc_id, jwt_token, user_id):
+    try:
+        with app.app_context():
+            g.jwt_token = jwt_token
+            g.current_user = user_id
+            compact_chat_history(doc_id, user_id=user_id)
+    except Exception as e:
+        print(f"会話要約の更新に失敗しました (doc_id={doc_id}): {e}", file=sys.stderr)
+    finally:
+        with _lock:
+            _in_flight.discard(doc_id)
+
+
+def schedule_compaction(app, doc_id, jwt_token, user_id):
+    """要約の更新をバックグラウンドに登録する (同じドキュメントの重複登録はしない)"""
+    with _lock:
+        if doc_id in _in_flight:
+            return
+        _in_flight.add(doc_id)
+    _executor.submit(_run_compaction, app, doc_id, jwt_token, user_id)
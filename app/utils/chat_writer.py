@@ -0,0 +1,141 @@
+"""
+チャットメッセージの保存 (AI 応答の生成後に保存するメッセージ)。
+
+• ユーザーメッセージは生成前に RPC begin_chat_turn が保存するため、ここで扱うのは主にアシスタントの応答
+• 1 回の save に渡したメッセージは create_chat_messages で 1 回の POST (returning=minimal) にまとめる
+• 環境変数 CHAT_WRITE_BEHIND=1 のときは保存をバックグラウンドスレッドに任せ (write-behind)、
+  HTTP 応答は最後の INSERT を待たずに返す。溜まった書き込みはユーザー (JWT) 毎に 1 回の INSERT にまとめる
+• 未保存の書き込みはプロセス終了時 (atexit) に flush する。
+  同じドキュメントの履歴を読む前には wait_for(doc_id) で書き込み完了を待つこと
+• Vercel などリクエスト後にプロセスが凍結される環境では write-behind を有効にしないこと
+"""
+import atexit
+import os
+import queue
+import sys
+import threading
+import time
+
+from flask import g
+
+from app.models.storage import create_chat_messages
+
+CHAT_WRITE_BEHIND = os.getenv('CHAT_WRITE_BEHIND', '0').lower() in ('1', 'true', 'yes')
+# 履歴の読み込みやシャットダウン時に書き込み完了を待つ最大秒数
+CHAT_WRITE_WAIT_TIMEOUT = float(os.getenv('CHAT_WRITE_WAIT_TIMEOUT', '5'))
+# 1 回の INSERT にまとめる最大行数
+MAX_BATCH_ROWS = 100
+
+
+class ChatMessageWriter:
+    """chat_messages への書き込みを同期またはバックグラウンドで行う"""
+
+    def __init__(self, write_behind=False):
+        self.write_behind = write_behind
+        self._queue = queue.Queue()
+        self._pending = {}   # doc_id -> 未保存の件数
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def save(self, app, jwt_token, user_id, rows, on_saved=None):
+        """
+        rows (chat_message_row の dict のリスト) を保存する。
+        保存後に on_saved() を呼ぶ (要約の更新予約など)。
+        同期モードでは呼び出し元の app_context / g のまま挿入する。
+        write-behind ではワーカーが jwt_token / user_id を g.jwt_token / g.current_user に設定して挿入する。
+        """
+        rows = [row for row in rows if row]
+        if not rows:
+            return
+        if not self.write_behind:
+            create_chat_messages(rows)
+            if on_saved:
+                on_saved()
+            return
+
+        with self._cond:
+            for row in rows:
+                self._pending[row['document_id']] = self._pending.get(row['document_id'], 0) + 1
+        self._ensure_worker()
+        self._queue.put((app, jwt_token, user_id, rows, on_saved))
+
+    def wait_for(self, doc_id, timeout=CHAT_WRITE_WAIT_TIMEOUT):
+        """doc_id の未保存メッセージが書き込まれるまで待つ (同期モードでは何もしない)"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending.get(doc_id):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print(f"チャットメッセージの保存待ちがタイムアウトしました (doc_id={doc_id})", file=sys.stderr)
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def flush(self, timeout=CHAT_WRITE_WAIT_TIMEOUT):
+        """未保存のメッセージをすべて書き込むまで待つ"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while any(self._pending.values()):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print("チャットメッセージの flush がタイムアウトしました", file=sys.stderr)
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='chat-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # 溜まっている分もまとめて取り出す
+            while len(batch) < MAX_BATCH_ROWS:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        # RLS (SQLite では所有者の確認) のため、同じユーザー (JWT) の書き込みだけを 1 回の INSERT にまとめる
+        groups = {}
+        for item in batch:
+            groups.setdefault((item[1], item[2]), []).append(item)
+        for (jwt_token, user_id), items in groups.items():
+            app = items[0][0]
+            rows = [row for item in items for row in item[3]]
+            try:
+                with app.app_context():
+                    g.jwt_token = jwt_token
+                    g.current_user = user_id
+                    create_chat_messages(rows)
+            except Exception as e:
+                print(f"チャットメッセージの保存に失敗しました ({len(rows)} 件): {e}", file=sys.stderr)
+            finally:
+                with self._cond:
+                    for row in rows:
+                        doc_id = row['document_id']
+                        self._pending[doc_id] = self._pending.get(doc_id, 1) - 1
+                        if self._pending[doc_id] <= 0:
+                            self._pending.pop(doc_id, None)
+                    self._cond.notify_all()
+            for item in items:
+                if item[4]:
+                    try:
+                        item[4]()
+                    except Exception as e:
+                        print(f"保存後の処理に失敗しました: {e}", file=sys.stderr)
+
+
+_writer = ChatMessageWriter(write_behind=CHAT_WRITE_BEHIND)
+atexit.register(_writer.flush)
+
+
+def get_chat_writer():
+    return _writer
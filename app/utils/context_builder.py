@@ -0,0 +1,203 @@
+"""
+全プロバイダ共通のコンテキスト組み立て。
+
+モデル毎の入力トークン予算に収まるよう、次の優先順位でプロンプト素材を詰める。
+  1. システムプロンプト (reserved_tokens として呼び出し側が見積もる) と最新のユーザーメッセージ
+  2. ユーザーが選択した chat_context、古い会話の要約 (summary)
+  3. 直近の会話履歴 (最低 MIN_RECENT_MESSAGES 件、予算の HISTORY_SHARE まで)
+  4. ドキュメント本文 (残り予算。溢れる場合は document_selector で関連部分を選ぶか、末尾を優先して残す)
+  5. さらに余った予算で、より古い会話履歴
+
+トークン数は tiktoken があれば OpenAI 系モデルで正確に数え、
+それ以外は文字種ベースの推定 (ASCII 4 文字 ≒ 1 トークン、非 ASCII 1 文字 ≒ 1 トークン) を使う。
+"""
+import os
+
+# モデル名の接頭辞 → 入力トークン予算。Vercel の 15 秒制限内で応答できる大きさに抑える
+MODEL_CONTEXT_BUDGETS = {
+    'gemini': 12_000,
+    'claude': 12_000,
+    'gpt': 12_000,
+    'o3': 8_000,
+}
+DEFAULT_CONTEXT_BUDGET = 8_000
+# 環境変数 CONTEXT_TOKEN_BUDGET で全モデルの予算を一括上書きできる
+_BUDGET_OVERRIDE = os.getenv('CONTEXT_TOKEN_BUDGET')
+
+# 直近の履歴として必ず残したいメッセージ数
+MIN_RECENT_MESSAGES = 4
+# 直近の履歴に割り当てる予算の割合 (残りはドキュメントへ)
+HISTORY_SHARE = 0.4
+# メッセージ 1 件あたりのロール表記などのオーバーヘッド
+MESSAGE_OVERHEAD_TOKENS = 4
+# 会話要約に割り当てる最大トークン数
+MAX_SUMMARY_TOKENS = 1_500
+
+_tiktoken_encodings = {}
+
+
+def context_budget(model_name):
+    """モデルの入力トークン予算"""
+    if _BUDGET_OVERRIDE:
+        return int(_BUDGET_OVERRIDE)
+    for prefix, budget in MODEL_CONTEXT_BUDGETS.items():
+        if model_name.startswith(prefix):
+            return budget
+    return DEFAULT_CONTEXT_BUDGET
+
+
+def _tiktoken_encoding(model_name):
+    """OpenAI 系モデルの tiktoken エンコーディング。使えなければ None"""
+    if not (model_name.startswith('gpt') or model_name.startswith('o3')):
+        return None
+    if model_name in _tiktoken_encodings:
+        return _tiktoken_encodings[model_name]
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding('o200k_base')
+    except ImportError:
+        encoding = None
+    _tiktoken_encodings[model_name] = encoding
+    return encoding
+
+
+def _estimate_char_tokens(ch):
+    return 0.25 if ord(ch) < 128 else 1.0
+
+
+def estimate_tokens(text, model_name=''):
+    """text のトークン数を数える (tiktoken があれば正確に、無ければ推定)"""
+    if not text:
+        return 0
+    encoding = _tiktoken_encoding(model_name)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return int(ascii_chars * 0.25 + (len(text) - ascii_chars)) + 1
+
+
+def truncate_to_tokens(text, max_tokens, model_name='', keep='tail'):
+    """text を max_tokens に収まるよう切り詰める。keep='tail' なら末尾、'head' なら先頭を残す"""
+    if not text or max_tokens <= 0:
+        return ''
+    if estimate_tokens(text, model_name) <= max_tokens:
+        return text
+
+    encoding = _tiktoken_encoding(model_name)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        kept = tokens[-max_tokens:] if keep == 'tail' else tokens[:max_tokens]
+        return encoding.decode(kept)
+
+    used = 0.0
+    chars = reversed(text) if keep == 'tail' else iter(text)
+    count = 0
+    for ch in chars:
+        used += _estimate_char_tokens(ch)
+        if used > max_tokens:
+            break
+        count += 1
+    return text[-count:] if keep == 'tail' else text[:count]
+
+
+def _message_tokens(message, model_name):
+    return estimate_tokens(message.get('content') or '', model_name) + MESSAGE_OVERHEAD_TOKENS
+
+
+def build_context(model_name, document, chat_history, user_message, chat_context=None,
+                  reserved_tokens=0, max_messages=None, budget=None, document_selector=None,
+                  summary=None):
+    """
+    予算内に収めたプロンプト素材を dict で返す。
+
+    document_selector(document, max_tokens) を渡すと、ドキュメントが予算を超える場合に
+    末尾の切り詰めの代わりに呼ばれる (retrieval.select_relevant_text など)。
+    summary には chat_history より前の会話の要約を渡す。
+
+
+    戻り値:
+      document        : 予算内に切り詰めたドキュメント本文
+      chat_context    : 予算内に切り詰めた追加コンテキスト (無ければ None)
+      summary         : 予算内に切り詰めた会話要約 (無ければ None)
+      history         : 採用した会話履歴 (昇順)。最新のユーザーメッセージは含まない
+      tokens          : 採用分の推定トークン数
+      budget          : 使用した予算
+      dropped_messages: 予算外として落とした履歴件数
+      document_truncated: ドキュメントを切り詰めたか
+    """
+    budget = budget or context_budget(model_name)
+    history = list(chat_history or [])
+
+    # 保存済みの今回のユーザーメッセージが履歴末尾に含まれていれば二重送信しない
+    if history and history[-1].get('role') == 'user' and history[-1].get('content') == user_message:
+        history = history[:-1]
+    if max_messages is not None and len(history) > max_messages:
+        history = history[-max_messages:]
+    candidate_count = len(history)
+
+    # 1. システムプロンプトと最新ユーザーメッセージは必ず送る
+    used = reserved_tokens + estimate_tokens(user_message, model_name) + MESSAGE_OVERHEAD_TOKENS
+    remaining = max(budget - used, 0)
+
+    # 2. ユーザー指定のコンテキスト (溢れる場合は先頭を残す)
+    if chat_context:
+        chat_context = truncate_to_tokens(chat_context, remaining, model_name, keep='head')
+        remaining -= estimate_tokens(chat_context, model_name)
+
+    # 古い会話の要約 (溢れる場合は新しい内容が書かれた末尾を残す)
+    if summary:
+        summary = truncate_to_tokens(summary, min(remaining, MAX_SUMMARY_TOKENS), model_name, keep='tail')
+        if summary:
+            remaining -= estimate_tokens(summary, model_name) + MESSAGE_OVERHEAD_TOKENS * 2
+
+    # 3. 直近の履歴を新しい順に、最低件数 + 予算の HISTORY_SHARE まで
+    message_costs = [_message_tokens(m, model_name) for m in history]
+    history_limit = int(remaining * HISTORY_SHARE)
+    selected = 0
+    history_used = 0
+    for cost in reversed(message_costs):
+        within_minimum = selected < MIN_RECENT_MESSAGES and history_used + cost <= remaining
+        if not within_minimum and history_used + cost > history_limit:
+            break
+        history_used += cost
+        selected += 1
+    remaining -= history_used
+
+    # 4. ドキュメント本文 (末尾を優先)
+    document = document or ''
+    document_tokens = estimate_tokens(document, model_name)
+    document_truncated = document_tokens > remaining
+    if document_truncated:
+        if document_selector is not None:
+            document = document_selector(document, remaining)
+        else:
+            document = truncate_to_tokens(document, remaining, model_name, keep='tail')
+        document_tokens = estimate_tokens(document, model_name)
+    remaining -= document_tokens
+
+    # 5. 余りでさらに古い履歴を足す
+    for cost in reversed(message_costs[:len(message_costs) - selected]):
+        if cost > remaining:
+            break
+        remaining -= cost
+        history_used += cost
+        selected += 1
+
+    kept_history = history[len(history) - selected:] if selected else []
+    # 応答だけが先頭に残ると文脈が欠けるため、履歴はユーザー発話から始める
+    while kept_history and kept_history[0].get('role') == 'assistant':
+        kept_history = kept_history[1:]
+        selected -= 1
+    return {
+        'document': document,
+        'chat_context': chat_context or None,
+        'summary': summary or None,
+        'history': kept_history,
+        'tokens': budget - max(remaining, 0),
+        'budget': budget,
+        'dropped_messages': candidate_count - selected,
+        'document_truncated': document_truncated,
+    }
@@ -0,0 +1,154 @@
+"""
+Quill Delta をサーバー側で適用するための最小実装。
+
+• ドキュメント (insert のみの Delta) に変更 Delta (retain / insert / delete) を compose する
+• 長さは Quill (JavaScript) と同じ UTF-16 コード単位で数える (絵文字などのサロゲートペアは 2)
+• 埋め込み (画像など insert が dict のもの) の長さは 1
+"""
+import json
+
+
+class DeltaError(ValueError):
+    """変更 Delta が不正、またはドキュメントの長さと合わない"""
+
+
+def _utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _splits_surrogate_pair(data, index):
+    """UTF-16 のバイト列で、コード単位 index の位置がサロゲートペアの間か"""
+    if index <= 0 or index * 2 >= len(data):
+        return False
+    unit = int.from_bytes(data[index * 2:index * 2 + 2], 'little')
+    return 0xDC00 <= unit <= 0xDFFF
+
+
+def _utf16_slice(text, start, end=None):
+    data = text.encode('utf-16-le')
+    for index in (start, end):
+        if index is not None and _splits_surrogate_pair(data, index):
+            # 絵文字などの途中で切ると保存できない文字列になる
+            raise DeltaError(f'position {index} splits a surrogate pair')
+    return data[start * 2:None if end is None else end * 2].decode('utf-16-le')
+
+
+def op_length(op):
+    if 'delete' in op:
+        return op['delete']
+    if 'retain' in op:
+        return op['retain']
+    insert = op.get('insert')
+    return _utf16_len(insert) if isinstance(insert, str) else 1
+
+
+def parse_document(content):
+    """documents.content (Delta JSON 文字列 / 空文字) を insert op のリストにする"""
+    if not content:
+        return []
+    try:
+        delta = json.loads(content)
+    except (TypeError, ValueError):
+        # Delta でないプレーンテキストは 1 つの insert とみなす
+        return [{'insert': content}]
+    ops = delta.get('ops') if isinstance(delta, dict) else delta
+    if not isinstance(ops, list):
+        return [{'insert': content}]
+    return [op for op in ops if isinstance(op, dict) and 'insert' in op]
+
+
+def _compose_attributes(base, change):
+    """retain の属性を insert に適用する (値が None の属性は削除)"""
+    attributes = dict(base or {})
+    for key, value in (change or {}).items():
+        if value is None:
+            attributes.pop(key, None)
+        else:
+            attributes[key] = value
+    return attributes or None
+
+
+def _push(ops, op):
+    """隣接する同じ属性のテキスト insert を 1 つにまとめて追加する"""
+    if op_length(op) == 0:
+        return
+    last = ops[-1] if ops else None
+    if (last is not None and isinstance(last.get('insert'), str) and isinstance(op.get('insert'), str)
+            and last.get('attributes') == op.get('attributes')):
+        last['insert'] += op['insert']
+        return
+    ops.append(dict(op))
+
+
+class _Iterator:
+    """insert op 列を任意の長さで切り出しながら読む"""
+
+    def __init__(self, ops):
+        self.ops = ops
+        self.index = 0
+        self.offset = 0
+
+    def has_next(self):
+        return self.index < len(self.ops)
+
+    def next(self, length=None):
+        op = self.ops[self.index]
+        remaining = op_length(op) - self.offset
+        if length is None or length >= remaining:
+            length = remaining
+            start, self.offset = self.offset, 0
+            self.index += 1
+        else:
+            start = self.offset
+            self.offset += length
+        insert = op['insert']
+        if isinstance(insert, str):
+            insert = _utf16_slice(insert, start, start + length)
+        piece = {'insert': insert}
+        if op.get('attributes'):
+            piece['attributes'] = op['attributes']
+        return piece
+
+
+def compose(document_ops, change_ops):
+    """
+    ドキュメント (insert のみ) に変更 Delta を適用した insert op のリストを返す。
+    変更がドキュメントの長さを超えて retain / delete する場合は DeltaError。
+    """
+    if not isinstance(change_ops, list):
+        raise DeltaError('ops must be a list')
+    base = _Iterator(document_ops)
+    result = []
+    for op in change_ops:
+        if not isinstance(op, dict):
+            raise DeltaError(f'invalid op: {op!r}')
+        if 'insert' in op:
+            if not isinstance(op['insert'], (str, dict)):
+                raise DeltaError(f'invalid insert: {op!r}')
+            _push(result, op)
+            continue
+
+        key = 'retain' if 'retain' in op else 'delete' if 'delete' in op else None
+        length = op.get(key) if key else None
+        if not isinstance(length, int) or isinstance(length, bool) or length < 0:
+            raise DeltaError(f'invalid op: {op!r}')
+        while length > 0:
+            if not base.has_next():
+                raise DeltaError(f'{key} exceeds document length')
+            piece = base.next(length)
+            length -= op_length(piece)
+            if key == 'retain':
+                attributes = _compose_attributes(piece.get('attributes'), op.get('attributes'))
+                piece.pop('attributes', None)
+                if attributes:
+                    piece['attributes'] = attributes
+                _push(result, piece)
+    # 残り (暗黙の retain)
+    while base.has_next():
+        _push(result, base.next())
+    return result
+
+
+def apply_delta(content, change_ops):
+    """documents.content に変更 Delta を適用し、保存用の Delta JSON 文字列を返す"""
+    return json.dumps({'ops': compose(parse_document(content), change_ops)}, ensure_ascii=False)
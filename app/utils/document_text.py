@@ -0,0 +1,157 @@
+"""
+Quill Delta で保存されたドキュメントを、LLM のプロンプト用テキストに変換する。
+
+• Delta JSON (`{"ops":[{"insert":...,"attributes":...}]}`) をそのまま送ると、
+  JSON の記号や書式属性がトークン予算の大半を占めるため Markdown に変換して送る
+• 変換結果は (ドキュメント ID, updated_at) 単位でプロセス内 LRU にメモ化し、
+  同じ版のドキュメントではチャットのたびに Delta を解析し直さない
+• 画像などの埋め込み (base64 の data URI を含む) はプレースホルダーに置き換える
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from app.utils.delta import parse_document
+
+MAX_CACHED_PROJECTIONS = 64   # メモ化するドキュメント数
+
+# 行内書式: 内側から順に適用する
+_INLINE_FORMATS = (
+    ('code', '`', '`'),
+    ('bold', '**', '**'),
+    ('italic', '*', '*'),
+    ('strike', '~~', '~~'),
+)
+
+
+def document_text(content):
+    """Quill Delta JSON なら insert 文字列を連結したプレーンテキストを返す"""
+    return ''.join(op['insert'] for op in parse_document(content) if isinstance(op['insert'], str))
+
+
+def _render_inline(text, attributes):
+    if not attributes or not text.strip():
+        return text
+    # 前後の空白は書式記号の外に出す (Markdown として解釈されるように)
+    stripped = text.strip()
+    leading = text[:len(text) - len(text.lstrip())]
+    trailing = text[len(text.rstrip()):]
+    for name, start, end in _INLINE_FORMATS:
+        if attributes.get(name):
+            stripped = f"{start}{stripped}{end}"
+    if attributes.get('link'):
+        stripped = f"[{stripped}]({attributes['link']})"
+    return f"{leading}{stripped}{trailing}"
+
+
+def _render_embed(embed):
+    if not isinstance(embed, dict):
+        return ''
+    if 'image' in embed:
+        source = str(embed['image'])
+        return '[画像]' if source.startswith('data:') else f"![画像]({source})"
+    if 'video' in embed:
+        return f"[動画]({embed['video']})"
+    if 'formula' in embed:
+        return f"${embed['formula']}$"
+    return ''
+
+
+def _split_lines(ops):
+    """op 列を (行内テキスト, 行の書式属性) のリストにする。行の書式は改行 op が持つ"""
+    lines = []
+    segments = []
+    for op in ops:
+        insert = op['insert']
+        attributes = op.get('attributes') or {}
+        if not isinstance(insert, str):
+            segments.append(_render_embed(insert))
+            continue
+        pieces = insert.split('\n')
+        for i, piece in enumerate(pieces):
+            if piece:
+                segments.append(_render_inline(piece, attributes))
+            if i < len(pieces) - 1:
+                lines.append((''.join(segments), attributes))
+                segments = []
+    if segments:
+        lines.append((''.join(segments), {}))
+    return lines
+
+
+def delta_to_markdown(ops):
+    """insert op 列を Markdown に変換する"""
+    output = []
+    in_code_block = False
+    ordered_counters = {}
+    for text, attributes in _split_lines(ops):
+        code_block = attributes.get('code-block')
+        if code_block and not in_code_block:
+            output.append('```')
+        elif not code_block and in_code_block:
+            output.append('```')
+        in_code_block = bool(code_block)
+        if code_block:
+            output.append(text)
+            continue
+
+        indent = int(attributes.get('indent') or 0)
+        list_type = attributes.get('list')
+        if list_type:
+            # 番号付きリストの番号は階層毎に数え、より深い階層の番号は親の項目でリセット
+            ordered_counters = {k: v for k, v in ordered_counters.items() if k <= indent}
+        else:
+            ordered_counters = {}
+        if list_type == 'ordered':
+            number = ordered_counters.get(indent, 0) + 1
+            ordered_counters[indent] = number
+            prefix = '  ' * indent + f"{number}. "
+        else:
+            ordered_counters.pop(indent, None)
+            if list_type == 'checked':
+                prefix = '  ' * indent + '- [x] '
+            elif list_type == 'unchecked':
+                prefix = '  ' * indent + '- [ ] '
+            elif list_type:
+                prefix = '  ' * indent + '- '
+            elif attributes.get('header'):
+                prefix = '#' * int(attributes['header']) + ' '
+            elif attributes.get('blockquote'):
+                prefix = '> '
+            else:
+                prefix = ''
+        output.append(prefix + text if text or prefix else '')
+    if in_code_block:
+        output.append('```')
+    return '\n'.join(output).strip('\n')
+
+
+def content_to_markdown(content):
+    """documents.content (Delta JSON 文字列) を Markdown に変換する"""
+    return delta_to_markdown(parse_document(content))
+
+
+_projections = OrderedDict()
+_lock = threading.Lock()
+
+
+def document_markdown(document):
+    """
+    documents 行の content を Markdown に変換して返す。
+    (id, updated_at) が同じ版は変換結果を使い回す (updated_at が無ければ content のハッシュで判定)。
+    """
+    content = document.get('content') or ''
+    version = document.get('updated_at') or hashlib.sha1(content.encode('utf-8')).hexdigest()
+    key = (document.get('id'), version)
+    with _lock:
+        text = _projections.get(key)
+        if text is not None:
+            _projections.move_to_end(key)
+            return text
+    text = content_to_markdown(content)
+    with _lock:
+        _projections[key] = text
+        _projections.move_to_end(key)
+        while len(_projections) > MAX_CACHED_PROJECTIONS:
+            _projections.popitem(last=False)
+    return text
@@ -0,0 +1,199 @@
+"""
+時間のかかる処理 (長い LLM 生成など) をリクエストの外で実行するジョブキュー。
+
+• キューは SQLite (CHAT_JOB_DB) に保存し、外部のブローカーを必要としない。
+  同じファイルを共有すれば複数プロセス (serve.py を複数起動) でも 1 つのジョブは 1 回だけ実行される
+• ジョブはプロセス内のワーカースレッド (CHAT_JOB_WORKERS 本) が取り出し、
+  app_context 内で g.jwt_token / g.current_user を設定して実行する (RLS は投入したユーザーの権限のまま)
+• 結果はポーリング (get) で取得するか、add_listener で登録したコールバック (SocketIO 通知など) で受け取る
+• 実行中のまま CHAT_JOB_TIMEOUT 秒を超えたジョブ (プロセスの停止など) は失敗として扱う
+• Vercel などリクエスト後にプロセスが凍結される環境では有効にしないこと (CHAT_JOBS=0 のまま)
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from flask import g
+
+CHAT_JOBS = os.getenv('CHAT_JOBS', '0').lower() in ('1', 'true', 'yes')
+CHAT_JOB_DB = os.getenv('CHAT_JOB_DB', 'instance/chat_jobs.db')
+CHAT_JOB_WORKERS = int(os.getenv('CHAT_JOB_WORKERS', '2'))
+# 実行中のジョブをこの秒数で打ち切り扱いにする
+CHAT_JOB_TIMEOUT = int(os.getenv('CHAT_JOB_TIMEOUT', '900'))
+# 完了したジョブの結果を保持する秒数
+CHAT_JOB_RETENTION = int(os.getenv('CHAT_JOB_RETENTION', '86400'))
+# 他のプロセスが投入したジョブを確認する間隔 (秒)
+POLL_INTERVAL = 2.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          TEXT PRIMARY KEY,
+    kind        TEXT NOT NULL,
+    status      TEXT NOT NULL,          -- queued / running / done / error
+    user_id     TEXT,
+    jwt_token   TEXT,                   -- 実行時の RLS 用。完了後は消去する
+    payload     TEXT,                   -- 完了後は消去する
+    result      TEXT,
+    error       TEXT,
+    created_at  REAL NOT NULL,
+    started_at  REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at);
+"""
+
+
+class JobQueue:
+    """SQLite に保存するジョブキューとワーカースレッド"""
+
+    def __init__(self, path, workers):
+        self.path = path
+        self.workers = workers
+        self._handlers = {}
+        self._listeners = []
+        self._app = None
+        self._threads = []
+        self._cond = threading.Condition()
+        self._initialized = False
+
+    def register(self, kind, handler):
+        """handler(payload) -> dict を kind のジョブとして登録する (例外は失敗として記録)"""
+        self._handlers[kind] = handler
+
+    def add_listener(self, listener):
+        """ジョブ完了時に listener(job) を呼ぶ (job は get と同じ dict)"""
+        self._listeners.append(listener)
+
+    def enqueue(self, app, kind, payload, jwt_token=None, user_id=None):
+        """ジョブを投入して job_id を返す"""
+        job_id = uuid.uuid4().hex
+        with closing(self._connect()) as con, con:
+            con.execute(
+                "INSERT INTO jobs (id, kind, status, user_id, jwt_token, payload, created_at) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, kind, user_id, jwt_token, json.dumps(payload, ensure_ascii=False), time.time()),
+            )
+        self._ensure_workers(app)
+        with self._cond:
+            self._cond.notify()
+        return job_id
+
+    def get(self, job_id):
+        """ジョブの状態を dict で返す (存在しなければ None)"""
+        with closing(self._connect()) as con, con:
+            row = con.execute(
+                "SELECT id, kind, status, user_id, result, error, created_at, started_at, finished_at "
+                "FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return job
+
+    # ---------------- 内部処理 ----------------
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        con.row_factory = sqlite3.Row
+        if not self._initialized:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.executescript(_SCHEMA)
+            self._initialized = True
+        return con
+
+    def _ensure_workers(self, app):
+        with self._cond:
+            self._app = app
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._run, name=f'job-worker-{len(self._threads)}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def _claim(self):
+        """queued のジョブを 1 件 running にして (id, kind, payload, jwt_token, user_id) を返す"""
+        now = time.time()
+        con = self._connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            # 打ち切り時間を過ぎた実行中ジョブと、保持期間を過ぎた完了ジョブを片付ける
+            con.execute(
+                "UPDATE jobs SET status = 'error', error = 'timeout', finished_at = ?, "
+                "jwt_token = NULL, payload = NULL WHERE status = 'running' AND started_at < ?",
+                (now, now - CHAT_JOB_TIMEOUT),
+            )
+            con.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'error') AND finished_at < ?",
+                (now - CHAT_JOB_RETENTION,),
+            )
+            row = con.execute(
+                "SELECT id, kind, payload, jwt_token, user_id FROM jobs "
+                "WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                con.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?", (now, row['id']))
+            con.execute("COMMIT")
+            return row
+        except Exception:
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+    def _finish(self, job_id, status, result=None, error=None):
+        with closing(self._connect()) as con, con:
+            con.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, "
+                "jwt_token = NULL, payload = NULL WHERE id = ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                 error, time.time(), job_id),
+            )
+        job = self.get(job_id)
+        for listener in self._listeners:
+            try:
+                listener(job)
+            except Exception as e:
+                print(f"ジョブ完了通知に失敗しました ({job_id}): {e}", file=sys.stderr)
+
+    def _run(self):
+        while True:
+            try:
+                row = self._claim()
+            except Exception as e:
+                print(f"ジョブの取り出しに失敗しました: {e}", file=sys.stderr)
+                row = None
+            if row is None:
+                with self._cond:
+                    self._cond.wait(POLL_INTERVAL)
+                continue
+
+            handler = self._handlers.get(row['kind'])
+            try:
+                if handler is None:
+                    raise ValueError(f"未登録のジョブです: {row['kind']}")
+                with self._app.app_context():
+                    g.jwt_token = row['jwt_token']
+                    g.current_user = row['user_id']
+                    result = handler(json.loads(row['payload']))
+            except Exception as e:
+                print(f"ジョブの実行に失敗しました ({row['id']}): {e}", file=sys.stderr)
+                self._finish(row['id'], 'error', error=str(e))
+            else:
+                self._finish(row['id'], 'done', result=result)
+
+
+_queue = JobQueue(CHAT_JOB_DB, CHAT_JOB_WORKERS)
+
+
+def get_job_queue():
+    return _queue
@@ -0,0 +1,212 @@
+"""
+LLM プロバイダ (OpenAI / Anthropic / Google) への呼び出しを一元管理するゲートウェイ。
+
+• SDK クライアントはプロセス内で使い回し、httpx のコネクションプールを共有する
+  (リクエスト毎の TLS ハンドシェイクとクライアント生成コストを削減)
+• プロバイダ毎に同時実行数の上限 (セマフォ) を設ける
+• Gemini の明示的コンテキストキャッシュ (CachedContent) を保持し、
+  プロンプトキャッシュのヒット/ミスのトークン数を集計する
+
+chat_controller の get_* / stream_* 関数は必ずこのモジュール経由で API を呼び出す。
+"""
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PROVIDERS = ('openai', 'anthropic', 'google')
+
+# コネクションプールの上限 (プロバイダ毎)
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '20'))
+LLM_MAX_KEEPALIVE = int(os.getenv('LLM_MAX_KEEPALIVE', '10'))
+# API 呼び出しのタイムアウト秒数
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))
+# プロバイダ毎の同時実行数上限 (例: LLM_CONCURRENCY_OPENAI=4)
+DEFAULT_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '8'))
+# Gemini SDK のトランスポート (grpc / rest)。gevent / eventlet では serve.py が rest を指定する
+GEMINI_TRANSPORT = os.getenv('GEMINI_TRANSPORT') or None
+# Gemini の明示的コンテキストキャッシュの有効期間 (秒)
+GEMINI_CACHE_TTL = int(os.getenv('GEMINI_CACHE_TTL', '600'))
+
+
+def _concurrency_limit(provider):
+    return int(os.getenv(f'LLM_CONCURRENCY_{provider.upper()}', str(DEFAULT_CONCURRENCY)))
+
+
+class LLMGateway:
+    """プロバイダ SDK クライアントと同時実行数制御をまとめて保持する"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._gemini_models = {}
+        self._gemini_caches = {}
+        self._google_configured_key = None
+        self._usage = {}
+        self._semaphores = {p: threading.BoundedSemaphore(_concurrency_limit(p)) for p in PROVIDERS}
+
+    # ---------------- クライアント生成 ----------------
+
+    def _get_or_create(self, name, factory):
+        client = self._clients.get(name)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(name)
+            if client is None:
+                client = factory()
+                self._clients[name] = client
+            return client
+
+    def _httpx_limits(self):
+        import httpx
+        return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                            max_keepalive_connections=LLM_MAX_KEEPALIVE)
+
+    def openai(self):
+        """共有プールを使う同期 OpenAI クライアント"""
+        def factory():
+            from openai import OpenAI, DefaultHttpxClient
+            return OpenAI(
+                api_key=os.getenv('OPENAI_API_KEY'),
+                timeout=LLM_TIMEOUT,
+                http_client=DefaultHttpxClient(limits=self._httpx_limits()),
+            )
+        return self._get_or_create('openai', factory)
+
+    def anthropic(self):
+        """共有プールを使う同期 Anthropic クライアント"""
+        def factory():
+            from anthropic import Anthropic, DefaultHttpxClient
+            return Anthropic(
+                api_key=os.getenv('ANTHROPIC_API_KEY'),
+                timeout=LLM_TIMEOUT,
+                http_client=DefaultHttpxClient(limits=self._httpx_limits()),
+            )
+        return self._get_or_create('anthropic', factory)
+
+    def _configure_google(self):
+        import google.generativeai as genai
+        api_key = os.getenv('GOOGLE_API_KEY')
+        if self._google_configured_key != api_key:
+            genai.configure(api_key=api_key, transport=GEMINI_TRANSPORT)
+            self._google_configured_key = api_key
+        return genai
+
+    def gemini_model(self, model_name, cache_key=None, **model_kwargs):
+        """
+        GenerativeModel を (model_name, cache_key) 単位で使い回す。
+        genai はプロセス全体で1つのチャネル (gRPC / REST) を共有するため、configure も一度だけ行う。
+        """
+        key = (model_name, cache_key)
+        model = self._gemini_models.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            model = self._gemini_models.get(key)
+            if model is None:
+                genai = self._configure_google()
+                model = genai.GenerativeModel(model_name, **model_kwargs)
+                self._gemini_models[key] = model
+            return model
+
+    def gemini_cached_model(self, model_name, prefix_contents, **model_kwargs):
+        """
+        prefix_contents (指示＋ドキュメントなど変化しない先頭部分) を CachedContent として登録し、
+        それを参照する GenerativeModel を返す。同じ先頭部分なら有効期間内は使い回す。
+        作成に失敗した場合 (モデル非対応・最小トークン数未満など) は None を返す。
+        失敗も同じ先頭部分について GEMINI_CACHE_TTL の間は記録し、毎ターン作成を試みて待たないようにする。
+        """
+        key = hashlib.sha256(
+            json.dumps([model_name, prefix_contents, model_kwargs], ensure_ascii=False, default=str).encode('utf-8')
+        ).hexdigest()
+        now = time.monotonic()
+        entry = self._gemini_caches.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]   # 作成に失敗した先頭部分は None
+        try:
+            genai = self._configure_google()
+            from google.generativeai import caching
+            cached = caching.CachedContent.create(
+                model=model_name,
+                contents=prefix_contents,
+                ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL),
+            )
+            model = genai.GenerativeModel.from_cached_content(cached_content=cached, **model_kwargs)
+        except Exception as e:
+            print(f"[LLMGateway] Gemini コンテキストキャッシュを作成できませんでした: {e}")
+            self.record_usage('google', model_name, calls=0, cache_failures=1)
+            model = None
+        with self._lock:
+            # 期限切れのエントリを掃除してから登録 (期限の少し前に作り直す)
+            self._gemini_caches = {k: v for k, v in self._gemini_caches.items() if v[1] > now}
+            self._gemini_caches[key] = (model, now + GEMINI_CACHE_TTL - 30)
+        return model
+
+    # ---------------- 使用量の記録 ----------------
+
+    def record_usage(self, provider, model_name, input_tokens=0, output_tokens=0,
+                     cache_read_tokens=0, cache_write_tokens=0, calls=1, cache_failures=0):
+        """
+        プロンプトキャッシュのヒット (read) / 作成 (write) を含むトークン数を集計する。
+        キャッシュの作成に失敗した場合は calls=0, cache_failures=1 で記録する。
+        """
+        with self._lock:
+            stats = self._usage.setdefault((provider, model_name), {
+                'calls': 0, 'input_tokens': 0, 'output_tokens': 0,
+                'cache_read_tokens': 0, 'cache_write_tokens': 0, 'cache_failures': 0,
+            })
+            stats['calls'] += calls
+            stats['input_tokens'] += input_tokens or 0
+            stats['output_tokens'] += output_tokens or 0
+            stats['cache_read_tokens'] += cache_read_tokens or 0
+            stats['cache_write_tokens'] += cache_write_tokens or 0
+            stats['cache_failures'] += cache_failures
+        print(f"[LLMGateway] usage {provider}/{model_name}: input={input_tokens} output={output_tokens} "
+              f"cache_read={cache_read_tokens} cache_write={cache_write_tokens} cache_failures={cache_failures}")
+
+    def usage_stats(self):
+        """プロセス起動以降のトークン使用量 (プロバイダ/モデル毎)"""
+        with self._lock:
+            return [
+                dict(provider=provider, model=model_name, **stats)
+                for (provider, model_name), stats in self._usage.items()
+            ]
+
+    def reset(self):
+        """API キー変更時などに保持しているクライアントを破棄する"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+            self._gemini_models = {}
+            self._gemini_caches = {}
+            self._google_configured_key = None
+        for client in clients:
+            close = getattr(client, 'close', None)
+            if close:
+                try:
+                    close()
+                except Exception:
+                    pass
+
+    # ---------------- 同時実行数制御 ----------------
+
+    @contextmanager
+    def slot(self, provider):
+        """同期呼び出し用: provider の同時実行枠を1つ確保する"""
+        semaphore = self._semaphores[provider]
+        semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+_gateway = LLMGateway()
+
+
+def get_llm_gateway():
+    return _gateway
@@ -0,0 +1,199 @@
+"""
+長いドキュメントから、ユーザーメッセージに関連するチャンクだけを選び出すローカル検索。
+
+• ドキュメントを段落単位でおよそ CHUNK_CHARS 文字のチャンクに分割
+• 英数字は単語、日本語などの非 ASCII 文字は文字 bi-gram でトークン化 (CJK 対応)
+• NumPy の postings (term → チャンク ID 配列 / 出現回数配列) で BM25 スコアを計算
+• インデックスは doc_id 毎にプロセス内 LRU に保持し、本文が変わった場合は
+  変更のないチャンクのトークン化結果を使い回して差分だけ再計算する
+• NumPy はコールドスタートを短くするため、長いドキュメントで初めて検索するときに import する
+"""
+import hashlib
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from app.utils.context_builder import estimate_tokens, truncate_to_tokens
+from app.utils.document_text import content_to_markdown
+
+CHUNK_CHARS = 800           # 1 チャンクの目安文字数
+MAX_CACHED_INDEXES = 32     # 保持するドキュメントインデックス数
+BM25_K1 = 1.5
+BM25_B = 0.75
+CHUNK_SEPARATOR = '\n…\n'   # 選んだチャンク同士の区切り
+
+_WORD_RE = re.compile(r'[0-9a-z_]+')
+_ASCII_RE = re.compile(r'[\x00-\x7f]+')
+
+
+def tokenize(text):
+    """英数字は小文字化した単語、非 ASCII は空白を除いた文字 bi-gram (1 文字なら unigram)"""
+    text = (text or '').lower()
+    tokens = _WORD_RE.findall(text)
+    for run in _ASCII_RE.split(text):
+        run = ''.join(run.split())
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+
+def search_index_tokens(text):
+    """
+    全文検索の索引に載せるトークン (重複なし)。tokenize に非 ASCII の 1 文字 (unigram) を加え、
+    1 文字の検索語 (tokenize では unigram になる) でも一致させる。検索語側は tokenize のまま使う
+    """
+    tokens = set(tokenize(text))
+    for run in _ASCII_RE.split((text or '').lower()):
+        tokens.update(char for char in run if not char.isspace())
+    return tokens
+
+
+def split_into_chunks(text, chunk_chars=CHUNK_CHARS):
+    """段落 (改行) 境界でおよそ chunk_chars 文字ずつに分割する"""
+    chunks = []
+    current = ''
+    for paragraph in text.splitlines(keepends=True):
+        # 1 段落が長すぎる場合は強制的に分割
+        while len(paragraph) > chunk_chars:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(paragraph[:chunk_chars])
+            paragraph = paragraph[chunk_chars:]
+        if current and len(current) + len(paragraph) > chunk_chars:
+            chunks.append(current)
+            current = ''
+        current += paragraph
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _chunk_key(chunk):
+    return hashlib.sha1(chunk.encode('utf-8')).hexdigest()
+
+
+class ChunkIndex:
+    """1 ドキュメント分のチャンクと BM25 用 postings"""
+
+    def __init__(self, text, previous=None):
+        import numpy as np
+
+        self.content_hash = _chunk_key(text)
+        self.chunks = split_into_chunks(text)
+        # 変更のないチャンクは前回のトークン化結果を再利用する
+        reusable = previous.term_counts_by_key if previous else {}
+        self.term_counts_by_key = {}
+        counts = []
+        for chunk in self.chunks:
+            key = _chunk_key(chunk)
+            counter = reusable.get(key) or self.term_counts_by_key.get(key)
+            if counter is None:
+                counter = Counter(tokenize(chunk))
+            self.term_counts_by_key[key] = counter
+            counts.append(counter)
+
+        self.doc_lengths = np.array([sum(c.values()) for c in counts], dtype=np.float32)
+        self.avg_length = float(self.doc_lengths.mean()) if len(counts) else 0.0
+        postings = {}
+        for chunk_id, counter in enumerate(counts):
+            for term, tf in counter.items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(chunk_id)
+                postings[term][1].append(tf)
+        n = len(counts)
+        self.postings = {}
+        for term, (ids, tfs) in postings.items():
+            idf = np.log(1.0 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+            self.postings[term] = (np.array(ids, dtype=np.int32), np.array(tfs, dtype=np.float32), idf)
+
+    def scores(self, query):
+        """query に対する各チャンクの BM25 スコア"""
+        import numpy as np
+
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        if not self.chunks:
+            return scores
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths / max(self.avg_length, 1.0))
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            ids, tfs, idf = posting
+            scores[ids] += idf * tfs * (BM25_K1 + 1) / (tfs + norm[ids])
+        return scores
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_document_index(doc_id, text):
+    """doc_id のインデックスを返す。本文が変わっていれば差分で作り直す"""
+    content_hash = _chunk_key(text)
+    with _lock:
+        index = _indexes.get(doc_id)
+        if index is not None and index.content_hash == content_hash:
+            _indexes.move_to_end(doc_id)
+            return index
+    index = ChunkIndex(text, previous=index)
+    with _lock:
+        _indexes[doc_id] = index
+        _indexes.move_to_end(doc_id)
+        while len(_indexes) > MAX_CACHED_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def refresh_document_index(doc_id, content):
+    """
+    ドキュメント更新時に呼ぶ。既にインデックスを保持しているドキュメントだけ差分で作り直す
+    (チャットで使われていないドキュメントの自動保存では何もしない)。
+    """
+    with _lock:
+        cached = doc_id in _indexes
+    if cached and content is not None:
+        # チャットと同じ Markdown 表現でインデックスを作る (document_markdown と一致させる)
+        get_document_index(doc_id, content_to_markdown(content))
+
+
+def forget_document_index(doc_id):
+    with _lock:
+        _indexes.pop(doc_id, None)
+
+
+def select_relevant_text(doc_id, text, query, max_tokens, model_name=''):
+    """
+    text が max_tokens に収まらない場合、query と関連の高いチャンクを予算内で選び、
+    元の順序で連結して返す。末尾チャンク (直近の執筆箇所) は常に含める。
+    """
+    if max_tokens <= 0 or not text:
+        return ''
+    if estimate_tokens(text, model_name) <= max_tokens:
+        return text
+
+    index = get_document_index(doc_id, text)
+    if len(index.chunks) <= 1:
+        return truncate_to_tokens(text, max_tokens, model_name, keep='tail')
+
+    import numpy as np
+
+    scores = index.scores(query or '')
+    last = len(index.chunks) - 1
+    order = [last] + [int(i) for i in np.argsort(-scores, kind='stable') if i != last and scores[i] > 0]
+
+    selected = []
+    used = 0
+    separator_tokens = estimate_tokens(CHUNK_SEPARATOR, model_name)
+    for chunk_id in order:
+        cost = estimate_tokens(index.chunks[chunk_id], model_name) + separator_tokens
+        if used + cost > max_tokens:
+            continue
+        selected.append(chunk_id)
+        used += cost
+    if not selected:
+        return truncate_to_tokens(text, max_tokens, model_name, keep='tail')
+
+    return CHUNK_SEPARATOR.join(index.chunks[i] for i in sorted(selected))
@@ -0,0 +1,152 @@
+"""
+DuckDuckGo 検索の結果キャッシュと並列実行。
+
+• 正規化したクエリ (NFKC・小文字化・空白の圧縮) と region をキーに TTL 付き LRU でキャッシュ
+• 環境変数 WEB_SEARCH_CACHE_DB に SQLite のパスを指定すると、キャッシュをディスクにも保存し
+  プロセス再起動後も再利用する
+• search_many で複数クエリをスレッドプールで同時に検索する
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+
+DEFAULT_REGION = 'jp-jp'
+DEFAULT_MAX_RESULTS = 3
+WEB_SEARCH_CACHE_TTL = float(os.getenv('WEB_SEARCH_CACHE_TTL', '3600'))   # 秒
+WEB_SEARCH_CACHE_SIZE = int(os.getenv('WEB_SEARCH_CACHE_SIZE', '256'))
+WEB_SEARCH_CACHE_DB = os.getenv('WEB_SEARCH_CACHE_DB')                    # 例: instance/search_cache.db
+WEB_SEARCH_MAX_WORKERS = int(os.getenv('WEB_SEARCH_MAX_WORKERS', '4'))
+
+
+def normalize_query(query):
+    """表記ゆれ (全角/半角・大文字/小文字・連続空白) を吸収したクエリ"""
+    return ' '.join(unicodedata.normalize('NFKC', query or '').lower().split())
+
+
+class SearchCache:
+    """メモリ上の TTL + LRU キャッシュ。db_path があれば SQLite にも書き込む"""
+
+    def __init__(self, ttl, maxsize, db_path=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_ready = False
+
+    @contextmanager
+    def _connect(self):
+        """
+        SQLite の接続を開き、トランザクション (成功時にコミット) の終了後に閉じる。
+        ディレクトリとテーブルは初回の使用時に作成する (import 時にはファイルに触れない)。
+        """
+        if not self._db_ready:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        with closing(sqlite3.connect(self.db_path, timeout=5)) as conn:
+            if not self._db_ready:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS search_cache ("
+                    " key TEXT PRIMARY KEY, results TEXT NOT NULL, expires REAL NOT NULL)"
+                )
+                self._db_ready = True
+            with conn:
+                yield conn
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                del self._entries[key]
+        if not self.db_path:
+            return None
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT results, expires FROM search_cache WHERE key = ?", (key,)
+                ).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            print(f"検索キャッシュ (SQLite) の読み込みに失敗しました: {e}", file=sys.stderr)
+            return None
+        if row is None or row[1] <= now:
+            return None
+        results = json.loads(row[0])
+        self._remember(key, results, row[1])
+        return results
+
+    def put(self, key, results):
+        expires = time.time() + self.ttl
+        self._remember(key, results, expires)
+        if not self.db_path:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO search_cache (key, results, expires) VALUES (?, ?, ?)",
+                    (key, json.dumps(results, ensure_ascii=False), expires),
+                )
+                conn.execute("DELETE FROM search_cache WHERE expires <= ?", (time.time(),))
+        except (sqlite3.Error, OSError) as e:
+            print(f"検索キャッシュ (SQLite) の書き込みに失敗しました: {e}", file=sys.stderr)
+
+    def _remember(self, key, results, expires):
+        with self._lock:
+            self._entries[key] = (results, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+_cache = SearchCache(WEB_SEARCH_CACHE_TTL, WEB_SEARCH_CACHE_SIZE, WEB_SEARCH_CACHE_DB)
+_executor = ThreadPoolExecutor(max_workers=WEB_SEARCH_MAX_WORKERS, thread_name_prefix='web-search')
+
+
+def search(query, region=DEFAULT_REGION, max_results=DEFAULT_MAX_RESULTS):
+    """
+    DuckDuckGo のテキスト検索結果 (title / body / href の dict のリスト) を返す。
+    キャッシュにあれば通信しない。検索エラーは例外として送出する (キャッシュはしない)。
+    """
+    key = f"{region}|{max_results}|{normalize_query(query)}"
+    cached = _cache.get(key)
+    if cached is not None:
+        print(f"--- Web検索キャッシュヒット: {query} ---")
+        return cached
+
+    from duckduckgo_search import DDGS
+    with DDGS() as ddgs:
+        results = [r for r in ddgs.text(query, region=region, max_results=max_results)]
+    _cache.put(key, results)
+    return results
+
+
+def search_many(queries, region=DEFAULT_REGION, max_results=DEFAULT_MAX_RESULTS):
+    """
+    複数クエリを並列に検索し、クエリと同じ順序で結果を返す。
+    各要素は検索結果のリスト、失敗したクエリは発生した例外。
+    正規化後に同一のクエリは 1 回だけ検索する。
+    """
+    unique = {}
+    for query in queries:
+        unique.setdefault(normalize_query(query), query)
+    futures = {
+        normalized: _executor.submit(search, query, region, max_results)
+        for normalized, query in unique.items()
+    }
+    results = {}
+    for normalized, future in futures.items():
+        try:
+            results[normalized] = future.result()
+        except Exception as e:
+            results[normalized] = e
+    return [results[normalize_query(query)] for query in queries]
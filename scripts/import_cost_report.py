@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+コールドスタート時の import コストを計測する (python -X importtime を集計)。
+
+api/index.py (Vercel のエントリーポイント) を新しいプロセスで import し、
+• 合計時間
+• パッケージ (先頭のモジュール名) 毎の import 時間 (self の合計)
+• 累積時間の大きいモジュール上位
+を表示する。--save で結果を JSON に保存し、--baseline で前回の結果と比較できる。
+
+使い方:
+    python scripts/import_cost_report.py [--runs 3] [--top 20]
+    python scripts/import_cost_report.py --save instance/import_cost.json
+    python scripts/import_cost_report.py --baseline instance/import_cost.json --max-regression-ms 100
+
+import だけを計測するため、SUPABASE_URL などが未設定ならダミー値を設定して実行する。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET = "api.index"
+
+
+def measure(target):
+    """target を import する新しいプロセスを起動し、[(モジュール名, self_us, cumulative_us, 深さ)] を返す"""
+    env = dict(os.environ)
+    env.setdefault("SUPABASE_URL", "http://localhost")
+    env.setdefault("SUPABASE_ANON_KEY", "dummy")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        sys.exit(f"{target} の import に失敗しました:\n{proc.stderr[-2000:]}")
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return entries
+
+
+def summarize(entries):
+    """合計・パッケージ毎・モジュール毎の時間 (ms) にまとめる"""
+    packages = {}
+    for name, self_us, _, _ in entries:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us / 1000
+    return {
+        "total_ms": sum(cumulative for _, _, cumulative, depth in entries if depth == 0) / 1000,
+        "packages": packages,
+        "modules": {name: cumulative / 1000 for name, _, cumulative, _ in entries},
+    }
+
+
+def median_summary(summaries):
+    """複数回の計測結果の中央値 (ディスクキャッシュなどによるばらつきを抑える)"""
+    def median_of(key):
+        names = set().union(*(s[key] for s in summaries))
+        return {name: statistics.median(s[key].get(name, 0.0) for s in summaries) for name in names}
+    return {
+        "total_ms": statistics.median(s["total_ms"] for s in summaries),
+        "packages": median_of("packages"),
+        "modules": median_of("modules"),
+    }
+
+
+def print_report(report, top, baseline=None):
+    def diff(value, base):
+        return f" ({value - base:+8.1f})" if base is not None else ""
+
+    base_packages = baseline["packages"] if baseline else {}
+    print(f"合計: {report['total_ms']:.1f} ms"
+          + diff(report["total_ms"], baseline["total_ms"] if baseline else None))
+    print(f"\n--- パッケージ毎 (上位 {top}) ---")
+    for name, ms in sorted(report["packages"].items(), key=lambda kv: -kv[1])[:top]:
+        print(f"{ms:9.1f} ms{diff(ms, base_packages.get(name, 0.0) if baseline else None)}  {name}")
+    print(f"\n--- モジュール毎の累積時間 (上位 {top}) ---")
+    for name, ms in sorted(report["modules"].items(), key=lambda kv: -kv[1])[:top]:
+        print(f"{ms:9.1f} ms  {name}")
+    if baseline:
+        added = sorted(set(report["packages"]) - set(base_packages))
+        if added:
+            print(f"\n新たに読み込まれるパッケージ: {', '.join(added)}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="コールドスタート時の import コストを計測する")
+    parser.add_argument("--target", default=TARGET, help="import するモジュール")
+    parser.add_argument("--runs", type=int, default=3, help="計測回数 (中央値を表示)")
+    parser.add_argument("--top", type=int, default=20, help="表示する件数")
+    parser.add_argument("--save", help="結果を保存する JSON ファイル")
+    parser.add_argument("--baseline", help="比較する前回の結果 (--save で保存した JSON)")
+    parser.add_argument("--max-regression-ms", type=float,
+                        help="合計時間が baseline よりこの値以上増えたら終了コード 1 で終了する")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = median_summary([summarize(measure(args.target)) for _ in range(max(args.runs, 1))])
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    print(f"=== {args.target} の import コスト ({args.runs} 回の中央値) ===")
+    print_report(report, args.top, baseline)
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or ".", exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を保存しました: {args.save}")
+
+    if baseline and args.max_regression_ms is not None:
+        regression = report["total_ms"] - baseline["total_ms"]
+        if regression >= args.max_regression_ms:
+            sys.exit(f"import 時間が {regression:.1f} ms 増えています (許容: {args.max_regression_ms} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,60 @@
 SQLite (wallbounce.db) -> Supabase へデータ移行
 既存データは保持し、SQLite 側の id は捨てて新しい id を採番。
 chat_messages.document_id だけ、旧→新 id 対応表で書き換える。
+
+• SQLite からは fetchmany で BATCH_SIZE 行ずつ読み、1 バッチを 1 回の upsert で送る
+• 旧 id を legacy_id (一意) に入れて on conflict do nothing で upsert するため、
+  再試行や中断後の再実行で同じ行を二重に挿入しない
+  (supabase/migrations/20261018160000_legacy_ids.sql の適用が必要)
+• documents はバッチを最大 WORKERS 並列で送信する
+• chat_messages はドキュメント単位で並列にし、1 つのドキュメントのメッセージは旧 id 順に直列で送る
+  (新しい id の順序 = 時系列。履歴のページングや会話要約の last_message_id がこの順序に依存する)
+• 完了したバッチ・ドキュメントはチェックポイントファイル (旧→新 id 対応表と移行済みドキュメント) に記録し、
+  中断しても再実行すれば続きから移行する (最初からやり直す場合は --fresh)
+• 進捗 (行数・行/秒) を随時表示する
+
+使い方:
+    SUPABASE_URL=... SUPABASE_KEY=<service_role key> \
+        python scripts/migrate_sqlite_to_supabase.py [--batch-size 500] [--workers 4]
 """
 
-import os, sqlite3, json
+import argparse
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
-from supabase import create_client
+
 from postgrest.exceptions import APIError
+from postgrest.types import ReturnMethod
+from supabase import create_client
 
 # --- 環境変数 ---
 SUPA_URL = os.getenv("SUPABASE_URL")
 SUPA_KEY = os.getenv("SUPABASE_KEY")
 SQLITE_PATH = "instance/wallbounce.db"
+CHECKPOINT_PATH = "instance/migration_checkpoint.json"
+CHECKPOINT_FORMAT = 2  # legacy_id で upsert する形式
+
+BATCH_SIZE = 500      # 1 回の upsert で送る行数
+WORKERS = 4           # 同時に送信するバッチ (chat_messages はドキュメント) 数
+MAX_RETRIES = 3       # バッチ送信の再試行回数
+
+_local = threading.local()
+
+
+def supabase():
+    """スレッド毎の Supabase クライアント (HTTP コネクションをスレッド間で共有しない)"""
+    client = getattr(_local, "client", None)
+    if client is None:
+        client = create_client(SUPA_URL, SUPA_KEY)
+        _local.client = client
+    return client
 
-supabase = create_client(SUPA_URL, SUPA_KEY)
 
 def iso(dt):
     """datetime -> ISO 文字列 (None 安全)"""
@@ -23,64 +64,247 @@ def iso(dt):
         return dt.isoformat()
     return dt
 
-def migrate_documents(cur):
-    """SQLite documents -> Supabase documents へ。旧→新 id マップを返す"""
-    rows = cur.execute("SELECT * FROM documents").fetchall()
-    cols = [d[0] for d in cur.description]
-    id_map = {}
 
-    for row in rows:
-        data = dict(zip(cols, row))
-        old_id = data.pop("id")           # 旧 id は捨てる
-        data["created_at"] = iso(data["created_at"])
-        data["updated_at"] = iso(data["updated_at"])
+class Checkpoint:
+    """
+    移行の途中経過をファイルに保存する。
+      documents      : 旧 id -> 新 id
+      chat_documents : メッセージをすべて移行した旧ドキュメント id
+                       (ドキュメントが未移行でスキップしたものは含まない。再実行時に再度移行を試みる)
+    """
+
+    def __init__(self, path, fresh=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self.id_map = {}
+        self.message_documents = set()
+        if not fresh and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("format") != CHECKPOINT_FORMAT:
+                # 旧形式は legacy_id なしで挿入しているため、続きから upsert すると重複を検出できない
+                sys.exit(f"{path} は旧形式のチェックポイントです。移行済みの行を削除してから --fresh で実行してください。")
+            self.id_map = {int(k): v for k, v in data.get("documents", {}).items()}
+            self.message_documents = set(data.get("chat_documents", []))
+            print(f"チェックポイントから再開: documents={len(self.id_map)} 行, "
+                  f"chat_messages={len(self.message_documents)} ドキュメント移行済み")
+
+    def add_documents(self, pairs):
+        with self._lock:
+            self.id_map.update(pairs)
+            self._save()
+
+    def add_message_document(self, old_doc_id):
+        with self._lock:
+            self.message_documents.add(old_doc_id)
+            self._save()
+
+    def _save(self):
+        # 書き込み途中で中断しても壊れないよう一時ファイル経由で置き換える
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "format": CHECKPOINT_FORMAT,
+                "documents": {str(k): v for k, v in self.id_map.items()},
+                "chat_documents": sorted(self.message_documents),
+            }, f)
+        os.replace(tmp_path, self.path)
+
+
+class Progress:
+    """移行行数とスループットを表示する"""
+
+    def __init__(self, table, total):
+        self.table = table
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, ok=0, failed=0):
+        with self._lock:
+            self.done += ok
+            self.failed += failed
+            elapsed = max(time.monotonic() - self.started, 1e-6)
+            print(f"[{self.table}] {self.done}/{self.total} 行 "
+                  f"({self.done / elapsed:.1f} 行/秒, 失敗 {self.failed} 行)", flush=True)
+
 
+def upsert_batch(table, rows, returning=True):
+    """
+    rows (legacy_id 付き) を 1 回の upsert で挿入する。legacy_id が既にある行は何もしない (on conflict do nothing)。
+    送信は冪等なので、一時的なエラー (タイムアウト後にサーバー側でコミット済みの場合も含む) は再試行する。
+    returning=True なら今回挿入した行を返す (既存の行は含まない)。
+    """
+    method = ReturnMethod.representation if returning else ReturnMethod.minimal
+    for attempt in range(1, MAX_RETRIES + 1):
         try:
-            res = supabase.table("documents").insert(data).execute()
-            new_id = res.data[0]["id"]
-            id_map[old_id] = new_id
-        except APIError as e:
-            print("documents insert error:", e)
+            return supabase().table(table).upsert(
+                rows, on_conflict="legacy_id", ignore_duplicates=True, returning=method
+            ).execute().data
+        except APIError:
+            # 制約違反などデータ起因のエラーは再試行しても成功しない
+            raise
+        except Exception as e:
+            if attempt == MAX_RETRIES:
+                raise
+            print(f"{table} upsert 再試行 ({attempt}/{MAX_RETRIES - 1}): {e}", file=sys.stderr)
+            time.sleep(2 ** attempt)
 
-    print(f"[documents] 移行完了: {len(id_map)} 行")
-    return id_map
 
-def migrate_chat_messages(cur, id_map):
-    rows = cur.execute("SELECT * FROM chat_messages").fetchall()
+def lookup_legacy_ids(table, legacy_ids):
+    """legacy_id -> 新 id (前回までの実行で挿入済みの行)"""
+    rows = supabase().table(table).select("id, legacy_id").in_("legacy_id", list(legacy_ids)).execute().data
+    return {row["legacy_id"]: row["id"] for row in rows}
+
+
+def read_batches(cur, query, batch_size):
+    """SQLite から batch_size 行ずつ dict のリストとして読む"""
+    cur.execute(query)
     cols = [d[0] for d in cur.description]
-    n_ok, n_skip = 0, 0
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield [dict(zip(cols, row)) for row in rows]
 
-    for row in rows:
-        data = dict(zip(cols, row))
-        data.pop("id")                       # id は自動採番
-        old_doc_id = data.pop("document_id")
-        new_doc_id = id_map.get(old_doc_id)
 
-        if not new_doc_id:
-            n_skip += 1
-            continue            # 対応するドキュメントが無ければスキップ
+def run_parallel(batches, handle_batch, workers):
+    """batches を最大 workers 並列で handle_batch に渡す (読み込みが送信を追い越さないよう上限付き)"""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        for batch in batches:
+            if len(in_flight) >= workers * 2:
+                _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            in_flight.add(executor.submit(handle_batch, batch))
+        wait(in_flight)
+
 
-        data["document_id"] = new_doc_id
-        data["timestamp"]    = iso(data["timestamp"])
+def migrate_documents(con, checkpoint, batch_size, workers):
+    """SQLite documents -> Supabase documents へ。旧→新 id マップを返す"""
+    total = con.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+    progress = Progress("documents", total)
+    progress.add(ok=len(checkpoint.id_map))
+
+    def pending_batches():
+        for rows in read_batches(con.cursor(), "SELECT * FROM documents ORDER BY id", batch_size):
+            rows = [r for r in rows if r["id"] not in checkpoint.id_map]
+            if rows:
+                yield rows
 
+    def handle_batch(rows):
+        old_ids = []
+        payload = []
+        for data in rows:
+            old_id = data.pop("id")                  # 旧 id は legacy_id に残し、id は自動採番
+            old_ids.append(old_id)
+            data["legacy_id"] = old_id
+            data["created_at"] = iso(data["created_at"])
+            data["updated_at"] = iso(data["updated_at"])
+            payload.append(data)
         try:
-            supabase.table("chat_messages").insert(data).execute()
-            n_ok += 1
-        except APIError as e:
-            print("chat_messages insert error:", e)
+            inserted = {row["legacy_id"]: row["id"] for row in upsert_batch("documents", payload)}
+            missing = [old_id for old_id in old_ids if old_id not in inserted]
+            if missing:
+                # 前回の実行 (チェックポイント保存前に中断) で挿入済みの行
+                inserted.update(lookup_legacy_ids("documents", missing))
+        except Exception as e:
+            print("documents upsert error:", e, file=sys.stderr)
+            progress.add(failed=len(rows))
+            return
+        checkpoint.add_documents(inserted.items())
+        progress.add(ok=len(inserted))
+
+    run_parallel(pending_batches(), handle_batch, workers)
+    print(f"[documents] 移行完了: {len(checkpoint.id_map)} 行")
+    return checkpoint.id_map
+
+
+def read_document_messages(con, batch_size):
+    """SQLite の chat_messages を (旧ドキュメント id, 旧 id 順のメッセージのリスト) ごとに読む"""
+    rows = itertools.chain.from_iterable(
+        read_batches(con.cursor(), "SELECT * FROM chat_messages ORDER BY document_id, id", batch_size)
+    )
+    for old_doc_id, messages in itertools.groupby(rows, key=lambda row: row["document_id"]):
+        yield old_doc_id, list(messages)
+
+
+def migrate_chat_messages(con, checkpoint, id_map, batch_size, workers):
+    """
+    SQLite chat_messages -> Supabase chat_messages へ。
+    ドキュメント単位で並列に移行し、1 つのドキュメントのメッセージは旧 id 順にバッチを直列で送る
+    (途中のバッチが失敗したら、そのドキュメントの残りは送らず次回の実行に回す)。
+    """
+    total = con.execute("SELECT COUNT(*) FROM chat_messages").fetchone()[0]
+    progress = Progress("chat_messages", total)
+    counts = dict(con.execute("SELECT document_id, COUNT(*) FROM chat_messages GROUP BY document_id"))
+    progress.add(ok=sum(counts.get(doc_id, 0) for doc_id in checkpoint.message_documents))
+    skipped = 0
+    lock = threading.Lock()
+
+    def pending_documents():
+        for old_doc_id, messages in read_document_messages(con, batch_size):
+            if old_doc_id not in checkpoint.message_documents:
+                yield old_doc_id, messages
+
+    def handle_document(item):
+        nonlocal skipped
+        old_doc_id, messages = item
+        new_doc_id = id_map.get(old_doc_id)
+        if not new_doc_id:
+            # 対応するドキュメントが無ければスキップ (ドキュメントの移行に失敗した分は次回に再試行)
+            with lock:
+                skipped += len(messages)
+            return
+        for start in range(0, len(messages), batch_size):
+            payload = []
+            for data in messages[start:start + batch_size]:
+                data = dict(data)
+                data["legacy_id"] = data.pop("id")   # id は自動採番
+                data["document_id"] = new_doc_id
+                data["timestamp"] = iso(data["timestamp"])
+                payload.append(data)
+            try:
+                upsert_batch("chat_messages", payload, returning=False)
+            except Exception as e:
+                print(f"chat_messages upsert error (document {old_doc_id}):", e, file=sys.stderr)
+                progress.add(failed=len(messages) - start)
+                return
+            progress.add(ok=len(payload))
+        checkpoint.add_message_document(old_doc_id)
+
+    run_parallel(pending_documents(), handle_document, workers)
+    print(f"[chat_messages] 移行完了: OK={progress.done} / SKIP(docなし)={skipped} / 失敗={progress.failed}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="SQLite -> Supabase データ移行")
+    parser.add_argument("--sqlite", default=SQLITE_PATH, help="移行元 SQLite ファイル")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH, help="チェックポイントファイル")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="1 回の upsert で送る行数")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="同時に送信するバッチ (ドキュメント) 数")
+    parser.add_argument("--fresh", action="store_true", help="チェックポイントを無視して最初から移行する")
+    return parser.parse_args()
 
-    print(f"[chat_messages] 移行完了: OK={n_ok} / SKIP(docなし)={n_skip}")
 
 def main():
-    con = sqlite3.connect(SQLITE_PATH)
-    cur = con.cursor()
+    args = parse_args()
+    if not SUPA_URL or not SUPA_KEY:
+        sys.exit("SUPABASE_URL と SUPABASE_KEY を設定してください。")
+
+    # 読み込みはメインスレッドだけで行う
+    con = sqlite3.connect(args.sqlite)
+    checkpoint = Checkpoint(args.checkpoint, fresh=args.fresh)
+    started = time.monotonic()
 
-    mapping = migrate_documents(cur)
-    migrate_chat_messages(cur, mapping)
+    mapping = migrate_documents(con, checkpoint, args.batch_size, args.workers)
+    migrate_chat_messages(con, checkpoint, mapping, args.batch_size, args.workers)
 
-    cur.close()
     con.close()
-    print("=== 移行処理が完了しました ===")
+    print(f"=== 移行処理が完了しました ({time.monotonic() - started:.1f} 秒) ===")
+    print(f"チェックポイント: {args.checkpoint} (再実行時は移行済みの行をスキップします)")
 
 if __name__ == "__main__":
     main()
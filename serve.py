@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+本番用のサーバー起動スクリプト (常駐サーバー向け。Vercel では api/index.py が使われる)
+
+    python serve.py
+
+`python app.py` は開発用 (threading モード + デバッグ)。こちらは gevent / eventlet の
+協調スレッド (グリーンスレッド) で動かし、1 プロセスで多数の SocketIO 接続と
+ストリーミング応答を同時に扱う。
+
+ワーカーモデル:
+• 1 プロセス・1 OS スレッドの中で、接続 (HTTP リクエスト / WebSocket) 毎にグリーンスレッドを割り当てる
+• LLM / Supabase / Web 検索の HTTP 通信は monkey patch 済みのソケットで行われるため、
+  待ち時間中は他の接続に切り替わる (threading.Semaphore や ThreadPoolExecutor もグリーンスレッド化される)
+• CPU を使う処理 (Delta の適用、BM25 など) の間は他の接続が止まるため、
+  CPU コア数を活かしたい場合はプロセスを複数起動し、ロードバランサのスティッキーセッションで振り分ける
+• 同時接続数は SERVER_MAX_CONNECTIONS、外部 API への同時実行数は LLM_CONCURRENCY、
+  Supabase への接続数は POSTGREST_MAX_CONNECTIONS で別々に上限を設ける
+
+monkey patch はソケットやスレッドを使うモジュール (SDK・httpx・app 配下) を import する前に
+行う必要があるため、このファイルでは patch より前に app を import しない。
+"""
+import importlib.util
+import os
+import pathlib
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# gevent (既定) / eventlet / threading
+ASYNC_MODE = os.getenv('ASYNC_MODE', 'gevent').lower()
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '5001'))
+# 1 プロセスで同時に処理する接続数 (WebSocket を含む) の上限
+SERVER_MAX_CONNECTIONS = int(os.getenv('SERVER_MAX_CONNECTIONS', '1000'))
+
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+elif ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE != 'threading':
+    raise SystemExit(f"ASYNC_MODE は gevent / eventlet / threading のいずれかを指定してください: {ASYNC_MODE}")
+
+if ASYNC_MODE != 'threading':
+    # Gemini SDK の gRPC は独自のスレッドでソケットを扱い monkey patch が効かないため、
+    # patch 済みソケットを使う REST トランスポートに切り替える
+    os.environ.setdefault('GEMINI_TRANSPORT', 'rest')
+os.environ['SOCKETIO_ASYNC_MODE'] = ASYNC_MODE
+# 本番では接続毎の engineio ログを出さない
+os.environ.setdefault('SOCKETIO_DEBUG_LOG', '0')
+
+# app/ パッケージと名前が衝突するため、api/index.py と同様にファイルパスから app.py を読み込む
+_spec = importlib.util.spec_from_file_location(
+    'flask_app_module', pathlib.Path(__file__).resolve().parent / 'app.py')
+_module = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_module)
+app = _module.app
+socketio = _module.socketio
+
+
+def main():
+    run_options = {}
+    if ASYNC_MODE == 'gevent':
+        from gevent.pool import Pool
+        run_options['spawn'] = Pool(SERVER_MAX_CONNECTIONS)
+    elif ASYNC_MODE == 'eventlet':
+        run_options['max_size'] = SERVER_MAX_CONNECTIONS
+    else:
+        run_options['allow_unsafe_werkzeug'] = True
+
+    print(f"サーバーを起動します: {HOST}:{PORT} (async_mode={ASYNC_MODE}, "
+          f"max_connections={SERVER_MAX_CONNECTIONS})")
+    socketio.run(app, host=HOST, port=PORT, debug=False, use_reloader=False,
+                 log_output=os.getenv('SERVER_ACCESS_LOG', '0') == '1', **run_options)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+-- 基本のテーブル (documents / chat_messages) の初期化
+-- supabase/migrations はこの 2 つのテーブルがある前提で列・関数・インデックスを追加するため、
+-- 新しいプロジェクト (ローカルを含む) ではマイグレーションより先に 1 回だけ実行する:
+--     psql "$DATABASE_URL" -f supabase/bootstrap.sql && supabase db push
+-- マイグレーションではない (日時順の適用履歴に入らない)。Supabase ダッシュボードで
+-- テーブルを作成済みのプロジェクトでは不要 (実行しても if not exists のため何も変更しない)。
+
+create table if not exists public.documents (
+    id         bigint generated by default as identity primary key,
+    title      text not null default '無題のドキュメント',
+    content    text not null default '',
+    user_id    uuid references auth.users (id) default auth.uid(),
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now()
+);
+
+create table if not exists public.chat_messages (
+    id               bigint generated by default as identity primary key,
+    document_id      bigint not null references public.documents (id) on delete cascade,
+    role             text not null,                 -- 'user' / 'assistant'
+    content          text not null default '',
+    timestamp        timestamptz not null default now(),
+    model_used       text,
+    thinking_enabled boolean not null default false,
+    user_id          uuid references auth.users (id) default auth.uid()
+);
+
+alter table if exists public.documents enable row level security;
+alter table if exists public.chat_messages enable row level security;
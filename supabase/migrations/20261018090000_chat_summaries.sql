@@ -0,0 +1,19 @@
+-- 会話要約テーブル
+-- 古い chat_messages をバックグラウンドで要約した結果をドキュメント毎に1行保持する。
+-- last_message_id までのメッセージが summary に含まれている。
+
+create table if not exists public.chat_summaries (
+    document_id     bigint primary key references public.documents (id) on delete cascade,
+    user_id         uuid references auth.users (id) default auth.uid(),
+    summary         text not null default '',
+    last_message_id bigint not null,
+    updated_at      timestamptz not null default now()
+);
+
+alter table public.chat_summaries enable row level security;
+
+drop policy if exists "chat_summaries_owner" on public.chat_summaries;
+create policy "chat_summaries_owner" on public.chat_summaries
+    for all
+    using (user_id = auth.uid())
+    with check (user_id = auth.uid());
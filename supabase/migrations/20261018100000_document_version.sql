@@ -0,0 +1,26 @@
+-- ドキュメントのバージョン列
+-- 差分保存 (PATCH /api/document/<id>) の楽観的排他制御に使う。
+-- content が変わる更新のたびにトリガーで version を 1 つ進め、updated_at を更新する。
+
+alter table public.documents
+    add column if not exists version bigint not null default 0;
+
+create or replace function public.documents_bump_version()
+returns trigger
+language plpgsql
+as $$
+begin
+    if new.content is distinct from old.content then
+        new.version := old.version + 1;
+    else
+        new.version := old.version;
+    end if;
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists documents_bump_version on public.documents;
+create trigger documents_bump_version
+    before update on public.documents
+    for each row execute function public.documents_bump_version();
@@ -0,0 +1,28 @@
+-- 一覧用のプレビュー列
+-- /api/document/list は content (Quill Delta JSON) 全体を読まず、
+-- 先頭 150 文字のプレーンテキスト preview だけを返す。
+-- preview は content から自動計算される生成列 (保存時に更新される)。
+
+create or replace function public.document_preview(content text)
+returns text
+language plpgsql
+immutable
+as $$
+begin
+    if content is null or content = '' then
+        return '';
+    end if;
+    return left((
+        select coalesce(string_agg(t.op ->> 'insert', '' order by t.ord), '')
+        from jsonb_array_elements(content::jsonb -> 'ops') with ordinality as t(op, ord)
+        where jsonb_typeof(t.op -> 'insert') = 'string'
+    ), 150);
+exception when others then
+    -- Delta JSON でない content はそのまま先頭を使う
+    return left(content, 150);
+end;
+$$;
+
+alter table public.documents
+    add column if not exists preview text
+    generated always as (public.document_preview(content)) stored;
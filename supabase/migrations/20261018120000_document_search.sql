@@ -0,0 +1,177 @@
+-- ドキュメントとチャット履歴の全文検索
+-- /api/document/search が呼ぶ RPC search_documents と、その検索インデックス。
+--
+-- • 日本語は単語に区切られないため、Postgres の to_tsvector ではなく独自のトークナイザ
+--   (英数字は小文字化した単語、それ以外は文字 bi-gram。app/utils/retrieval.py の tokenize と同じ規則)
+--   で tsvector を作り、GIN インデックスで検索する
+-- • 検索語のトークンをすべて含む行がヒット (AND)。順位は ts_rank でタイトル (A) > 本文 (B) > チャット (C)
+-- • tsvector は列として保存せず、title / content から計算する式の GIN インデックスにする
+-- • RLS が効くよう関数は呼び出したユーザーの権限 (security invoker) で実行する
+
+-- Quill Delta JSON の insert 文字列を連結したプレーンテキスト
+create or replace function public.document_plain_text(content text)
+returns text
+language plpgsql
+immutable
+as $$
+begin
+    if content is null or content = '' then
+        return '';
+    end if;
+    return (
+        select coalesce(string_agg(t.op ->> 'insert', '' order by t.ord), '')
+        from jsonb_array_elements(content::jsonb -> 'ops') with ordinality as t(op, ord)
+        where jsonb_typeof(t.op -> 'insert') = 'string'
+    );
+exception when others then
+    -- Delta JSON でない content はそのまま使う
+    return content;
+end;
+$$;
+
+-- 検索用トークン (重複なし)
+create or replace function public.search_tokens(body text)
+returns text[]
+language sql
+immutable
+parallel safe
+as $$
+    select coalesce(array_agg(distinct t.token), '{}')
+    from (
+        -- 英数字は単語単位
+        select m[1] as token
+        from regexp_matches(lower(coalesce(body, '')), '([0-9a-z_]+)', 'g') as m
+        union all
+        -- ASCII 以外の連続部分は空白を除いて文字 bi-gram (1 文字だけならその文字)
+        select case when length(r.run) = 1 then r.run else substr(r.run, i, 2) end
+        from (
+            select regexp_replace(m[1], '[[:space:]　]', '', 'g') as run
+            from regexp_matches(lower(coalesce(body, '')), '([^\u0001-\u007f]+)', 'g') as m
+        ) as r,
+        generate_series(1, greatest(length(r.run) - 1, 1)) as i
+        where r.run <> ''
+    ) as t
+$$;
+
+-- 重み付きの tsvector (ts_rank で重みを使うため、各トークンに位置 1 と重みを付ける)
+create or replace function public.search_vector(body text, weight "char")
+returns tsvector
+language sql
+immutable
+parallel safe
+as $$
+    select coalesce(
+        (select string_agg(quote_literal(token) || ':1' || weight::text, ' ')
+         from unnest(public.search_tokens(body)) as token)::tsvector,
+        ''::tsvector
+    )
+$$;
+
+-- ドキュメントの tsvector (タイトル A + 本文 B)
+create or replace function public.document_search_vector(title text, content text)
+returns tsvector
+language sql
+immutable
+parallel safe
+as $$
+    select public.search_vector(title, 'A') || public.search_vector(public.document_plain_text(content), 'B')
+$$;
+
+-- 検索語 → 全トークンの AND (トークンが無ければ null)
+create or replace function public.search_query(query text)
+returns tsquery
+language sql
+immutable
+parallel safe
+as $$
+    select nullif(
+        (select string_agg(quote_literal(token), ' & ') from unnest(public.search_tokens(query)) as token),
+        ''
+    )::tsquery
+$$;
+
+-- 検索語が最初に現れる位置の前後を切り出したスニペット
+create or replace function public.search_snippet(body text, query text, width integer default 120)
+returns text
+language sql
+immutable
+parallel safe
+as $$
+    with source as (
+        select regexp_replace(coalesce(body, ''), '\s+', ' ', 'g') as body
+    ), hit as (
+        select s.body,
+               greatest(coalesce((
+                   select min(nullif(strpos(lower(s.body), token), 0))
+                   from unnest(public.search_tokens(query)) as token
+               ), 1) - width / 4, 1) as start
+        from source as s
+    )
+    select case when h.start > 1 then '…' else '' end
+           || substr(h.body, h.start, width)
+           || case when length(h.body) >= h.start + width then '…' else '' end
+    from hit as h
+$$;
+
+-- 検索用の式インデックス (列は追加しないため、select('*') の応答は大きくならない)。
+-- 下の search_documents はインデックスと同じ式で検索する
+create index if not exists documents_search_idx
+    on public.documents using gin (public.document_search_vector(title, content));
+
+create index if not exists chat_messages_search_idx
+    on public.chat_messages using gin (public.search_vector(content, 'C'));
+
+-- 検索 RPC
+--   query_text : 検索語
+--   scope      : 'all' / 'documents' / 'chats'
+--   page_size, page_offset : ページング (順位順)
+-- 一致判定は GIN インデックスで行い、スニペットは返すページの行だけで計算する
+create or replace function public.search_documents(
+    query_text text,
+    scope text default 'all',
+    page_size integer default 20,
+    page_offset integer default 0
+)
+returns table (
+    kind text,
+    document_id bigint,
+    title text,
+    message_id bigint,
+    role text,
+    snippet text,
+    rank real,
+    updated_at timestamptz,
+    document_updated_at timestamptz
+)
+language sql
+stable
+security invoker
+as $$
+    with hits as (
+        select 'document'::text as kind, d.id::bigint as document_id, null::bigint as message_id,
+               ts_rank(public.document_search_vector(d.title, d.content), public.search_query(query_text)) as rank,
+               d.updated_at::timestamptz as updated_at
+        from public.documents as d
+        where scope in ('all', 'documents')
+          and public.document_search_vector(d.title, d.content) @@ public.search_query(query_text)
+        union all
+        select 'chat'::text, m.document_id::bigint, m.id::bigint,
+               ts_rank(public.search_vector(m.content, 'C'), public.search_query(query_text)),
+               m.timestamp::timestamptz
+        from public.chat_messages as m
+        where scope in ('all', 'chats')
+          and public.search_vector(m.content, 'C') @@ public.search_query(query_text)
+        order by rank desc, updated_at desc, document_id desc, message_id nulls first
+        limit page_size offset page_offset
+    )
+    select h.kind, h.document_id, d.title::text, h.message_id, m.role::text,
+           public.search_snippet(
+               case when h.kind = 'chat' then m.content else public.document_plain_text(d.content) end,
+               query_text
+           ),
+           h.rank, h.updated_at, d.updated_at::timestamptz
+    from hits as h
+    join public.documents as d on d.id = h.document_id
+    left join public.chat_messages as m on m.id = h.message_id
+    order by h.rank desc, h.updated_at desc, h.document_id desc, h.message_id nulls first
+$$;
@@ -0,0 +1,61 @@
+-- チャット 1 ターンの開始 (RPC begin_chat_turn)
+-- /api/chat/send と SocketIO の chat_send が AI 応答の生成前に 1 回だけ呼ぶ。
+--
+-- • ドキュメントの取得・会話要約の取得・直近の履歴の取得・ユーザーメッセージの保存を
+--   1 回の呼び出し (1 トランザクション) で行い、PostgREST への往復を 1 回にまとめる
+-- • 呼び出したユーザーの権限 (security invoker) で実行するため RLS がそのまま効く。
+--   加えて、他のユーザーのドキュメントには書き込まないよう user_id を明示的に確認する
+-- • ドキュメントが見つからない (または他のユーザーのもの) なら何も保存せず null を返す
+-- • 返す履歴は今回のユーザーメッセージを含まない直近 history_limit 件 (古い順)
+-- • content の Markdown 変換はアプリ側で行う (変換結果は (id, updated_at) 毎にキャッシュされる)
+
+create or replace function public.begin_chat_turn(
+    doc_id bigint,
+    user_message text,
+    model_name text default null,
+    thinking boolean default false,
+    history_limit integer default 25
+)
+returns jsonb
+language plpgsql
+volatile
+security invoker
+as $$
+declare
+    doc public.documents;
+    history jsonb;
+    summary jsonb;
+    message_id bigint;
+begin
+    select * into doc from public.documents as d where d.id = doc_id;
+    if not found or (doc.user_id is not null and doc.user_id is distinct from auth.uid()) then
+        return null;
+    end if;
+
+    select coalesce(jsonb_agg(to_jsonb(h) order by h.timestamp, h.id), '[]'::jsonb)
+    into history
+    from (
+        select m.id, m.role, m.content, m.timestamp, m.model_used, m.thinking_enabled
+        from public.chat_messages as m
+        where m.document_id = doc_id
+        order by m.timestamp desc, m.id desc
+        limit history_limit
+    ) as h;
+
+    select jsonb_build_object('summary', s.summary, 'last_message_id', s.last_message_id)
+    into summary
+    from public.chat_summaries as s
+    where s.document_id = doc_id;
+
+    insert into public.chat_messages (document_id, role, content, model_used, thinking_enabled, user_id)
+    values (doc_id, 'user', user_message, model_name, coalesce(thinking, false), auth.uid())
+    returning id into message_id;
+
+    return jsonb_build_object(
+        'document', to_jsonb(doc),
+        'messages', history,
+        'summary', summary,
+        'user_message_id', message_id
+    );
+end;
+$$;
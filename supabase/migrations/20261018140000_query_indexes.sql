@@ -0,0 +1,44 @@
+-- よく使う問い合わせに合わせたインデックスと RLS ポリシー
+-- 確認は scripts/explain_queries.py (app/models/database.py の各問い合わせを EXPLAIN ANALYZE する)。
+--
+-- • documents の一覧・最新 ID: RLS の user_id = auth.uid() で絞り込み、updated_at desc, id desc の順
+--   (キーセットページングのカーソルも同じ列) → (user_id, updated_at desc, id desc)
+-- • chat_messages の履歴: document_id で絞り込み、timestamp, id の順 (直近 N 件は逆順に読む)
+--   → (document_id, timestamp, id)。document_id の外部キー (削除時のカスケード) にも使われる
+-- • ポリシーの auth.uid() は (select auth.uid()) と書き、行毎ではなく問い合わせ毎に 1 回だけ評価させる
+-- • 同じ名前のポリシーは作り直す。別の名前で作成済みの緩いポリシーがあれば削除すること
+--   (permissive なポリシーは OR で結合される)
+
+create index if not exists documents_user_updated_at_idx
+    on public.documents (user_id, updated_at desc, id desc);
+
+create index if not exists chat_messages_document_timestamp_idx
+    on public.chat_messages (document_id, timestamp, id);
+
+-- documents: 作成者だけが読み書きできる
+drop policy if exists "documents_owner" on public.documents;
+create policy "documents_owner" on public.documents
+    for all
+    to authenticated
+    using (user_id = (select auth.uid()))
+    with check (user_id = (select auth.uid()));
+
+-- chat_messages: 作成者だけが読み書きでき、書き込めるのは自分のドキュメントへのメッセージだけ
+-- (exists の中の documents にも RLS が効く。主キーでの 1 行の確認)
+drop policy if exists "chat_messages_owner" on public.chat_messages;
+create policy "chat_messages_owner" on public.chat_messages
+    for all
+    to authenticated
+    using (user_id = (select auth.uid()))
+    with check (
+        user_id = (select auth.uid())
+        and exists (select 1 from public.documents as d where d.id = document_id)
+    );
+
+-- chat_summaries: 既存のポリシーを同じ書き方にそろえる
+drop policy if exists "chat_summaries_owner" on public.chat_summaries;
+create policy "chat_summaries_owner" on public.chat_summaries
+    for all
+    to authenticated
+    using (user_id = (select auth.uid()))
+    with check (user_id = (select auth.uid()));
@@ -0,0 +1,42 @@
+-- 1 文字の検索語で一致させる (全文検索の索引に日本語などの 1 文字も載せる)
+-- 20261018120000_document_search.sql では非 ASCII を bi-gram だけで索引化していたため、
+-- 「犬」のような 1 文字の検索語 (search_query では unigram になる) が何にも一致しなかった。
+--
+-- • 索引側 (search_vector) は search_tokens に非 ASCII の 1 文字を加えたトークンを使う
+--   (app/utils/retrieval.py の search_index_tokens と同じ規則)
+-- • 検索語側 (search_query) は search_tokens のまま。2 文字以上の検索語は従来どおり bi-gram の AND
+-- • 式インデックスの関数を変えるため、最後に検索インデックスを作り直す
+
+-- 索引用のトークン (重複なし)
+create or replace function public.search_index_tokens(body text)
+returns text[]
+language sql
+immutable
+parallel safe
+as $$
+    select coalesce(array_agg(distinct t.token), '{}')
+    from (
+        select unnest(public.search_tokens(body)) as token
+        union
+        -- ASCII 以外の 1 文字 (空白を除く)
+        select c.ch
+        from regexp_split_to_table(lower(coalesce(body, '')), '') as c(ch)
+        where c.ch ~ '[^\u0001-\u007f]' and c.ch !~ '[[:space:]　]'
+    ) as t
+$$;
+
+create or replace function public.search_vector(body text, weight "char")
+returns tsvector
+language sql
+immutable
+parallel safe
+as $$
+    select coalesce(
+        (select string_agg(quote_literal(token) || ':1' || weight::text, ' ')
+         from unnest(public.search_index_tokens(body)) as token)::tsvector,
+        ''::tsvector
+    )
+$$;
+
+reindex index public.documents_search_idx;
+reindex index public.chat_messages_search_idx;
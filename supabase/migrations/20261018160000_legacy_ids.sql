@@ -0,0 +1,10 @@
+-- SQLite (wallbounce.db) からの移行元の id (scripts/migrate_sqlite_to_supabase.py)
+-- 移行スクリプトは legacy_id を一意キーに upsert (on conflict do nothing) するため、
+-- 再試行や中断後の再実行で同じ行を二重に挿入しない。アプリからは使わない (移行していない行は null)。
+-- on_conflict に使うため部分インデックスではなく通常の一意インデックスにする (null は重複とみなされない)。
+
+alter table public.documents add column if not exists legacy_id bigint;
+alter table public.chat_messages add column if not exists legacy_id bigint;
+
+create unique index if not exists documents_legacy_id_key on public.documents (legacy_id);
+create unique index if not exists chat_messages_legacy_id_key on public.chat_messages (legacy_id);
@@ -0,0 +1,41 @@
+-- 会話要約の保存 (RPC save_chat_summary)
+-- バックグラウンドの要約 (app/utils/chat_compaction.py) が要約し終えたときに呼ぶ。
+--
+-- • 要約した最後のメッセージ (last_message_id) がまだ残っている場合だけ保存する。
+--   要約の生成中にチャット履歴がリセットされると、削除済みの会話の要約を書き戻してしまうため
+-- • リセット (POST /api/chat/reset/<id>) はメッセージを削除してから要約を削除するので、
+--   メッセージ削除より後の保存はここで弾かれ、それより前の保存は要約の削除で消える
+-- • 確認と保存は 1 つの文で行う。呼び出したユーザーの権限 (security invoker) で実行し RLS がそのまま効く
+-- • 保存しなかった場合は null を返す
+
+create or replace function public.save_chat_summary(
+    doc_id bigint,
+    summary_text text,
+    last_message_id bigint
+)
+returns jsonb
+language plpgsql
+volatile
+security invoker
+as $$
+declare
+    saved public.chat_summaries;
+begin
+    insert into public.chat_summaries as s (document_id, user_id, summary, last_message_id, updated_at)
+    select doc_id, auth.uid(), summary_text, save_chat_summary.last_message_id, now()
+    where exists (
+        select 1 from public.chat_messages as m
+        where m.id = save_chat_summary.last_message_id and m.document_id = doc_id
+    )
+    on conflict (document_id) do update
+        set summary = excluded.summary,
+            last_message_id = excluded.last_message_id,
+            updated_at = excluded.updated_at
+    returning * into saved;
+
+    if not found then
+        return null;
+    end if;
+    return to_jsonb(saved);
+end;
+$$;
@@ -0,0 +1,52 @@
+import pytest
+from flask import Flask, g
+
+from app.models import sqlite_storage
+from app.utils import chat_compaction
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(sqlite_storage, '_pool', sqlite_storage._ConnectionPool(str(tmp_path / 'test.db'), 2))
+    for name in ('get_chat_messages', 'get_chat_summary', 'upsert_chat_summary'):
+        monkeypatch.setattr(chat_compaction, name, getattr(sqlite_storage, name))
+    monkeypatch.setattr(chat_compaction, 'COMPACTION_TRIGGER_MESSAGES', 4)
+    monkeypatch.setattr(chat_compaction, 'COMPACTION_KEEP_RECENT', 2)
+    app = Flask(__name__)
+    with app.app_context():
+        g.current_user = 'user-a'
+        yield sqlite_storage
+    sqlite_storage._pool.close()
+
+
+def _create_thread(storage, count=6):
+    doc = storage.create_document('メモ', '')
+    for i in range(count):
+        storage.create_chat_message(doc['id'], 'user' if i % 2 == 0 else 'assistant', f'メッセージ {i}')
+    return doc['id']
+
+
+def test_compaction_saves_summary(storage, monkeypatch):
+    doc_id = _create_thread(storage)
+    monkeypatch.setattr(chat_compaction, '_summarize', lambda prompt: '要約')
+
+    assert chat_compaction.compact_chat_history(doc_id, user_id='user-a')
+    summary = storage.get_chat_summary(doc_id)
+    messages = storage.get_chat_messages(doc_id)
+    assert summary['summary'] == '要約'
+    assert summary['last_message_id'] == messages[-3]['id']
+
+
+def test_reset_during_compaction_discards_summary(storage, monkeypatch):
+    doc_id = _create_thread(storage)
+
+    def summarize_while_reset(prompt):
+        # 要約の生成中にチャット履歴がリセットされる (reset_chat_history と同じ順で削除)
+        storage.delete_chat_messages(doc_id)
+        storage.delete_chat_summary(doc_id)
+        return '削除済みの会話の要約'
+
+    monkeypatch.setattr(chat_compaction, '_summarize', summarize_while_reset)
+
+    assert not chat_compaction.compact_chat_history(doc_id, user_id='user-a')
+    assert storage.get_chat_summary(doc_id) is None
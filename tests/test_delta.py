@@ -0,0 +1,31 @@
+import json
+
+import pytest
+
+from app.utils.delta import DeltaError, apply_delta
+
+
+def _text(content):
+    return ''.join(op['insert'] for op in json.loads(content)['ops'])
+
+
+def test_emoji_counts_as_two_utf16_units():
+    content = json.dumps({'ops': [{'insert': 'Hello 😀 world\n'}]})
+    # 😀 (6〜7) の後ろに挿入し、直後の空白を削除する
+    result = apply_delta(content, [{'retain': 8}, {'insert': '!'}, {'delete': 1}])
+    assert _text(result) == 'Hello 😀!world\n'
+
+
+def test_delete_whole_emoji():
+    result = apply_delta('Hello 😀 world', [{'retain': 6}, {'delete': 2}])
+    assert _text(result) == 'Hello  world'
+
+
+@pytest.mark.parametrize('ops', [
+    [{'retain': 7}, {'delete': 1}],
+    [{'retain': 7}, {'insert': 'x'}],
+    [{'retain': 6}, {'delete': 1}],
+])
+def test_boundary_inside_surrogate_pair_is_rejected(ops):
+    with pytest.raises(DeltaError):
+        apply_delta('Hello 😀 world', ops)
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+from flask import Flask, g
+
+from app.models import sqlite_storage
+from app.utils.retrieval import search_index_tokens, tokenize
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(sqlite_storage, '_pool', sqlite_storage._ConnectionPool(str(tmp_path / 'test.db'), 2))
+    app = Flask(__name__)
+    with app.app_context():
+        g.current_user = 'user-a'
+        yield sqlite_storage
+    sqlite_storage._pool.close()
+
+
+def test_index_tokens_include_unigrams():
+    assert {'犬', '犬が', 'が', '好き'} <= search_index_tokens('犬が好きです')
+    assert tokenize('犬') == ['犬']
+
+
+@pytest.mark.parametrize('query', ['犬', 'す', '犬が', '好き'])
+def test_one_and_two_character_queries_match(storage, query):
+    doc = storage.create_document('メモ', json.dumps({'ops': [{'insert': '犬が好きです\n'}]}))
+    results = storage.search_documents(query)
+    assert [r['document_id'] for r in results] == [doc['id']]
+
+
+def test_one_character_query_matches_chat_messages(storage):
+    doc = storage.create_document('メモ', '')
+    storage.create_chat_message(doc['id'], 'user', '猫について')
+    results = storage.search_documents('猫', scope='chats')
+    assert [r['kind'] for r in results] == ['chat']